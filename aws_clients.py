@@ -0,0 +1,101 @@
+# aws_clients.py - shared, lazily created boto3 clients and resources for the pipeline handlers.
+# Handlers declare their clients at module level as before (s3_client = aws_clients.client("s3")),
+# but nothing is imported or built until the first call on them. boto3 itself is only imported
+# then, so a cold start doesn't pay for clients a code path never uses. Every handler in the
+# container shares one session and one client per service, all with the same pool and retry config.
+#
+# AWS_CLIENTS_EAGER=true builds every declared client during INIT instead, which suits
+# provisioned concurrency (INIT runs before any request arrives).
+import os
+import threading
+import time
+
+AWS_REGION = os.environ.get("AWS_REGION") or os.environ.get("AWS_DEFAULT_REGION") or "us-east-1"
+# send_email_lambda publishes from a thread pool, so allow more than botocore's default of 10
+MAX_POOL_CONNECTIONS = int(os.environ.get("AWS_MAX_POOL_CONNECTIONS", 32))
+CONNECT_TIMEOUT_SECONDS = float(os.environ.get("AWS_CONNECT_TIMEOUT_SECONDS", 2))
+READ_TIMEOUT_SECONDS = float(os.environ.get("AWS_READ_TIMEOUT_SECONDS", 10))
+# "standard" retries throttling and transient errors with backoff; callers retry partial failures themselves
+RETRY_MODE = os.environ.get("AWS_RETRY_MODE", "standard")
+MAX_ATTEMPTS = int(os.environ.get("AWS_MAX_ATTEMPTS", 3))
+EAGER = os.environ.get("AWS_CLIENTS_EAGER", "false").lower() == "true"
+
+_session = None
+_instances = {}  # (kind, service) -> boto3 client/resource or a registered stand-in
+_lock = threading.Lock()
+# "client:s3" -> milliseconds it took to build, for the cold-start profiler
+INIT_TIMES = {}
+
+
+def _config():
+    from botocore.config import Config
+    return Config(
+        region_name=AWS_REGION,
+        max_pool_connections=MAX_POOL_CONNECTIONS,
+        connect_timeout=CONNECT_TIMEOUT_SECONDS,
+        read_timeout=READ_TIMEOUT_SECONDS,
+        retries={"mode": RETRY_MODE, "max_attempts": MAX_ATTEMPTS},
+        tcp_keepalive=True,
+    )
+
+
+def get(kind, service):
+    # The shared client ("client") or resource ("resource") for a service, built on first use
+    instance = _instances.get((kind, service))
+    if instance is None:
+        with _lock:
+            instance = _instances.get((kind, service))
+            if instance is None:
+                global _session
+                started = time.perf_counter()
+                if _session is None:
+                    import boto3
+                    _session = boto3.session.Session(region_name=AWS_REGION)
+                factory = _session.client if kind == "client" else _session.resource
+                instance = factory(service, config=_config())
+                INIT_TIMES[f"{kind}:{service}"] = round((time.perf_counter() - started) * 1000, 3)
+                _instances[(kind, service)] = instance
+    return instance
+
+
+class LazyClient:
+    # Module-level placeholder that forwards every attribute to the shared instance
+    __slots__ = ("kind", "service")
+
+    def __init__(self, kind, service):
+        self.kind = kind
+        self.service = service
+
+    def __getattr__(self, name):
+        return getattr(get(self.kind, self.service), name)
+
+    def resolve(self):
+        return get(self.kind, self.service)
+
+    def __repr__(self):
+        return f"<LazyClient {self.kind}:{self.service}>"
+
+
+def client(service):
+    lazy = LazyClient("client", service)
+    if EAGER:
+        lazy.resolve()
+    return lazy
+
+
+def resource(service):
+    lazy = LazyClient("resource", service)
+    if EAGER:
+        lazy.resolve()
+    return lazy
+
+
+def register(service, instance, kind="client"):
+    # Uses instance (e.g. a local_aws stand-in) for every handler's client of this service
+    _instances[(kind, service)] = instance
+
+
+def reset():
+    # Forgets every client and stand-in; the next use builds fresh ones
+    _instances.clear()
+    INIT_TIMES.clear()
@@ -0,0 +1,62 @@
+# batching.py - shared helpers for passing surveys between the pipeline Lambdas in batches
+import os
+import codec
+
+# Async (InvocationType='Event') payloads are capped at 256 KB, so keep some headroom
+MAX_PAYLOAD_BYTES = int(os.environ.get("MAX_PAYLOAD_BYTES", 240 * 1024))
+# Maximum number of surveys forwarded in a single invoke
+BATCH_SIZE = int(os.environ.get("BATCH_SIZE", 500))
+
+# Batch events look like {"trace_id": ..., "surveys": [survey, survey, ...]}
+BATCH_KEY = "surveys"
+
+_BATCH_SUFFIX = b']}'
+
+
+class ForwardingError(Exception):
+    # Surveys couldn't be passed on to the next Lambda, even through the overflow queue. Raised
+    # at the end of a handler so the invocation fails and Lambda retries it (or sends it to the
+    # DLQ); the stages downstream drop the surveys they already have as duplicates.
+    pass
+
+
+def unpack_event(event):
+    # Returns (surveys, is_batch). The old single-survey event is treated as a batch of one.
+    if isinstance(event, dict) and isinstance(event.get(BATCH_KEY), list):
+        return event[BATCH_KEY], True
+    return [event], False
+
+
+def iter_batch_payloads(items, batch_size=None, max_bytes=None, extra=None):
+    # Yields (chunk, payload) pairs where payload is the JSON batch event for chunk, as UTF-8 bytes.
+    # Items are encoded once (compactly, through codec) and packed until either limit would be exceeded.
+    # extra holds envelope fields (e.g. the trace ID) sent alongside the surveys.
+    batch_size = batch_size or BATCH_SIZE
+    max_bytes = max_bytes or MAX_PAYLOAD_BYTES
+    envelope = codec.dumps_bytes(extra or {})[:-1]
+    prefix = envelope + (b',"' if extra else b'"') + BATCH_KEY.encode("utf-8") + b'":['
+    overhead = len(prefix) + len(_BATCH_SUFFIX)
+
+    chunk, parts, size = [], [], overhead
+    for item in items:
+        encoded = codec.dumps_bytes(item)
+        # +1 for the separating comma
+        if chunk and (len(chunk) >= batch_size or size + len(encoded) + 1 > max_bytes):
+            yield chunk, prefix + b",".join(parts) + _BATCH_SUFFIX
+            chunk, parts, size = [], [], overhead
+        chunk.append(item)
+        parts.append(encoded)
+        size += len(encoded) + 1
+
+    if chunk:
+        yield chunk, prefix + b",".join(parts) + _BATCH_SUFFIX
+
+
+def invoke_in_batches(lambda_client, function_name, items, batch_size=None, max_bytes=None):
+    # Asynchronously invokes function_name with batch events covering all items, carrying
+    # the current trace ID. Returns (sent_count, failed_items) so callers can account for every survey.
+    # The invokes run in parallel, throttle-aware, through invoker.InvokeExecutor.
+    from invoker import InvokeExecutor  # invoker imports this module
+    executor = InvokeExecutor(function_name, lambda_client)
+    executor.submit(items, batch_size, max_bytes)
+    return executor.close()
@@ -0,0 +1,774 @@
+# benchmark.py - synthetic survey workload and per-stage benchmarks for the pipeline handlers.
+# Every handler runs against the in-memory AWS stand-ins from local_aws.py. Files are pushed
+# through verify -> cat_lambda -> rec_lambda -> send_email_lambda one at a time, and what the
+# handlers write and never read back (stored results, S3 result objects, SNS messages, queued
+# sends, settled idempotency claims) is dropped after each file, so the stand-ins only keep
+# per-user state and memory doesn't grow with the number of records.
+#
+# Usage:
+#   python benchmark.py --records 100000
+#   python benchmark.py --records 100000 --compare bench_results/<older commit>.json
+#   python benchmark.py --records 1000000 --write-ndjson /tmp/surveys.ndjson   # only write the workload
+#   python benchmark.py --records 100000 --micro validation   # one code path against its predecessor
+#   python benchmark.py --cold-start [<older checkout>]          # import and client init time per handler
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+import local_aws
+
+PHASES = ("Menstruation", "Follicular", "Ovulation", "Luteal")
+# Days spent in each phase over a typical 28-day cycle
+PHASE_WEIGHTS = (5, 9, 3, 11)
+
+# Q5 options, as listed in the README
+SYMPTOMS = [
+    "Cramps",
+    "Bloating",
+    "Breast tenderness",
+    "Feeling hot or flushed",
+    "Headache or migraine",
+    "Acne or skin breakouts",
+    "Lower back pain",
+    "Digestive issues (constipation, diarrhea)",
+    "Breast fullness or swelling",
+]
+NO_SYMPTOMS = "Nothing noticeable today"
+ADDITIONAL_NOTES = ["", "", "", "Felt dizzy after waking up.", "Slept badly.", "Mild nausea in the morning."]
+
+# Per phase: answer weights for Q1 (0-4), Q2 (0-4), Q3 (1-5), Q6 (1-5) and symptom probabilities
+PHASE_PROFILES = {
+    "Menstruation": {
+        "q1": (0, 1, 3, 3, 2), "q2": (5, 3, 1, 0, 0), "q3": (4, 3, 2, 1, 0), "q6": (4, 4, 2, 1, 0),
+        "symptoms": {"Cramps": 0.7, "Lower back pain": 0.4, "Headache or migraine": 0.3, "Bloating": 0.3},
+    },
+    "Follicular": {
+        "q1": (8, 1, 0, 0, 0), "q2": (1, 2, 4, 3, 1), "q3": (1, 2, 4, 3, 1), "q6": (0, 1, 3, 4, 2),
+        "symptoms": {"Acne or skin breakouts": 0.1, "Headache or migraine": 0.05},
+    },
+    "Ovulation": {
+        "q1": (9, 1, 0, 0, 0), "q2": (0, 0, 1, 3, 6), "q3": (0, 1, 2, 4, 4), "q6": (0, 0, 2, 4, 4),
+        "symptoms": {"Feeling hot or flushed": 0.4, "Breast tenderness": 0.1},
+    },
+    "Luteal": {
+        "q1": (8, 2, 0, 0, 0), "q2": (2, 5, 2, 1, 0), "q3": (2, 4, 3, 1, 0), "q6": (1, 3, 4, 2, 0),
+        "symptoms": {"Bloating": 0.5, "Breast tenderness": 0.4, "Breast fullness or swelling": 0.3,
+                     "Digestive issues (constipation, diarrhea)": 0.3, "Acne or skin breakouts": 0.3},
+    },
+}
+
+
+# --- Synthetic workload ---
+def _corrupt(survey, rng):
+    # Breaks a survey in one of the ways verify rejects
+    kind = rng.randrange(5)
+    if kind == 0:
+        survey["time_elapsed"] = round(rng.uniform(0, 4.9), 1)
+    elif kind == 1:
+        survey["user_id"] = ""
+    elif kind == 2:
+        survey["timestamp"] = survey["timestamp"][:8]
+    elif kind == 3:
+        survey["responses"]["Q5"] = {"symptoms": [], "additional": ""}
+    else:
+        del survey["responses"]["Q%d" % rng.randint(1, 6)]
+
+
+def generate_surveys(count, seed=0, invalid_rate=0.05, users=1000, start=datetime(2024, 5, 1)):
+    # Yields `count` surveys following the tests/*.json schema. The same seed always
+    # produces the same workload.
+    rng = random.Random(seed)
+    for i in range(count):
+        phase = rng.choices(PHASES, PHASE_WEIGHTS)[0]
+        profile = PHASE_PROFILES[phase]
+        submitted = start + timedelta(days=i * 30 // max(count, 1), seconds=rng.randrange(86400))
+
+        symptoms = [symptom for symptom, p in profile["symptoms"].items() if rng.random() < p]
+        if rng.random() < 0.05:
+            symptoms.append(rng.choice(SYMPTOMS))
+            symptoms = list(dict.fromkeys(symptoms))
+
+        survey = {
+            "user_id": "user_%06d" % rng.randrange(users),
+            "timestamp": submitted.strftime("%m%d%y%H%M%S"),
+            "time_elapsed": round(rng.lognormvariate(3, 0.6), 1),
+            "responses": {
+                "Q1": rng.choices(range(0, 5), profile["q1"])[0],
+                "Q2": rng.choices(range(0, 5), profile["q2"])[0],
+                "Q3": rng.choices(range(1, 6), profile["q3"])[0],
+                "Q4": rng.randint(1, 5),
+                "Q5": {
+                    "symptoms": symptoms or [NO_SYMPTOMS],
+                    "additional": rng.choice(ADDITIONAL_NOTES),
+                },
+                "Q6": rng.choices(range(1, 6), profile["q6"])[0],
+            },
+        }
+        if rng.random() < invalid_rate:
+            _corrupt(survey, rng)
+        yield survey
+
+
+def write_ndjson(path, surveys):
+    count = 0
+    with open(path, "w") as f:
+        for survey in surveys:
+            f.write(json.dumps(survey) + "\n")
+            count += 1
+    return count
+
+
+def user_email_config(users):
+    return [{"user_id": "user_%06d" % i, "email": "user_%06d@example.com" % i} for i in range(users)]
+
+
+# --- Replaced code paths ---
+# rec_lambda's float handling before codec.py, which the microbenchmarks compare against
+def convert_floats(obj):
+    if isinstance(obj, float):
+        return Decimal(str(obj))
+    elif isinstance(obj, dict):
+        return {k: convert_floats(v) for k, v in obj.items()}
+    elif isinstance(obj, list):
+        return [convert_floats(elem) for elem in obj]
+    return obj
+
+
+class DecimalEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, Decimal):
+            return float(obj)
+        return super().default(obj)
+
+
+# --- Measurement ---
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    k = (len(sorted_values) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if platform.system() == "Darwin" else 1024), 1)
+
+
+class StageTimer:
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.records = 0
+
+    def time(self, handler, event, records):
+        started = time.perf_counter()
+        result = handler(event, None)
+        self.latencies.append(time.perf_counter() - started)
+        self.records += records
+        return result
+
+    def report(self):
+        latencies = sorted(self.latencies)
+        total = sum(latencies)
+        return {
+            "invocations": len(latencies),
+            "records": self.records,
+            "seconds": round(total, 4),
+            "records_per_second": round(self.records / total, 1) if total else 0.0,
+            "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        }
+
+
+def _batch_size(event):
+    return len(event["surveys"]) if "surveys" in event else 1
+
+
+def install_stand_ins(users):
+    # Points every handler's module-level clients at the local stand-ins
+    import aws_clients, idempotency, invoker, scheduler, send_email_lambda, survey_index
+
+    aws = {"s3": local_aws.LocalS3(), "lambda": local_aws.LocalLambda(),
+           "dynamodb": local_aws.LocalDynamoDB(), "dynamodb_client": local_aws.LocalDynamoDBClient(),
+           "sns": local_aws.LocalSNS(),
+           "sqs": local_aws.LocalSQS(f"arn:aws:sqs:us-east-1:000000000000:{invoker.INVOKE_OVERFLOW_QUEUE_NAME}")}
+    aws_clients.register("s3", aws["s3"])
+    aws_clients.register("lambda", aws["lambda"])
+    aws_clients.register("sqs", aws["sqs"])
+    invoker.reset()
+    # A fresh ledger, so forget what this process claimed in an earlier run
+    idempotency._seen = idempotency.LRUSet(idempotency.LRU_SIZE)
+    aws_clients.register("sns", aws["sns"])
+    aws_clients.register("dynamodb", aws["dynamodb_client"])
+    aws_clients.register("dynamodb", aws["dynamodb"], kind="resource")
+    for name, (partition_key, sort_key, projection) in survey_index.INDEXES.items():
+        aws["dynamodb"].define_index(survey_index.TABLE_NAME, name, partition_key, sort_key, projection)
+    aws["dynamodb"].define_table(scheduler.SEND_QUEUE_TABLE_NAME, "user_id", "send_date")
+    aws["dynamodb"].define_index(scheduler.SEND_QUEUE_TABLE_NAME, scheduler.DUE_INDEX, "due_day", "slot")
+    # The stand-ins have no service quotas; measure the code, not the SNS rate limit
+    send_email_lambda._publish_limiter = send_email_lambda.TokenBucket(1e9, 1e9)
+
+    aws["s3"].put_object(Bucket=send_email_lambda.S3_CONFIG_BUCKET, Key=send_email_lambda.S3_USER_EMAILS_KEY,
+                         Body=json.dumps(user_email_config(users)))
+    return aws
+
+
+def discard_outputs(aws):
+    # Drops what the handlers wrote that no later invocation reads, keeping the email directory,
+    # cycle state and anything still queued for a handler
+    import idempotency, rec_lambda, scheduler, survey_index
+    for bucket, key in [key for key in aws["s3"].objects if key[1].startswith(rec_lambda.S3_RESULTS_PREFIX)]:
+        del aws["s3"].objects[(bucket, key)]
+    aws["dynamodb"].Table(survey_index.TABLE_NAME).clear()
+    aws["dynamodb"].Table(scheduler.SEND_QUEUE_TABLE_NAME).clear()
+    aws["dynamodb_client"].tables[idempotency.IDEMPOTENCY_TABLE_NAME].clear()
+    idempotency._seen = idempotency.LRUSet(idempotency.LRU_SIZE)
+    aws["sns"].messages.clear()
+
+
+def run_benchmark(records, seed=0, invalid_rate=0.05, users=1000, records_per_file=1000):
+    import verify, cat_lambda, rec_lambda, send_email_lambda
+
+    aws = install_stand_ins(users)
+    stages = {name: StageTimer(name) for name in ("verify", "cat_lambda", "rec_lambda", "send_email_lambda")}
+    surveys = generate_surveys(records, seed=seed, invalid_rate=invalid_rate, users=users)
+    bucket = "benchmark"
+    started = time.perf_counter()
+
+    # Handlers log with print; keep that out of the measurements' output
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        file_index = 0
+        while True:
+            batch = [survey for _, survey in zip(range(records_per_file), surveys)]
+            if not batch:
+                break
+            key = f"raw_surveys/bench_{file_index:06d}.json"
+            aws["s3"].put_object(Bucket=bucket, Key=key, Body=json.dumps(batch))
+            event = {"Records": [{"s3": {"bucket": {"name": bucket}, "object": {"key": key}}}]}
+            stages["verify"].time(verify.lambda_handler, event, len(batch))
+            del aws["s3"].objects[(bucket, key)]
+
+            for event in aws["lambda"].take(verify.CAT_LAMBDA_FUNCTION_NAME):
+                stages["cat_lambda"].time(cat_lambda.lambda_handler, event, _batch_size(event))
+            for event in aws["lambda"].take(cat_lambda.REC_LAMBDA_FUNCTION_NAME):
+                stages["rec_lambda"].time(rec_lambda.lambda_handler, event, _batch_size(event))
+            for event in aws["lambda"].take(rec_lambda.SEND_EMAIL_LAMBDA_FUNCTION_NAME):
+                stages["send_email_lambda"].time(send_email_lambda.lambda_handler, event, _batch_size(event))
+            discard_outputs(aws)
+            file_index += 1
+
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "created": datetime.utcnow().isoformat(timespec="seconds") + "Z",
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+        },
+        "params": {"records": records, "seed": seed, "invalid_rate": invalid_rate, "users": users,
+                   "records_per_file": records_per_file},
+        "total_seconds": round(time.perf_counter() - started, 3),
+        # Process-wide, so it also covers the workload generator and the stand-ins
+        "peak_rss_mb": peak_rss_mb(),
+        "stages": {name: stage.report() for name, stage in stages.items()},
+        "aws_calls": {
+            "s3": dict(aws["s3"].calls),
+            "lambda": dict(aws["lambda"].calls),
+            "dynamodb": dict(aws["dynamodb"].calls + aws["dynamodb_client"].calls),
+            "sns": dict(aws["sns"].calls),
+        },
+    }
+
+
+# --- Microbenchmarks ---
+# Each compares one optimized code path with the code it replaced on the same workload
+def records_per_second(function, records, repeat=3):
+    # Best of `repeat` runs, so a noisy neighbour doesn't decide the result
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - started)
+    return round(records / best, 1)
+
+
+def bench_validation(records, seed=0, invalid_rate=0.05):
+    # verify: validate_questionnaire one record at a time vs validate_batch over VALIDATION_BATCH_SIZE columns
+    import verify
+    surveys = list(generate_surveys(records, seed, invalid_rate))
+    size = verify.VALIDATION_BATCH_SIZE
+
+    def row_loop():
+        for survey in surveys:
+            verify.validate_questionnaire(survey)
+
+    def columnar():
+        for start in range(0, len(surveys), size):
+            verify.validate_batch(surveys[start:start + size])
+
+    row_rate, columnar_rate = records_per_second(row_loop, records), records_per_second(columnar, records)
+    return {"row_loop_records_per_second": row_rate, "columnar_records_per_second": columnar_rate,
+            "speedup": round(columnar_rate / row_rate, 2)}
+
+
+# --- Cold start ---
+# Each handler is imported in a fresh interpreter, as in a Lambda INIT, and then has its clients
+# built, as the first invocation would. -X importtime attributes the import time to modules.
+HANDLERS = ("verify", "cat_lambda", "rec_lambda", "send_email_lambda")
+
+_COLD_START_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+module = __import__(sys.argv[1])
+imported = time.perf_counter()
+clients = {}
+try:
+    import aws_clients
+    for value in list(vars(module).values()):
+        if isinstance(value, aws_clients.LazyClient):
+            value.resolve()
+    clients = aws_clients.INIT_TIMES
+except ImportError:
+    pass  # trees from before aws_clients.py build their clients during the import
+finished = time.perf_counter()
+print(json.dumps({"import_ms": (imported - started) * 1000, "init_ms": (finished - started) * 1000, "clients": clients}))
+"""
+
+
+def _top_imports(importtime, count=5):
+    # Slowest top-level imports from -X importtime output, as {module: cumulative ms}
+    imports = []
+    for line in importtime.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Nested imports are indented further than the single space of a top-level one
+        if not name.startswith("  "):
+            imports.append((name.strip(), int(cumulative) / 1000))
+    imports.sort(key=lambda item: -item[1])
+    return {name: round(ms, 1) for name, ms in imports[:count]}
+
+
+def profile_cold_start(root=None, repeat=5):
+    # Median import and INIT (import + client creation) time per handler, in milliseconds.
+    # root is the tree to profile, so an older checkout can be measured the same way.
+    root = root or os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=root, PYTHONDONTWRITEBYTECODE="1")
+    env.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    results = {}
+    for handler in HANDLERS:
+        runs, importtime = [], ""
+        for _ in range(repeat):
+            process = subprocess.run([sys.executable, "-X", "importtime", "-c", _COLD_START_SCRIPT, handler],
+                                     capture_output=True, text=True, cwd=root, env=env, check=True)
+            runs.append(json.loads(process.stdout.strip().splitlines()[-1]))
+            importtime = process.stderr
+        runs.sort(key=lambda run: run["init_ms"])
+        median = runs[len(runs) // 2]
+        results[handler] = {"import_ms": round(median["import_ms"], 1), "init_ms": round(median["init_ms"], 1),
+                            "clients_ms": median["clients"], "top_imports": _top_imports(importtime)}
+    return results
+
+
+def bench_rendering(records, seed=0, invalid_rate=0.05):
+    # send_email_lambda: rendering every message from the templates vs the cached per-phase rendering.
+    # Runs at 1%, 10% and 100% of records; the cached cost per message should not grow with volume.
+    import message_templates
+    import rec_lambda
+    rng = random.Random(seed)
+    messages = [(f"user_{rng.randrange(1000):06d}", phase, rec_lambda.generate_recommendations(phase))
+                for phase in rng.choices(PHASES, PHASE_WEIGHTS, k=records)]
+
+    def uncached(batch):
+        for user_id, phase, recommendations in batch:
+            parts, subject = message_templates.render_template(message_templates.DEFAULT_LOCALE, phase, recommendations)
+            json.dumps(user_id)[1:-1].join(parts)
+
+    def cached(batch):
+        for user_id, phase, recommendations in batch:
+            message_templates.render(user_id, phase, recommendations)
+
+    result = {}
+    for volume in sorted({max(1, records // 100), max(1, records // 10), records}):
+        batch = messages[:volume]
+        message_templates.clear()
+        uncached_rate = records_per_second(lambda: uncached(batch), volume)
+        cached_rate = records_per_second(lambda: cached(batch), volume)
+        result[str(volume)] = {"uncached_us_per_message": round(1e6 / uncached_rate, 3),
+                               "cached_us_per_message": round(1e6 / cached_rate, 3),
+                               "speedup": round(cached_rate / uncached_rate, 2)}
+    return result
+
+
+def bench_persistence(records, seed=0, invalid_rate=0.05, unprocessed_rate=0.3):
+    # rec_lambda persistence: one put_item and one pretty-printed put_object per result (as before
+    # the bulk writes) vs save_results_to_dynamodb and save_results_to_s3, on the local stand-ins.
+    # unprocessed_rate of the items in each BatchWriteItem come back as UnprocessedItems.
+    # tests/test_persistence.py checks the same writes for correctness.
+    import instrumentation
+    import rec_lambda
+    rng = random.Random(seed)
+    results = [rec_lambda.build_result(dict(survey, phase=rng.choice(PHASES)))
+               for survey in generate_surveys(records, seed, 0)]
+    keys = {(result["user_id"], result["timestamp"]) for result in results}
+
+    def before(aws):
+        table = aws["dynamodb"].Table(rec_lambda.DYNAMO_TABLE_NAME)
+        for result in results:
+            safe_result = convert_floats(result)
+            table.put_item(Item=safe_result)
+            aws["s3"].put_object(Bucket=rec_lambda.S3_BUCKET, Key=f"recommendations/{result['user_id']}_{result['timestamp']}.json",
+                                 Body=json.dumps(safe_result, cls=DecimalEncoder, indent=2))
+
+    def after(aws):
+        batch_write_item = aws["dynamodb"].batch_write_item
+
+        def batch_write_with_unprocessed(RequestItems, **kwargs):
+            written, unprocessed = {}, {}
+            for table_name, requests in RequestItems.items():
+                for request in requests:
+                    (unprocessed if rng.random() < unprocessed_rate else written).setdefault(table_name, []).append(request)
+            batch_write_item(RequestItems=written)
+            if not written:
+                aws["dynamodb"].calls["batch_write_item"] += 1
+            return {"UnprocessedItems": unprocessed}
+
+        aws["dynamodb"].batch_write_item = batch_write_with_unprocessed
+        instrumentation.start("benchmark", {})
+        rec_lambda.save_results_to_dynamodb(results)
+        rec_lambda.save_results_to_s3(results)
+
+    saved_backoff = rec_lambda.DYNAMO_BACKOFF_BASE_SECONDS
+    rec_lambda.DYNAMO_BACKOFF_BASE_SECONDS = 0
+    result = {"results": records}
+    try:
+        for name, function in (("before", before), ("after", after)):
+            aws = install_stand_ins(1000)
+            # The stand-ins start with the email directory in S3
+            dynamodb_calls, s3_calls, s3_bytes = sum(aws["dynamodb"].calls.values()), aws["s3"].calls["put_object"], aws["s3"].bytes_written
+            started = time.perf_counter()
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                function(aws)
+            elapsed = time.perf_counter() - started
+            stored = set(aws["dynamodb"].Table(rec_lambda.DYNAMO_TABLE_NAME).items)
+            result[name] = {"seconds": round(elapsed, 3), "stored": len(stored & keys),
+                            "dynamodb_requests": sum(aws["dynamodb"].calls.values()) - dynamodb_calls,
+                            "s3_requests": aws["s3"].calls["put_object"] - s3_calls,
+                            "s3_bytes_written": aws["s3"].bytes_written - s3_bytes}
+    finally:
+        rec_lambda.DYNAMO_BACKOFF_BASE_SECONDS = saved_backoff
+    return result
+
+
+def bench_codec(records, seed=0, invalid_rate=0.05):
+    # rec_lambda persistence and batch payloads: the recursive convert_floats copy plus json.dumps
+    # (a new encoder per call) it replaced vs codec.to_dynamodb and codec.dumps_bytes.
+    # Peak memory is traced over one BATCH_SIZE batch, as one rec_lambda invocation holds it.
+    import tracemalloc
+    import batching
+    import codec
+    import rec_lambda
+    results = [rec_lambda.build_result(dict(survey, phase=phase)) for survey, phase in
+               zip(generate_surveys(records, seed, 0), random.Random(seed).choices(PHASES, k=records))]
+
+    def before(batch):
+        items = [convert_floats(result) for result in batch]
+        body = "".join(json.dumps(row, cls=DecimalEncoder, separators=(",", ":")) + "\n" for row in batch).encode("utf-8")
+        payloads = [json.dumps(result) for result in batch]
+        return items, body, payloads
+
+    def after(batch):
+        items = [codec.to_dynamodb(result) for result in batch]
+        body = b"".join(codec.dumps_bytes(row) + b"\n" for row in batch)
+        payloads = [codec.dumps_bytes(result) for result in batch]
+        return items, body, payloads
+
+    batch = results[:batching.BATCH_SIZE]
+    result = {"backend": codec.BACKEND}
+    for name, function in (("before", before), ("after", after)):
+        rate = records_per_second(lambda: function(results), records)
+        tracemalloc.start()
+        _, body, payloads = function(batch)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        result[name] = {"records_per_second": rate, "us_per_record": round(1e6 / rate, 3),
+                        "peak_bytes_per_record": peak // len(batch),
+                        "payload_bytes_per_record": sum(map(len, payloads)) // len(batch),
+                        "s3_bytes_per_record": len(body) // len(batch)}
+    result["speedup"] = round(result["after"]["records_per_second"] / result["before"]["records_per_second"], 2)
+    return result
+
+
+def bench_index(records, seed=0, invalid_rate=0.05, users=1000, lookups=20):
+    # survey_index: history() and users_in_phase() Queries vs a full paginated scan filtered
+    # client-side, on the local DynamoDB stand-in. Read units follow DynamoDB's 4 KB rounding.
+    import instrumentation
+    import rec_lambda
+    import survey_index
+    aws = install_stand_ins(users)
+    instrumentation.start("benchmark", {})
+    rng = random.Random(seed)
+    results = [rec_lambda.build_result(dict(survey, phase=rng.choice(PHASES)))
+               for survey in generate_surveys(records, seed, 0, users)]
+    rec_lambda.save_results_to_dynamodb(results)
+    table = aws["dynamodb"].Table(survey_index.TABLE_NAME)
+    days = sorted({survey_index.surveyed_at(result["timestamp"])[:10] for result in results})
+    since = days[-7]
+    user_ids = sorted({result["user_id"] for result in results})
+    lookup_users = rng.sample(user_ids, min(lookups, len(user_ids)))
+    lookup_days = [(rng.choice(days), rng.choice(PHASES)) for _ in range(lookups)]
+
+    def scan_all():
+        request = {}
+        while True:
+            response = table.scan(**request)
+            yield from response["Items"]
+            if "LastEvaluatedKey" not in response:
+                return
+            request["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    def measure(function):
+        read_units, calls = aws["dynamodb"].read_units, sum(aws["dynamodb"].calls.values())
+        started = time.perf_counter()
+        answers = function()
+        elapsed = time.perf_counter() - started
+        return answers, {"ms_per_lookup": round(elapsed * 1000 / lookups, 3),
+                         "read_units_per_lookup": round((aws["dynamodb"].read_units - read_units) / lookups, 1),
+                         "requests_per_lookup": round((sum(aws["dynamodb"].calls.values()) - calls) / lookups, 1)}
+
+    query_history, history_query = measure(lambda: [
+        [item["timestamp"] for item in survey_index.history(user_id, since)] for user_id in lookup_users])
+    scan_history, history_scan = measure(lambda: [
+        [item["timestamp"] for item in sorted((item for item in scan_all()
+                                               if item["user_id"] == user_id and item["surveyed_at"] >= since),
+                                              key=lambda item: item["surveyed_at"])]
+        for user_id in lookup_users])
+    query_phase, phase_query = measure(lambda: [survey_index.users_in_phase(day, phase) for day, phase in lookup_days])
+    scan_phase, phase_scan = measure(lambda: [
+        sorted({item["user_id"] for item in scan_all() if item["surveyed_at"][:10] == day and item["phase"] == phase})
+        for day, phase in lookup_days])
+    assert query_history == scan_history and query_phase == scan_phase, "index and scan answers differ"
+    return {"items": len(table.items), "lookups": lookups,
+            "history": {"scan": history_scan, "query": history_query},
+            "users_in_phase": {"scan": phase_scan, "query": phase_query}}
+
+
+# Time zones of the synthetic users in bench_scheduler
+BENCH_TIME_ZONES = ("America/New_York", "America/Chicago", "America/Denver", "America/Los_Angeles")
+
+
+def bench_scheduler(records, seed=0, invalid_rate=0.05, repeat_rate=0.1, upload_at=datetime(2024, 5, 1, 11, 30)):
+    # send_email_lambda with the send scheduler vs immediate delivery, for a morning upload of
+    # `records` results (repeat_rate of them a second same-day result for a user) arriving in one
+    # minute. The scheduled run is drained a minute at a time with a simulated clock.
+    import scheduler
+    import send_email_lambda
+    users = max(1, int(records * (1 - repeat_rate)))
+    rng = random.Random(seed)
+    directory = [dict(entry, time_zone=BENCH_TIME_ZONES[i % len(BENCH_TIME_ZONES)], send_hour=rng.choice((7, 8, 9)))
+                 for i, entry in enumerate(user_email_config(users))]
+    results = [{"user_id": "user_%06d" % (i % users), "timestamp": (upload_at + timedelta(seconds=i)).strftime("%m%d%y%H%M%S"),
+                "phase": rng.choice(PHASES)} for i in range(records)]
+    for result in results:
+        result["recommendations_list"] = ["Recommendation for the %s phase." % result["phase"]]
+    upload = upload_at.replace(tzinfo=timezone.utc)
+    clock = [upload]
+    utcnow, enabled = scheduler.utcnow, scheduler.SEND_SCHEDULER_ENABLED
+    scheduler.utcnow = lambda: clock[0]
+
+    def deliver(scheduled):
+        aws = install_stand_ins(users)
+        aws["s3"].put_object(Bucket=send_email_lambda.S3_CONFIG_BUCKET, Key=send_email_lambda.S3_USER_EMAILS_KEY,
+                             Body=json.dumps(directory))
+        send_email_lambda._email_directory_cache.clear()
+        scheduler.SEND_SCHEDULER_ENABLED = scheduled
+        clock[0] = upload
+        per_minute = Counter()
+        for start in range(0, len(results), 500):
+            send_email_lambda.lambda_handler({"surveys": results[start:start + 500]}, None)
+        per_minute[0] = len(aws["sns"].messages)
+        if not scheduled:
+            return aws, per_minute, {}
+
+        queue = aws["dynamodb"].Table(scheduler.SEND_QUEUE_TABLE_NAME)
+        slots = {item["user_id"]: (item["slot"], item["window_end"]) for item in queue.items.values()}
+        queue_bytes = sum(queue.sizes.values()) // max(1, len(queue.items))
+        lags, late, minute = [], 0, 0
+        while queue.items and minute < 48 * 60:
+            minute += 1
+            clock[0] = upload + timedelta(minutes=minute)
+            now, sent_before = scheduler._slot(clock[0]), len(aws["sns"].messages)
+            send_email_lambda.drain_handler({"source": "aws.events"}, None)
+            for message in aws["sns"].messages[sent_before:]:
+                slot, window_end = slots[message["MessageAttributes"]["user_id"]["StringValue"]]
+                lags.append((clock[0] - scheduler._parse_slot(slot)).total_seconds())
+                late += slot <= window_end < now
+            per_minute[minute] = len(aws["sns"].messages) - sent_before
+        lags.sort()
+        return aws, per_minute, {"queue_items": len(slots), "queue_bytes_per_item": queue_bytes,
+                                 "drain_runs": minute, "lag_p50_s": percentile(lags, 50),
+                                 "lag_p95_s": percentile(lags, 95), "lag_max_s": lags[-1] if lags else 0,
+                                 "late": late, "left_in_queue": len(queue.items)}
+
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            _, immediate, _ = deliver(False)
+            aws, scheduled, stats = deliver(True)
+    finally:
+        scheduler.utcnow, scheduler.SEND_SCHEDULER_ENABLED = utcnow, enabled
+    busy = [minute for minute, sent in scheduled.items() if sent]
+    return {"results": records, "users": users,
+            "immediate": {"emails": sum(immediate.values()), "peak_sends_per_minute": max(immediate.values())},
+            "scheduled": dict(stats, emails=sum(scheduled.values()), peak_sends_per_minute=max(scheduled.values()),
+                              minutes_with_sends=len(busy), first_minute=min(busy, default=0),
+                              last_minute=max(busy, default=0))}
+
+
+def bench_invoke(records, seed=0, invalid_rate=0.05, latency_ms=30, concurrency_limit=8, throttle_rate=0.1):
+    # verify on one S3 file of `records` surveys: the old serial invoke loop (one invoke at a time,
+    # no retries, failures dropped) vs invoker.InvokeExecutor, against a Lambda stand-in where each
+    # invoke takes latency_ms, more than concurrency_limit at once are throttled and throttle_rate
+    # of the rest are throttled anyway (other traffic on the account's limits)
+    import aws_clients
+    import invoker
+    import verify
+    body = json.dumps(list(generate_surveys(records, seed, invalid_rate)))
+    settings = ("INVOKE_MAX_CONCURRENCY", "INVOKE_INITIAL_CONCURRENCY", "INVOKE_MAX_RETRIES", "INVOKE_OVERFLOW_QUEUE_NAME")
+    saved = {name: getattr(invoker, name) for name in settings}
+    serial = {"INVOKE_MAX_CONCURRENCY": 1, "INVOKE_INITIAL_CONCURRENCY": 1, "INVOKE_MAX_RETRIES": 0,
+              "INVOKE_OVERFLOW_QUEUE_NAME": ""}
+
+    def run(overrides):
+        for name, value in overrides.items():
+            setattr(invoker, name, value)
+        aws = install_stand_ins(1000)
+        rng = random.Random(seed)
+        lambda_stand_in = aws["lambda"] = local_aws.LocalLambda(latency_ms / 1000, concurrency_limit)
+        invoke = lambda_stand_in.invoke
+
+        def invoke_with_background_throttles(**kwargs):
+            if rng.random() < throttle_rate:
+                lambda_stand_in.calls["throttled"] += 1
+                raise local_aws.client_error("TooManyRequestsException", "Invoke", "Rate Exceeded.")
+            return invoke(**kwargs)
+
+        lambda_stand_in.invoke = invoke_with_background_throttles
+        aws_clients.register("lambda", lambda_stand_in)
+        aws["s3"].put_object(Bucket="benchmark", Key="raw_surveys/bench.json", Body=body)
+        event = {"Records": [{"s3": {"bucket": {"name": "benchmark"}, "object": {"key": "raw_surveys/bench.json"}}}]}
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            started = time.perf_counter()
+            verify.lambda_handler(event, None)
+            elapsed = time.perf_counter() - started
+        delivered = sum(len(payload["surveys"]) for payload in lambda_stand_in.invocations[verify.CAT_LAMBDA_FUNCTION_NAME])
+        spilled = sum(len(json.loads(message_body)["surveys"]) for _, message_body, _ in aws["sqs"].messages)
+        return {"seconds": round(elapsed, 3), "delivered": delivered, "spilled": spilled,
+                "invokes": lambda_stand_in.calls["invoke"], "throttled": lambda_stand_in.calls["throttled"],
+                "peak_in_flight": lambda_stand_in.peak_in_flight,
+                "final_concurrency_limit": round(invoker.limiter_for(verify.CAT_LAMBDA_FUNCTION_NAME).limit, 2)}
+
+    try:
+        before, after = run(serial), run(saved)
+    finally:
+        for name, value in saved.items():
+            setattr(invoker, name, value)
+    # Surveys verify forwards: the valid ones, once per (user_id, timestamp)
+    _, payloads, _, _ = verify.validate_batch(list(generate_surveys(records, seed, invalid_rate)))
+    valid = len({(payload["user_id"], payload["timestamp"]) for payload in payloads if payload is not None})
+    for result in (before, after):
+        result["dropped"] = valid - result["delivered"] - result["spilled"]
+    return {"valid_surveys": valid, "before": before, "after": after,
+            "speedup": round(before["seconds"] / after["seconds"], 2)}
+
+
+MICROBENCHMARKS = {
+    "invoke": bench_invoke,
+    "scheduler": bench_scheduler,
+    "persistence": bench_persistence,
+    "index": bench_index,
+    "codec": bench_codec,
+    "validation": bench_validation,
+    "rendering": bench_rendering,
+}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(baseline, current):
+    # Prints the change in throughput and p95 latency per stage against an earlier result file
+    print(f"Comparing {current['meta']['commit']} against {baseline['meta']['commit']}:")
+    for name, stage in current["stages"].items():
+        before = baseline["stages"].get(name)
+        if not before:
+            continue
+        for metric in ("records_per_second", "p95_ms"):
+            old, new = before[metric], stage[metric]
+            change = (new - old) / old * 100 if old else 0.0
+            print(f"  {name:18s} {metric:18s} {old:>12} -> {new:>12} ({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline handlers on a synthetic workload.")
+    parser.add_argument("--records", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--invalid-rate", type=float, default=0.05)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--records-per-file", type=int, default=1000)
+    parser.add_argument("--output", help="Result file (default: bench_results/<commit>.json)")
+    parser.add_argument("--compare", help="Earlier result file to compare against")
+    parser.add_argument("--write-ndjson", help="Only write the synthetic workload to this NDJSON file")
+    parser.add_argument("--micro", choices=sorted(MICROBENCHMARKS), help="Only run this microbenchmark")
+    parser.add_argument("--cold-start", nargs="?", const="", metavar="TREE",
+                        help="Only profile handler import and init time (of TREE, default this checkout)")
+    args = parser.parse_args()
+
+    if args.cold_start is not None:
+        result = profile_cold_start(args.cold_start or None)
+        print(json.dumps({"cold_start": result, "commit": git_commit()}, indent=2))
+        return
+
+    if args.micro:
+        result = MICROBENCHMARKS[args.micro](args.records, args.seed, args.invalid_rate)
+        print(json.dumps({"micro": args.micro, "records": args.records, "commit": git_commit(), **result}, indent=2))
+        return
+
+    if args.write_ndjson:
+        count = write_ndjson(args.write_ndjson, generate_surveys(args.records, args.seed, args.invalid_rate, args.users))
+        print(f"Wrote {count} surveys to {args.write_ndjson}")
+        return
+
+    results = run_benchmark(args.records, args.seed, args.invalid_rate, args.users, args.records_per_file)
+    output = args.output or os.path.join("bench_results", f"{results['meta']['commit']}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results["stages"], indent=2))
+    print(f"Peak RSS: {results['peak_rss_mb']} MB")
+    print(f"Saved results to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
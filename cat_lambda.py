@@ -1,105 +1,323 @@
 # cat_lambda.py (MODIFIED)
 import json
-import boto3
 import os
 from datetime import datetime
 from botocore.exceptions import ClientError
 from decimal import Decimal
+from batching import unpack_event, invoke_in_batches, ForwardingError
+import instrumentation
+import cycle_state
+import aws_clients
 
 # Initialize client for rec_lambda
-lambda_client = boto3.client('lambda')
+lambda_client = aws_clients.client('lambda')
+# Per-user cycle state (see cycle_state.py)
+dynamodb = aws_clients.resource('dynamodb')
+CYCLE_STATE_ENABLED = os.environ.get("CYCLE_STATE_ENABLED", "true").lower() == "true"
+
+# Define the name of the recommendation Lambda function
+REC_LAMBDA_FUNCTION_NAME = 'rec_lambda'  # Ensure this matches your rec_lambda function name
 
 def lambda_handler(event, context):
-    user_id = event.get("user_id")
-    responses = event.get("responses")
-    timestamp = event.get("timestamp")
-    time_elapsed = event.get("time_elapsed", 0)
+    # Accepts either a single survey or a batch event {"surveys": [...]} from verify
+    metrics = instrumentation.start("cat_lambda", event)
+    surveys, is_batch = unpack_event(event)
+    metrics.count("received", len(surveys))
 
-    # Parse and validate timestamp
-    try:
-        parsed_timestamp = datetime.strptime(timestamp, "%m%d%y%H%M%S")
-    except Exception:
-        print(f"Error: Invalid timestamp format for user {user_id}: {timestamp}")
-        return {
-            "user_id": user_id,
-            "valid": False,
-            "reason": "Invalid timestamp format"
-        }
+    valid_surveys = []
+    surveyed_at = []
+    invalid_results = []
+    for survey in surveys:
+        user_id = survey.get("user_id")
+        timestamp = survey.get("timestamp")
 
-    # Categorize phase
-    phase = classify_phase(responses)
+        # Parse and validate timestamp
+        try:
+            parsed_timestamp = datetime.strptime(timestamp, "%m%d%y%H%M%S")
+        except Exception:
+            metrics.error("Rejected survey: invalid timestamp format", user_id=user_id, timestamp=timestamp)
+            metrics.skip("Invalid timestamp format")
+            invalid_results.append({
+                "user_id": user_id,
+                "valid": False,
+                "reason": "Invalid timestamp format"
+            })
+            continue
+        valid_surveys.append(survey)
+        surveyed_at.append(parsed_timestamp)
+
+    # Categorize phases for the whole batch in one call
+    with metrics.timer("classify"):
+        if CYCLE_STATE_ENABLED and valid_surveys:
+            phases = classify_with_cycle_state(valid_surveys, surveyed_at)
+        else:
+            phases = classify_phases([survey.get("responses") for survey in valid_surveys])
 
     # Prepare data to send to rec_lambda
-    rec_lambda_payload = {
-        "user_id": user_id,
-        "timestamp": timestamp,
-        "responses": responses,
-        "time_elapsed": time_elapsed,
-        "phase": phase
-    }
+    rec_lambda_payloads = []
+    for survey, phase in zip(valid_surveys, phases):
+        rec_lambda_payloads.append({
+            "user_id": survey.get("user_id"),
+            "timestamp": survey.get("timestamp"),
+            "responses": survey.get("responses"),
+            "time_elapsed": survey.get("time_elapsed", 0),
+            "phase": phase
+        })
 
-    # Invoke recommendation Lambda
-    try:
-        response = lambda_client.invoke(
-            FunctionName='rec_lambda',  # Ensure this matches your rec_lambda function name
-            InvocationType='Event',  # Asynchronous invocation
-            Payload=json.dumps(rec_lambda_payload)
-        )
-        print(f"Invoked rec_lambda for user {user_id} with phase {phase}. Status code: {response['StatusCode']}")
-    except ClientError as e:
-        print(f"Error invoking rec_lambda for user {user_id}: {str(e)}")
+    # Invoke recommendation Lambda, one async invoke per batch
+    sent_count, failed_payloads = invoke_in_batches(lambda_client, REC_LAMBDA_FUNCTION_NAME, rec_lambda_payloads)
+    metrics.count("processed", sent_count)
+    if failed_payloads:
+        metrics.skip("Invoke failed", n=len(failed_payloads))
+    metrics.emit()
+    if failed_payloads:
+        # Fail the invocation so Lambda retries the event; rec_lambda drops the surveys it already has
+        raise ForwardingError(f"{len(failed_payloads)} of {len(rec_lambda_payloads)} surveys could not be "
+                              f"forwarded to {REC_LAMBDA_FUNCTION_NAME}")
+
+    if not is_batch:
+        if invalid_results:
+            return invalid_results[0]
+        return {
+            "statusCode": 200,
+            "body": json.dumps({
+                "user_id": rec_lambda_payloads[0]["user_id"],
+                "phase": rec_lambda_payloads[0]["phase"],
+                "status": "Processed and recommendation initiated."
+            })
+        }
 
     return {
         "statusCode": 200,
         "body": json.dumps({
-            "user_id": user_id,
-            "phase": phase,
-            "status": "Processed and recommendation initiated."
+            "processed": sent_count,
+            "skipped": len(invalid_results) + len(failed_payloads),
+            "status": "Batch processed and recommendations initiated."
         })
     }
 
-def classify_phase(res):
-    # (Phase classification logic - same as before)
-    bleeding = res.get("q1")
-    mucus = res.get("q2")
-    libido = res.get("q3")
-    mood = res.get("q4")
-    symptoms = res.get("q5", [])
-    energy = res.get("q6")
+# --- Phase Classification ---
+# The survey answers live in a tiny discrete domain, so the scoring rules below are
+# compiled once per container into a packed lookup table. Classifying a survey is
+# then a couple of dict lookups for the answers, a bitmask for the symptoms and a
+# single index into the table.
+
+# Order matters: ties are broken in favour of the phase listed first
+PHASES = ("Menstruation", "Luteal", "Ovulation", "Follicular")
+_M, _L, _O, _F = range(len(PHASES))
 
-    menstruation_symptoms = ["Cramps", "Lower back pain", "Headache or migraine"]
-    luteal_symptoms = ["Bloating", "Breast tenderness", "Breast fullness or swelling", "Digestive issues", "Acne or skin breakouts"]
-    ovulation_symptoms = ["Feeling hot or flushed", "Egg-white consistency mucus", "High libido"]
+MENSTRUATION_SYMPTOMS = ["Cramps", "Lower back pain", "Headache or migraine"]
+LUTEAL_SYMPTOMS = ["Bloating", "Breast tenderness", "Breast fullness or swelling", "Digestive issues", "Acne or skin breakouts"]
+OVULATION_SYMPTOMS = ["Feeling hot or flushed", "Egg-white consistency mucus", "High libido"]
 
-    score = {"Menstruation": 0, "Luteal": 0, "Ovulation": 0, "Follicular": 0}
+# Points added to the phase expected for the user's cycle day when cycle state is available
+CYCLE_PRIOR_WEIGHT = int(os.environ.get("CYCLE_PRIOR_WEIGHT", 2))
+
+# Answer domains (None = question not answered)
+Q1_VALUES = (None, 0, 1, 2, 3, 4)  # bleeding
+Q2_VALUES = (None, 0, 1, 2, 3, 4)  # mucus
+Q3_VALUES = (None, 1, 2, 3, 4, 5)  # libido
+Q6_VALUES = (None, 1, 2, 3, 4, 5)  # energy
+
+
+def _get_symptoms(res):
+    # verify sends q5 as {"symptoms": [...], "additional": "..."}; older payloads sent a plain list
+    q5 = res.get("q5")
+    if isinstance(q5, dict):
+        return q5.get("symptoms") or []
+    return q5 or []
+
+
+def _score_answers(bleeding, mucus, libido, energy):
+    score = [0, 0, 0, 0]
 
     if bleeding is not None:
         if bleeding >= 2:
-            score["Menstruation"] += 3
+            score[_M] += 3
         elif bleeding == 1:
-            score["Luteal"] += 1
+            score[_L] += 1
 
     if mucus is not None and libido is not None:
         if mucus == 4 or libido >= 4:
-            score["Ovulation"] += 2
+            score[_O] += 2
         elif mucus in [2, 3]:
-            score["Follicular"] += 1
+            score[_F] += 1
 
     if energy is not None:
         if energy in [1, 2]:
-            score["Menstruation"] += 1
-            score["Luteal"] += 1
+            score[_M] += 1
+            score[_L] += 1
         elif energy >= 4:
-            score["Ovulation"] += 1
-            score["Follicular"] += 1
-
-    for symptom in symptoms:
-        if symptom in menstruation_symptoms:
-            score["Menstruation"] += 1
-        elif symptom in luteal_symptoms:
-            score["Luteal"] += 1
-        elif symptom in ovulation_symptoms:
-            score["Ovulation"] += 1
-
-    assigned_phase = max(score, key=score.get)
-    return assigned_phase
\ No newline at end of file
+            score[_O] += 1
+            score[_F] += 1
+
+    return score
+
+
+def _best_phase(score):
+    # Same tie-breaking as max() over the original score dict: first phase wins
+    best = 0
+    for i in range(1, len(score)):
+        if score[i] > score[best]:
+            best = i
+    return best
+
+
+def classify_phase_rules(res, expected_phase=None):
+    # Reference implementation of the scoring rules, also used for inputs outside the table's domain
+    score = _score_answers(res.get("q1"), res.get("q2"), res.get("q3"), res.get("q6"))
+    if expected_phase in PHASES:
+        score[PHASES.index(expected_phase)] += CYCLE_PRIOR_WEIGHT
+
+    for symptom in _get_symptoms(res):
+        if symptom in MENSTRUATION_SYMPTOMS:
+            score[_M] += 1
+        elif symptom in LUTEAL_SYMPTOMS:
+            score[_L] += 1
+        elif symptom in OVULATION_SYMPTOMS:
+            score[_O] += 1
+
+    return PHASES[_best_phase(score)]
+
+
+def _compile_phase_engine(bonus=(0, 0, 0, 0)):
+    # bonus is added to every score, e.g. the prior for the phase expected on the user's cycle day
+    # Symptoms -> bitmask. Only the number of symptoms per phase matters for the score,
+    # so every mask is reduced to a "symptom class" (menstruation, luteal, ovulation counts).
+    m_max, l_max, o_max = len(MENSTRUATION_SYMPTOMS), len(LUTEAL_SYMPTOMS), len(OVULATION_SYMPTOMS)
+    groups = [(MENSTRUATION_SYMPTOMS, _M), (LUTEAL_SYMPTOMS, _L), (OVULATION_SYMPTOMS, _O)]
+
+    symptom_bits = {}
+    bit_phase = []
+    for symptoms, phase in groups:
+        for symptom in symptoms:
+            symptom_bits[symptom] = 1 << len(bit_phase)
+            bit_phase.append(phase)
+
+    n_classes = (m_max + 1) * (l_max + 1) * (o_max + 1)
+    symptom_class = bytearray(1 << len(bit_phase))
+    for mask in range(len(symptom_class)):
+        counts = [0, 0, 0]
+        for bit, phase in enumerate(bit_phase):
+            if mask >> bit & 1:
+                counts[phase] += 1
+        symptom_class[mask] = (counts[_M] * (l_max + 1) + counts[_L]) * (o_max + 1) + counts[_O]
+
+    class_scores = []
+    for m in range(m_max + 1):
+        for l in range(l_max + 1):
+            for o in range(o_max + 1):
+                class_scores.append((m, l, o))
+
+    # Numeric answers -> row index (row-major over q1, q2, q3, q6)
+    strides = (len(Q2_VALUES) * len(Q3_VALUES) * len(Q6_VALUES), len(Q3_VALUES) * len(Q6_VALUES), len(Q6_VALUES), 1)
+    indexes = []
+    for values, stride in zip((Q1_VALUES, Q2_VALUES, Q3_VALUES, Q6_VALUES), strides):
+        indexes.append({v: i * stride * n_classes for i, v in enumerate(values)})
+
+    # One byte per (answers, symptom class) holding the winning phase. Many answer
+    # combinations share a score, so each distinct score row is only computed once.
+    rows = {}
+    table = []
+    for q1 in Q1_VALUES:
+        for q2 in Q2_VALUES:
+            for q3 in Q3_VALUES:
+                for q6 in Q6_VALUES:
+                    base = tuple(_score_answers(q1, q2, q3, q6))
+                    if base not in rows:
+                        rows[base] = bytes(_best_phase((base[_M] + m + bonus[_M], base[_L] + l + bonus[_L],
+                                                        base[_O] + o + bonus[_O], base[_F] + bonus[_F]))
+                                           for m, l, o in class_scores)
+                    table.append(rows[base])
+
+    return b"".join(table), bytes(symptom_class), symptom_bits, indexes
+
+
+# Built once at cold start and reused by every invocation in this container
+_PHASE_TABLE, _SYMPTOM_CLASS, _SYMPTOM_BITS, (_Q1_INDEX, _Q2_INDEX, _Q3_INDEX, _Q6_INDEX) = _compile_phase_engine()
+
+
+def _table_index(res):
+    # Returns the table position for a response, or None if it falls outside the compiled domain
+    try:
+        mask = 0
+        for symptom in _get_symptoms(res):
+            if not isinstance(symptom, str):
+                return None
+            bit = _SYMPTOM_BITS.get(symptom, 0)
+            if mask & bit:
+                return None  # repeated symptom counts twice under the rules
+            mask |= bit
+        return (_Q1_INDEX[res.get("q1")] + _Q2_INDEX[res.get("q2")] + _Q3_INDEX[res.get("q3")]
+                + _Q6_INDEX[res.get("q6")] + _SYMPTOM_CLASS[mask])
+    except (KeyError, TypeError):
+        return None
+
+
+# Tables with the cycle prior applied, compiled on first use: one per expected phase
+_PRIOR_TABLES = {}
+
+
+def _phase_table(expected_phase):
+    if expected_phase not in PHASES:
+        return _PHASE_TABLE
+    if expected_phase not in _PRIOR_TABLES:
+        bonus = [0, 0, 0, 0]
+        bonus[PHASES.index(expected_phase)] = CYCLE_PRIOR_WEIGHT
+        _PRIOR_TABLES[expected_phase] = _compile_phase_engine(tuple(bonus))[0]
+    return _PRIOR_TABLES[expected_phase]
+
+
+def classify_phase(res, expected_phase=None):
+    idx = _table_index(res)
+    if idx is None:
+        return classify_phase_rules(res, expected_phase)
+    return PHASES[_phase_table(expected_phase)[idx]]
+
+
+def classify_phases(batch):
+    """Classify a list of normalized response dicts in one call, returning phases in order."""
+    table = _PHASE_TABLE
+    phases = []
+    for res in batch:
+        idx = _table_index(res)
+        phases.append(classify_phase_rules(res) if idx is None else PHASES[table[idx]])
+    return phases
+
+
+def classify_with_cycle_state(surveys, surveyed_at, store=None):
+    # Combines each survey's answers with the phase expected for the user's cycle day, then
+    # folds the survey into the user's state: one state read and one write per user per batch.
+    # Falls back to answers-only classification if the state table can't be read.
+    # store defaults to the DynamoDB table (see cycle_state.py for the store interface).
+    metrics = instrumentation.current()
+    store = store or cycle_state.DynamoDBStateStore(dynamodb)
+    try:
+        with metrics.timer("cycle_state_read"):
+            states = store.load([survey.get("user_id") for survey in surveys])
+    except ClientError as e:
+        metrics.error("Error reading cycle state. Classifying without it.", error=str(e))
+        metrics.count("cycle_state_errors")
+        return classify_phases([survey.get("responses") for survey in surveys])
+    except Exception as e:
+        metrics.error("Unexpected error reading cycle state. Classifying without it.", error=str(e))
+        metrics.count("cycle_state_errors")
+        return classify_phases([survey.get("responses") for survey in surveys])
+
+    # Oldest first, so several days for the same user in one batch build on each other
+    phases = [None] * len(surveys)
+    changed = {}
+    for i in sorted(range(len(surveys)), key=surveyed_at.__getitem__):
+        res = surveys[i].get("responses")
+        state = states[surveys[i].get("user_id")]
+        expected = cycle_state.expected_phase(state, surveyed_at[i].date())
+        phases[i] = classify_phase(res, expected)
+        if expected:
+            metrics.count("cycle_prior_used")
+        if cycle_state.record(state, surveyed_at[i], phases[i], res.get("q1")):
+            changed[state["user_id"]] = state
+
+    with metrics.timer("cycle_state_write"):
+        failed_users = store.save(changed.values())
+    metrics.count("cycle_state_failed", len(failed_users))
+    return phases
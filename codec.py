@@ -0,0 +1,88 @@
+# codec.py - shared JSON encoding for invoke payloads, S3 objects and DynamoDB items.
+# Every handler encodes through here, so a survey is serialized the same compact way at each
+# hop: no whitespace, UTF-8 bytes, Decimals (from DynamoDB) written as plain numbers.
+#
+# orjson is used when it is installed (CODEC_JSON_BACKEND=auto); it is several times faster
+# than the json module but is not part of the Lambda runtime, so it only helps where it is
+# packaged. CODEC_JSON_BACKEND=json forces the standard library.
+import json
+import os
+from decimal import Decimal
+
+JSON_BACKEND = os.environ.get("CODEC_JSON_BACKEND", "auto")
+
+orjson = None
+if JSON_BACKEND in ("auto", "orjson"):
+    try:
+        import orjson
+    except ImportError:
+        if JSON_BACKEND == "orjson":
+            raise
+
+
+def _default(obj):
+    # Decimals come back from DynamoDB; whole numbers stay ints
+    if isinstance(obj, Decimal):
+        return int(obj) if obj.is_finite() and obj == obj.to_integral_value() else float(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+# json.dumps builds a new encoder on every call that passes options; this one is built once
+_encoder = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False, default=_default)
+
+if orjson is not None:
+    BACKEND = "orjson"
+    _ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS
+
+    def dumps_bytes(obj):
+        return orjson.dumps(obj, default=_default, option=_ORJSON_OPTIONS)
+
+    def dumps(obj):
+        return orjson.dumps(obj, default=_default, option=_ORJSON_OPTIONS).decode("utf-8")
+
+    loads = orjson.loads
+else:
+    BACKEND = "json"
+
+    def dumps_bytes(obj):
+        return _encoder.encode(obj).encode("utf-8")
+
+    def dumps(obj):
+        return _encoder.encode(obj)
+
+    def loads(data):
+        # Accepts str or UTF-8 bytes, like orjson.loads
+        return json.loads(data)
+
+
+def to_dynamodb(value):
+    # Returns value with every float replaced by a Decimal, as the DynamoDB resource API requires.
+    # Containers without floats are returned as they are; only those on the path to a float are
+    # copied, and the input is never modified.
+    kind = type(value)
+    if kind is float:
+        return Decimal(repr(value))
+    if kind is dict:
+        converted = None
+        for key, item in value.items():
+            if type(item) in _CONVERTED_TYPES:
+                new = to_dynamodb(item)
+                if new is not item:
+                    if converted is None:
+                        converted = dict(value)
+                    converted[key] = new
+        return value if converted is None else converted
+    if kind is list:
+        converted = None
+        for index, item in enumerate(value):
+            if type(item) in _CONVERTED_TYPES:
+                new = to_dynamodb(item)
+                if new is not item:
+                    if converted is None:
+                        converted = list(value)
+                    converted[index] = new
+        return value if converted is None else converted
+    return value
+
+
+_CONVERTED_TYPES = frozenset((float, dict, list))
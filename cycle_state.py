@@ -0,0 +1,191 @@
+# cycle_state.py - compact per-user cycle state for time-series phase prediction.
+# Each user has one small DynamoDB item: the last period start, a running cycle-length
+# estimate and the most recent phases in a fixed-size ring buffer. Folding in a new survey
+# is O(1), so reading a user's state costs the same however many days of history they have.
+import os
+from datetime import date
+from decimal import Decimal
+from botocore.exceptions import ClientError
+import instrumentation
+import retries
+
+CYCLE_STATE_TABLE_NAME = os.environ.get("CYCLE_STATE_TABLE_NAME", "CyclicalBetaCycleState")
+# Number of recent phases kept per user
+HISTORY_LENGTH = int(os.environ.get("CYCLE_HISTORY_LENGTH", 14))
+
+DEFAULT_CYCLE_LENGTH = 28.0
+# Gaps between period starts outside this range (e.g. a missed month of surveys) don't update the estimate
+MIN_CYCLE_LENGTH = 21
+MAX_CYCLE_LENGTH = 45
+# Weight of the newest cycle in the running cycle-length estimate
+CYCLE_LENGTH_SMOOTHING = 0.3
+# Bleeding at or above this level (q1) marks a period day, as in the phase rules
+PERIOD_BLEEDING_LEVEL = 2
+# A period day at least this many days after the last period start begins a new cycle
+NEW_PERIOD_AFTER_DAYS = 15
+PERIOD_DAYS = 5
+LUTEAL_DAYS = 14
+
+# Phases are stored as one character per ring-buffer slot; "-" is an empty slot
+PHASE_CODES = {"Menstruation": "M", "Luteal": "L", "Ovulation": "O", "Follicular": "F"}
+_EMPTY_SLOT = "-"
+
+# DynamoDB limit: 100 keys per BatchGetItem
+BATCH_GET_SIZE = 100
+MAX_RETRIES = int(os.environ.get("CYCLE_STATE_MAX_RETRIES", 5))
+
+
+def new_state(user_id):
+    return {
+        "user_id": user_id,
+        "period_start": None,  # ISO date of the last observed period start
+        "cycle_length": DEFAULT_CYCLE_LENGTH,
+        "cycles": 0,  # cycles that contributed to cycle_length
+        "history": _EMPTY_SLOT * HISTORY_LENGTH,
+        "head": 0,  # next ring-buffer slot to write
+        "last_seen": None,  # ISO datetime of the newest survey folded in
+    }
+
+
+def _from_item(item):
+    # DynamoDB returns numbers as Decimal; a changed HISTORY_LENGTH restarts the ring buffer
+    state = new_state(item["user_id"])
+    state.update(item)
+    state["cycle_length"] = float(state["cycle_length"])
+    state["cycles"] = int(state["cycles"])
+    state["head"] = int(state["head"])
+    if len(state["history"]) != HISTORY_LENGTH:
+        state["history"], state["head"] = _EMPTY_SLOT * HISTORY_LENGTH, 0
+    return state
+
+
+def _to_item(state):
+    item = {key: value for key, value in state.items() if value is not None}
+    item["cycle_length"] = Decimal(str(round(state["cycle_length"], 2)))
+    return item
+
+
+def cycle_day(state, day):
+    # 1-based day of the user's current cycle on the given date, or None before a period has been seen
+    if not state.get("period_start"):
+        return None
+    days = (day - date.fromisoformat(state["period_start"])).days
+    if days < 0:
+        return None
+    return days % max(1, round(state["cycle_length"])) + 1
+
+
+def expected_phase(state, day):
+    # Phase expected on the given date from the cycle estimate, or None without one.
+    # Menstruation opens the cycle, ovulation falls LUTEAL_DAYS before the next period.
+    current_day = cycle_day(state, day)
+    if current_day is None:
+        return None
+    ovulation_day = round(state["cycle_length"]) - LUTEAL_DAYS
+    if current_day <= PERIOD_DAYS:
+        return "Menstruation"
+    if abs(current_day - ovulation_day) <= 1:
+        return "Ovulation"
+    if current_day < ovulation_day:
+        return "Follicular"
+    return "Luteal"
+
+
+def recent_phases(state):
+    # Ring buffer contents, oldest first
+    head = state["head"]
+    history = state["history"][head:] + state["history"][:head]
+    codes = {code: phase for phase, code in PHASE_CODES.items()}
+    return [codes[code] for code in history if code != _EMPTY_SLOT]
+
+
+def record(state, surveyed_at, phase, bleeding):
+    # Folds one classified survey into the state in O(1). Surveys no newer than the last one
+    # folded in are ignored, so replays and out-of-order deliveries can't rewind the state.
+    # Returns True if the state changed.
+    seen = surveyed_at.isoformat()
+    if state["last_seen"] and seen <= state["last_seen"]:
+        return False
+    state["last_seen"] = seen
+
+    day = surveyed_at.date()
+    if isinstance(bleeding, (int, float)) and bleeding >= PERIOD_BLEEDING_LEVEL:
+        if not state["period_start"]:
+            state["period_start"] = day.isoformat()
+        else:
+            gap = (day - date.fromisoformat(state["period_start"])).days
+            if gap >= NEW_PERIOD_AFTER_DAYS:
+                if MIN_CYCLE_LENGTH <= gap <= MAX_CYCLE_LENGTH:
+                    state["cycle_length"] += CYCLE_LENGTH_SMOOTHING * (gap - state["cycle_length"])
+                    state["cycles"] += 1
+                state["period_start"] = day.isoformat()
+
+    head = state["head"]
+    state["history"] = state["history"][:head] + PHASE_CODES.get(phase, _EMPTY_SLOT) + state["history"][head + 1:]
+    state["head"] = (head + 1) % HISTORY_LENGTH
+    return True
+
+
+def load_states(dynamodb, user_ids, table_name=None):
+    # Reads the state of every user with BatchGetItem. Returns {user_id: state}; users without
+    # an item get a fresh state. Raises ClientError if the table can't be read.
+    table_name = table_name or CYCLE_STATE_TABLE_NAME
+    metrics = instrumentation.current()
+    user_ids = list(dict.fromkeys(user_ids))
+    states = {user_id: new_state(user_id) for user_id in user_ids}
+    for start in range(0, len(user_ids), BATCH_GET_SIZE):
+        keys = [{"user_id": user_id} for user_id in user_ids[start:start + BATCH_GET_SIZE]]
+        attempt = 0
+        while keys:
+            response = dynamodb.batch_get_item(RequestItems={table_name: {"Keys": keys, "ConsistentRead": True}})
+            metrics.count("cycle_state_reads")
+            for item in response.get("Responses", {}).get(table_name, []):
+                states[item["user_id"]] = _from_item(item)
+            keys = response.get("UnprocessedKeys", {}).get(table_name, {}).get("Keys", [])
+            if keys:
+                if attempt >= MAX_RETRIES:
+                    raise ClientError({"Error": {"Code": "UnprocessedKeys", "Message": f"{len(keys)} cycle states not read"}},
+                                      "BatchGetItem")
+                retries.backoff(attempt)
+                attempt += 1
+    return states
+
+
+def save_states(dynamodb, states, table_name=None):
+    # Writes states with BatchWriteItem. Returns the user_ids whose state could not be written.
+    table_name = table_name or CYCLE_STATE_TABLE_NAME
+    failed = retries.batch_write(dynamodb, table_name, [{"PutRequest": {"Item": _to_item(state)}} for state in states],
+                                 "cycle state", MAX_RETRIES, count_as="cycle_state_writes")
+    return [request["PutRequest"]["Item"]["user_id"] for request in failed]
+
+
+# --- Stores ---
+# classify_with_cycle_state() in cat_lambda reads and writes states through a store: load(user_ids)
+# returns {user_id: state} and save(states) returns the user_ids that could not be written.
+class DynamoDBStateStore:
+    # States in CYCLE_STATE_TABLE_NAME; what cat_lambda and pipeline.py's aws backend use
+    def __init__(self, dynamodb, table_name=None):
+        self.dynamodb = dynamodb
+        self.table_name = table_name
+
+    def load(self, user_ids):
+        return load_states(self.dynamodb, user_ids, self.table_name)
+
+    def save(self, states):
+        return save_states(self.dynamodb, states, self.table_name)
+
+
+class MemoryStateStore:
+    # States in a dict, for pipeline.py's memory backend; copies go in and out so callers can't
+    # change a stored state without saving it
+    def __init__(self):
+        self.states = {}
+
+    def load(self, user_ids):
+        return {user_id: dict(self.states[user_id]) if user_id in self.states else new_state(user_id)
+                for user_id in dict.fromkeys(user_ids)}
+
+    def save(self, states):
+        for state in states:
+            self.states[state["user_id"]] = dict(state)
+        return []
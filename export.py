@@ -0,0 +1,258 @@
+# export.py - exports the CyclicalBetaSurvey table to a date-partitioned archive for analytics.
+# The table is read with a parallel segmented scan: TotalSegments workers each scan their own
+# slice of the table, page by page (LastEvaluatedKey), and stream rows into compressed files
+# under <destination>/date=YYYY-MM-DD/. Each worker holds at most --rows-per-file rows per
+# partition and twice that in total, so memory stays flat however large the table is.
+#
+# --incremental only exports items saved since the last successful run. rec_lambda stamps
+# every item with saved_at (epoch seconds); the checkpoint (<destination>/_checkpoint.json)
+# records the start of the last complete run. Items saved during a run can be exported twice,
+# so readers should dedupe on (user_id, timestamp). A scan filter still reads (and is billed
+# for) the whole table; the filter only saves transfer and writing.
+#
+# Usage:
+#   python export.py exports/                                   # JSONL (gzip), 8 segments
+#   python export.py s3://final-summer99d/exports/survey --segments 16 --incremental
+#   python export.py exports/ --format parquet                  # needs pyarrow
+import argparse
+import gzip
+import io
+import json
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from decimal import Decimal
+
+from botocore.exceptions import ClientError
+
+import aws_clients
+import codec
+
+TABLE_NAME = os.environ.get("EXPORT_TABLE_NAME", "CyclicalBetaSurvey")
+TOTAL_SEGMENTS = int(os.environ.get("EXPORT_TOTAL_SEGMENTS", 8))
+ROWS_PER_FILE = int(os.environ.get("EXPORT_ROWS_PER_FILE", 50000))
+# Items per scan page; DynamoDB also stops a page at 1 MB
+PAGE_SIZE = int(os.environ.get("EXPORT_PAGE_SIZE", 1000))
+# Subtracted from the run's start time in the checkpoint, to cover clock skew between the
+# Lambdas that stamp saved_at and the machine running the export
+CHECKPOINT_SKEW_SECONDS = 60
+CHECKPOINT_NAME = "_checkpoint.json"
+FORMATS = ("jsonl", "parquet")
+
+dynamodb = aws_clients.resource("dynamodb")
+s3 = aws_clients.client("s3")
+
+
+def partition_of(item):
+    # Survey date from the timestamp (MMDDYYHHMMSS) as YYYY-MM-DD, or "unknown"
+    try:
+        return datetime.strptime(item["timestamp"], "%m%d%y%H%M%S").strftime("%Y-%m-%d")
+    except (KeyError, TypeError, ValueError):
+        return "unknown"
+
+
+# --- Destinations ---
+class LocalDestination:
+    def __init__(self, root):
+        self.root = root
+
+    def write(self, key, data):
+        path = os.path.join(self.root, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written under a temporary name and renamed, so readers never see half a file
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+    def read(self, key):
+        try:
+            with open(os.path.join(self.root, key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+
+class S3Destination:
+    def __init__(self, url):
+        self.bucket, _, prefix = url[len("s3://"):].partition("/")
+        self.prefix = prefix.rstrip("/") + "/" if prefix else ""
+
+    def write(self, key, data):
+        s3.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=data)
+
+    def read(self, key):
+        try:
+            return s3.get_object(Bucket=self.bucket, Key=self.prefix + key)["Body"].read()
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return None
+            raise
+
+
+def destination_for(url):
+    return S3Destination(url) if url.startswith("s3://") else LocalDestination(url)
+
+
+# --- File formats ---
+def encode_jsonl(rows):
+    return gzip.compress(b"".join(codec.dumps_bytes(row) + b"\n" for row in rows))
+
+
+def encode_parquet(rows):
+    # One flat, fixed schema so every file of the archive can be read as one dataset;
+    # the nested responses are kept as a JSON string
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    schema = pa.schema([("user_id", pa.string()), ("timestamp", pa.string()), ("phase", pa.string()),
+                        ("time_elapsed", pa.float64()), ("valid", pa.bool_()),
+                        ("recommendations", pa.list_(pa.string())), ("responses", pa.string()),
+                        ("saved_at", pa.int64())])
+    columns = {
+        "user_id": [row.get("user_id") for row in rows],
+        "timestamp": [row.get("timestamp") for row in rows],
+        "phase": [row.get("phase") for row in rows],
+        "time_elapsed": [None if row.get("time_elapsed") is None else float(row["time_elapsed"]) for row in rows],
+        "valid": [row.get("valid") for row in rows],
+        "recommendations": [row.get("recommendations") for row in rows],
+        "responses": [codec.dumps(row["responses"]) if "responses" in row else None for row in rows],
+        "saved_at": [None if row.get("saved_at") is None else int(row["saved_at"]) for row in rows],
+    }
+    buffer = io.BytesIO()
+    pq.write_table(pa.Table.from_pydict(columns, schema=schema), buffer, compression="zstd")
+    return buffer.getvalue()
+
+
+ENCODERS = {"jsonl": (encode_jsonl, ".jsonl.gz"), "parquet": (encode_parquet, ".parquet")}
+
+
+# --- Export ---
+class SegmentWriter:
+    # Buffers one segment's rows per date partition and writes a file whenever a partition
+    # reaches rows_per_file, or the largest partition when the segment holds twice that
+    def __init__(self, destination, run_id, segment, file_format, rows_per_file):
+        self.destination = destination
+        self.prefix = f"part-{run_id}-{segment:04d}"
+        self.encode, self.suffix = ENCODERS[file_format]
+        self.rows_per_file = rows_per_file
+        self.partitions = {}
+        self.buffered = 0
+        self.files = 0
+        self.bytes = 0
+
+    def add(self, item):
+        rows = self.partitions.setdefault(partition_of(item), [])
+        rows.append(item)
+        self.buffered += 1
+        if len(rows) >= self.rows_per_file:
+            self.flush(partition_of(item))
+        elif self.buffered >= 2 * self.rows_per_file:
+            self.flush(max(self.partitions, key=lambda date: len(self.partitions[date])))
+
+    def flush(self, date):
+        rows = self.partitions.pop(date)
+        data = self.encode(rows)
+        self.destination.write(f"date={date}/{self.prefix}-{self.files:05d}{self.suffix}", data)
+        self.buffered -= len(rows)
+        self.files += 1
+        self.bytes += len(data)
+
+    def close(self):
+        for date in list(self.partitions):
+            self.flush(date)
+
+
+def export_segment(table_name, segment, total_segments, writer, since=None, page_size=PAGE_SIZE):
+    # Scans one segment to the end, following LastEvaluatedKey. Returns the segment's stats.
+    # Each worker makes its own Table; only the underlying client is shared between threads.
+    table = dynamodb.Table(table_name)
+    request = {"Segment": segment, "TotalSegments": total_segments, "Limit": page_size}
+    if since is not None:
+        request["FilterExpression"] = "saved_at > :since"
+        request["ExpressionAttributeValues"] = {":since": Decimal(int(since))}
+    stats = {"segment": segment, "pages": 0, "scanned": 0, "items": 0}
+    while True:
+        response = table.scan(**request)
+        stats["pages"] += 1
+        stats["scanned"] += response.get("ScannedCount", response.get("Count", 0))
+        for item in response.get("Items", []):
+            writer.add(item)
+            stats["items"] += 1
+        if "LastEvaluatedKey" not in response:
+            break
+        request["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+    writer.close()
+    stats.update(files=writer.files, bytes=writer.bytes)
+    return stats
+
+
+def read_checkpoint(destination):
+    data = destination.read(CHECKPOINT_NAME)
+    return json.loads(data) if data else None
+
+
+def run_export(destination_url, table_name=None, total_segments=None, file_format="jsonl",
+               rows_per_file=None, incremental=False, page_size=PAGE_SIZE):
+    # Exports the table with total_segments parallel workers. The checkpoint is only moved
+    # forward once every segment has finished, so a failed run is simply run again.
+    table_name = table_name or TABLE_NAME
+    total_segments = total_segments or TOTAL_SEGMENTS
+    rows_per_file = rows_per_file or ROWS_PER_FILE
+    if file_format not in ENCODERS:
+        raise ValueError(f"Unknown export format {file_format!r}; expected one of {FORMATS}")
+    if file_format == "parquet":
+        import pyarrow  # noqa: F401 - fail before scanning, not after the first partition fills
+
+    destination = destination_for(destination_url)
+    checkpoint = read_checkpoint(destination) if incremental else None
+    since = checkpoint["exported_through"] if checkpoint else None
+    run_id = f"{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    started = time.time()
+    clock = time.perf_counter()
+
+    def work(segment):
+        writer = SegmentWriter(destination, run_id, segment, file_format, rows_per_file)
+        return export_segment(table_name, segment, total_segments, writer, since, page_size)
+
+    with ThreadPoolExecutor(max_workers=total_segments) as pool:
+        segments = list(pool.map(work, range(total_segments)))
+
+    elapsed = max(time.perf_counter() - clock, 1e-9)
+    summary = {
+        "run_id": run_id,
+        "table": table_name,
+        "since": since,
+        "exported_through": int(started) - CHECKPOINT_SKEW_SECONDS,
+        "segments": total_segments,
+        "items": sum(stats["items"] for stats in segments),
+        "scanned": sum(stats["scanned"] for stats in segments),
+        "pages": sum(stats["pages"] for stats in segments),
+        "files": sum(stats["files"] for stats in segments),
+        "bytes": sum(stats["bytes"] for stats in segments),
+        "seconds": round(elapsed, 3),
+    }
+    summary["items_per_second"] = round(summary["items"] / elapsed, 1)
+    destination.write(CHECKPOINT_NAME, json.dumps(
+        {key: summary[key] for key in ("run_id", "table", "exported_through", "items")}, indent=2).encode("utf-8"))
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the survey table to a date-partitioned archive.")
+    parser.add_argument("destination", help="Local directory or s3://bucket/prefix")
+    parser.add_argument("--table", default=TABLE_NAME)
+    parser.add_argument("--segments", type=int, default=TOTAL_SEGMENTS, help="Parallel scan segments (TotalSegments)")
+    parser.add_argument("--format", choices=FORMATS, default="jsonl")
+    parser.add_argument("--rows-per-file", type=int, default=ROWS_PER_FILE)
+    parser.add_argument("--page-size", type=int, default=PAGE_SIZE)
+    parser.add_argument("--incremental", action="store_true", help="Only export items saved since the last checkpoint")
+    args = parser.parse_args()
+
+    summary = run_export(args.destination, args.table, args.segments, args.format, args.rows_per_file,
+                         args.incremental, args.page_size)
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
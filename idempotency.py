@@ -0,0 +1,262 @@
+# idempotency.py - duplicate suppression for the at-least-once parts of the pipeline.
+# S3 notifications, SQS messages and async invokes can all be delivered more than once, so work
+# is claimed under a key before it is done: an S3 object by bucket, key and ETag, a survey by
+# (user_id, timestamp) per stage. A claim is a conditional put into a DynamoDB ledger, which is
+# the source of truth. It starts in progress with a lease, and is marked done once the work has
+# succeeded or dropped if the work failed; an in-progress claim whose lease ran out belongs to an
+# invocation that died, and is taken over by the next delivery. An LRU of the keys this
+# container has completed answers repeats in warm containers without a round trip.
+# Ledger items expire through the table's TTL attribute (expires_at).
+#
+# If the ledger can't be reached the work is treated as new: a duplicate email is better than
+# a lost survey.
+import os
+import time
+from collections import OrderedDict
+from botocore.exceptions import ClientError
+import instrumentation
+import aws_clients
+import retries
+
+IDEMPOTENCY_ENABLED = os.environ.get("IDEMPOTENCY_ENABLED", "true").lower() == "true"
+IDEMPOTENCY_TABLE_NAME = os.environ.get("IDEMPOTENCY_TABLE_NAME", "CyclicalBetaIdempotency")
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get("IDEMPOTENCY_TTL_SECONDS", 7 * 24 * 3600))
+# A claim still in progress after this long belongs to an invocation that died (e.g. timed out),
+# and may be taken over. It must run out before Lambda's async retries of that invocation arrive
+# (about 1 and 2 minutes after the failure), so it is the function timeout plus a margin.
+# Lambda doesn't expose the configured timeout to the function; the notebook sets
+# FUNCTION_TIMEOUT_SECONDS to each function's timeout.
+FUNCTION_TIMEOUT_SECONDS = int(os.environ.get("FUNCTION_TIMEOUT_SECONDS", 30))
+LEASE_MARGIN_SECONDS = 15
+LEASE_SECONDS = int(os.environ.get("IDEMPOTENCY_LEASE_SECONDS", FUNCTION_TIMEOUT_SECONDS + LEASE_MARGIN_SECONDS))
+LRU_SIZE = int(os.environ.get("IDEMPOTENCY_LRU_SIZE", 100000))
+# A key can be claimed if it is unclaimed or its lease ran out; a done claim has no lease_until,
+# so the condition never holds for it
+CLAIM_CONDITION = "attribute_not_exists(pk) OR lease_until < :now"
+
+# DynamoDB limit: 100 items per TransactWriteItems
+TRANSACT_SIZE = 100
+MAX_RETRIES = 5
+
+dynamodb_client = aws_clients.client("dynamodb")
+
+
+class LRUSet:
+    # Bounded set that forgets the least recently used key first
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._keys = OrderedDict()
+
+    def __contains__(self, key):
+        if key in self._keys:
+            self._keys.move_to_end(key)
+            return True
+        return False
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, key):
+        self._keys[key] = None
+        self._keys.move_to_end(key)
+        if len(self._keys) > self.maxsize:
+            self._keys.popitem(last=False)
+
+    def discard(self, key):
+        self._keys.pop(key, None)
+
+
+# Keys completed in this container; survives across warm invocations. Keys that are only claimed
+# aren't kept, since a claim that fails is released and the work must be done again.
+_seen = LRUSet(LRU_SIZE)
+
+
+def survey_key(stage, user_id, timestamp):
+    return f"{stage}#{user_id}#{timestamp}"
+
+
+def object_key(bucket, key, etag):
+    return f"object#{bucket}/{key}#{(etag or '').strip(chr(34))}"
+
+
+def _expires_at(now):
+    return str(int(now) + IDEMPOTENCY_TTL_SECONDS)
+
+
+def _claim_item(pk, now):
+    # A new in-progress claim, to be written under CLAIM_CONDITION
+    return {"pk": {"S": pk}, "status": {"S": "in_progress"},
+            "lease_until": {"N": str(now + LEASE_SECONDS)}, "expires_at": {"N": _expires_at(now)}}
+
+
+# --- S3 objects ---
+def claim_object(bucket, key, etag):
+    # Returns True if this invocation should process the object. The claim holds a lease until
+    # complete_object() or release_object() is called.
+    if not IDEMPOTENCY_ENABLED:
+        return True
+    metrics = instrumentation.current()
+    pk = object_key(bucket, key, etag)
+    if pk in _seen:
+        metrics.count("duplicate_objects")
+        return False
+
+    now = int(time.time())
+    try:
+        dynamodb_client.put_item(
+            TableName=IDEMPOTENCY_TABLE_NAME,
+            Item=_claim_item(pk, now),
+            ConditionExpression=CLAIM_CONDITION,
+            ExpressionAttributeValues={":now": {"N": str(now)}}
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            metrics.count("duplicate_objects")
+            return False
+        metrics.error("Idempotency ledger unavailable. Processing object anyway.", object=f"s3://{bucket}/{key}", error=str(e))
+        metrics.count("idempotency_errors")
+        return True
+    except Exception as e:
+        metrics.error("Unexpected error claiming object. Processing it anyway.", object=f"s3://{bucket}/{key}", error=str(e))
+        metrics.count("idempotency_errors")
+        return True
+    return True
+
+
+def complete_object(bucket, key, etag):
+    # Marks a claimed object as done; a done claim has no lease, so it is never taken over
+    if not IDEMPOTENCY_ENABLED:
+        return
+    pk = object_key(bucket, key, etag)
+    _seen.add(pk)
+    try:
+        dynamodb_client.update_item(
+            TableName=IDEMPOTENCY_TABLE_NAME,
+            Key={"pk": {"S": pk}},
+            UpdateExpression="SET #status = :done REMOVE lease_until",
+            ExpressionAttributeNames={"#status": "status"},
+            ExpressionAttributeValues={":done": {"S": "done"}}
+        )
+    except Exception as e:
+        # The lease still protects the object until it runs out
+        instrumentation.current().error("Error completing idempotency claim", object=f"s3://{bucket}/{key}", error=str(e))
+        instrumentation.current().count("idempotency_errors")
+
+
+def release_object(bucket, key, etag):
+    # Drops the claim of an object that failed, so a redelivery processes it again
+    if not IDEMPOTENCY_ENABLED:
+        return
+    pk = object_key(bucket, key, etag)
+    _seen.discard(pk)
+    try:
+        dynamodb_client.delete_item(TableName=IDEMPOTENCY_TABLE_NAME, Key={"pk": {"S": pk}})
+    except Exception as e:
+        instrumentation.current().error("Error releasing idempotency claim", object=f"s3://{bucket}/{key}", error=str(e))
+        instrumentation.current().count("idempotency_errors")
+
+
+# --- Surveys ---
+def _claim_keys(keys, now):
+    # Claims keys with TransactWriteItems. A transaction fails as a whole if any key is already
+    # claimed; those keys are read from the cancellation reasons and the rest are retried.
+    # Returns the keys that were already claimed.
+    metrics = instrumentation.current()
+    claimed_before = set()
+    attempt = 0
+    while keys:
+        try:
+            dynamodb_client.transact_write_items(TransactItems=[{
+                "Put": {
+                    "TableName": IDEMPOTENCY_TABLE_NAME,
+                    "Item": _claim_item(key, now),
+                    "ConditionExpression": CLAIM_CONDITION,
+                    "ExpressionAttributeValues": {":now": {"N": str(now)}}
+                }
+            } for key in keys])
+            metrics.count("idempotency_writes")
+            return claimed_before
+        except ClientError as e:
+            metrics.count("idempotency_writes")
+            reasons = e.response.get("CancellationReasons", [])
+            if e.response["Error"]["Code"] != "TransactionCanceledException" or attempt >= MAX_RETRIES:
+                metrics.error("Idempotency ledger unavailable. Treating surveys as new.", surveys=len(keys), error=str(e))
+                metrics.count("idempotency_errors")
+                return claimed_before
+        except Exception as e:
+            metrics.error("Unexpected error claiming surveys. Treating them as new.", surveys=len(keys), error=str(e))
+            metrics.count("idempotency_errors")
+            return claimed_before
+        taken = {key for key, reason in zip(keys, reasons) if reason.get("Code") == "ConditionalCheckFailed"}
+        claimed_before |= taken
+        keys = [key for key in keys if key not in taken]
+        if not taken:
+            # Cancelled for conflicts or throttling only
+            retries.backoff(attempt)
+            attempt += 1
+    return claimed_before
+
+
+def claim_surveys(stage, items):
+    # Claims each item's (user_id, timestamp) for a stage. Returns the items not claimed before,
+    # in order; repeats inside items are dropped too. Duplicates are counted in duplicate_surveys.
+    # The claims hold a lease until complete_surveys() or release_surveys() is called.
+    if not IDEMPOTENCY_ENABLED:
+        return list(items)
+    metrics = instrumentation.current()
+    fresh = OrderedDict()
+    duplicates = 0
+    for item in items:
+        pk = survey_key(stage, item.get("user_id"), item.get("timestamp"))
+        if pk in fresh or pk in _seen:
+            duplicates += 1
+        else:
+            fresh[pk] = item
+
+    keys = list(fresh)
+    now = int(time.time())
+    claimed_before = set()
+    for start in range(0, len(keys), TRANSACT_SIZE):
+        claimed_before |= _claim_keys(keys[start:start + TRANSACT_SIZE], now)
+
+    duplicates += len(claimed_before)
+    if duplicates:
+        metrics.count("duplicate_surveys", duplicates)
+        metrics.log("Suppressed duplicate surveys", stage=stage, duplicates=duplicates, received=duplicates + len(keys) - len(claimed_before))
+    return [item for pk, item in fresh.items() if pk not in claimed_before]
+
+
+def _survey_keys(stage, items):
+    return list(dict.fromkeys(survey_key(stage, item.get("user_id"), item.get("timestamp")) for item in items))
+
+
+def complete_surveys(stage, items):
+    # Marks the claims of surveys whose work succeeded as done; a done claim has no lease, so it is
+    # never taken over. Items only need user_id and timestamp.
+    if not IDEMPOTENCY_ENABLED or not items:
+        return
+    keys = _survey_keys(stage, items)
+    for pk in keys:
+        _seen.add(pk)
+    expires_at = _expires_at(time.time())
+    uncompleted = retries.batch_write(dynamodb_client, IDEMPOTENCY_TABLE_NAME,
+                                      [{"PutRequest": {"Item": {"pk": {"S": pk}, "status": {"S": "done"},
+                                                                "expires_at": {"N": expires_at}}}} for pk in keys],
+                                      "idempotency claim completions", MAX_RETRIES)
+    if uncompleted:
+        # Their leases still protect them until they run out
+        instrumentation.current().count("idempotency_errors")
+
+
+def release_surveys(stage, items):
+    # Drops the claims of surveys whose work failed, so a retry does it again
+    if not IDEMPOTENCY_ENABLED or not items:
+        return
+    keys = _survey_keys(stage, items)
+    for pk in keys:
+        _seen.discard(pk)
+    unreleased = retries.batch_write(dynamodb_client, IDEMPOTENCY_TABLE_NAME,
+                                     [{"DeleteRequest": {"Key": {"pk": {"S": pk}}}} for pk in keys],
+                                     "idempotency claim releases", MAX_RETRIES)
+    if unreleased:
+        instrumentation.current().count("idempotency_errors")
@@ -0,0 +1,159 @@
+# instrumentation.py - shared metrics, tracing and structured logging for the pipeline handlers.
+# Each invocation gets a Metrics object (stage timers, counters, size histograms) that is
+# flushed as one CloudWatch Embedded Metric Format (EMF) JSON line. A trace ID starts in
+# verify and is carried through every invoke payload, so one file can be followed end to end.
+#
+# Per-record logs go through log_record() and are sampled with LOG_SAMPLE_RATE
+# (1.0 = log every record, 0 = off). Errors and per-invocation summaries are always logged.
+import json
+import os
+import random
+import time
+import uuid
+from collections import Counter, defaultdict
+
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "CyclicalBetaPipeline")
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", 1.0))
+
+TRACE_KEY = "trace_id"
+
+
+def new_trace_id():
+    return uuid.uuid4().hex
+
+
+def trace_id_from(event):
+    # Trace ID carried by a pipeline payload (batch or single survey), or None
+    if isinstance(event, dict):
+        return event.get(TRACE_KEY)
+    return None
+
+
+def _size_bucket(nbytes):
+    # Power-of-two buckets keep the histogram small: 0, 1, 2, 4, ... bytes
+    return 0 if nbytes <= 0 else 1 << (int(nbytes) - 1).bit_length()
+
+
+class _Timer:
+    # A plain class rather than @contextmanager: timers wrap per-record work, so they must be cheap
+    __slots__ = ("timings", "stage", "started")
+
+    def __init__(self, timings, stage):
+        self.timings = timings
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timings[self.stage] += (time.perf_counter() - self.started) * 1000
+        return False
+
+
+class Metrics:
+    def __init__(self, function_name, trace_id=None):
+        self.function_name = function_name
+        self.trace_id = trace_id or new_trace_id()
+        self.started = time.perf_counter()
+        self.timings = defaultdict(float)  # stage -> milliseconds
+        self.counters = Counter()
+        self.reasons = Counter()
+        self.sizes = defaultdict(Counter)  # name -> {bucket: count}
+        self.size_totals = Counter()
+        self.size_max = Counter()
+        self.gauges = {}  # name -> (value, unit)
+
+    def timer(self, stage):
+        # with metrics.timer("s3_get"): ...  adds the block's duration to the stage
+        return _Timer(self.timings, stage)
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def skip(self, *reasons, n=1):
+        # Counts n skipped records, broken down by reason (a record may fail for several reasons)
+        self.counters["skipped"] += n
+        for reason in reasons:
+            self.reasons[reason] += n
+
+    def gauge(self, name, value, unit="Count"):
+        # A point-in-time value such as a queue depth; the last one set is emitted
+        self.gauges[name] = (value, unit)
+
+    def observe_size(self, name, nbytes):
+        self.sizes[name][_size_bucket(nbytes)] += 1
+        self.size_totals[name] += nbytes
+        self.size_max[name] = max(self.size_max[name], nbytes)
+
+    def log(self, message, **fields):
+        print(json.dumps({"level": "INFO", "function": self.function_name, TRACE_KEY: self.trace_id,
+                          "message": message, **fields}, default=str))
+
+    def error(self, message, **fields):
+        print(json.dumps({"level": "ERROR", "function": self.function_name, TRACE_KEY: self.trace_id,
+                          "message": message, **fields}, default=str))
+
+    def log_record(self, message, **fields):
+        # Per-record logging, sampled so it can be turned down in production
+        if LOG_SAMPLE_RATE >= 1 or (LOG_SAMPLE_RATE > 0 and random.random() < LOG_SAMPLE_RATE):
+            self.log(message, **fields)
+
+    def to_emf(self):
+        self.timings["total"] = (time.perf_counter() - self.started) * 1000
+        definitions = []
+        document = {"FunctionName": self.function_name, TRACE_KEY: self.trace_id}
+
+        for stage, ms in self.timings.items():
+            name = f"{stage}_ms"
+            definitions.append({"Name": name, "Unit": "Milliseconds"})
+            document[name] = round(ms, 3)
+        for name, value in self.counters.items():
+            definitions.append({"Name": name, "Unit": "Count"})
+            document[name] = value
+        for name, (value, unit) in self.gauges.items():
+            definitions.append({"Name": name, "Unit": unit})
+            document[name] = value
+        for name, buckets in self.sizes.items():
+            # Totals and maxima are metrics; the power-of-two histogram rides along as a log field
+            for suffix, value in (("total", self.size_totals[name]), ("max", self.size_max[name])):
+                definitions.append({"Name": f"{name}_{suffix}", "Unit": "Bytes"})
+                document[f"{name}_{suffix}"] = value
+            document[f"{name}_histogram"] = {str(bucket): count for bucket, count in sorted(buckets.items())}
+        if self.reasons:
+            document["skip_reasons"] = dict(self.reasons)
+
+        document["_aws"] = {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": METRICS_NAMESPACE,
+                "Dimensions": [["FunctionName"]],
+                "Metrics": definitions,
+            }],
+        }
+        return document
+
+    def emit(self):
+        document = self.to_emf()
+        print(json.dumps(document, default=str))
+        return document
+
+
+# The Metrics of the invocation currently running in this container
+_current = None
+
+
+def start(function_name, event=None):
+    # Begins metrics for a handler invocation, continuing the event's trace if it has one
+    global _current
+    _current = Metrics(function_name, trace_id_from(event))
+    _current.count("invocations")
+    return _current
+
+
+def current():
+    # Metrics for the running invocation; helpers called outside a handler get a throwaway one
+    global _current
+    if _current is None:
+        _current = Metrics(os.environ.get("AWS_LAMBDA_FUNCTION_NAME", "local"))
+    return _current
@@ -0,0 +1,237 @@
+# invoker.py - parallel, throttle-aware async invokes between the pipeline Lambdas.
+# InvokeExecutor sends batch payloads from a bounded thread pool. How many invokes of a function
+# are in flight at once is set by an AIMD limiter: it grows by one per round of fast successful
+# calls and halves on a throttle (TooManyRequestsException), or shrinks by a tenth when calls get
+# slower than INVOKE_LATENCY_TARGET_MS. Limiters are kept per target function for the life of the
+# container, so warm invocations start from what the last one learned.
+#
+# Throttled and transient failures are retried with full-jitter backoff. A batch that still can't
+# be delivered is spilled to the overflow SQS queue (INVOKE_OVERFLOW_QUEUE_NAME) and replayed later
+# by overflow_lambda; only if that fails too is it handed back to the caller as failed.
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import BotoCoreError, ClientError
+from batching import iter_batch_payloads
+import instrumentation
+import aws_clients
+import retries
+
+INVOKE_MAX_CONCURRENCY = int(os.environ.get("INVOKE_MAX_CONCURRENCY", 16))
+INVOKE_INITIAL_CONCURRENCY = int(os.environ.get("INVOKE_INITIAL_CONCURRENCY", 4))
+INVOKE_MIN_CONCURRENCY = 1
+# Async invokes normally return in tens of milliseconds; slower means the service is struggling
+INVOKE_LATENCY_TARGET_MS = float(os.environ.get("INVOKE_LATENCY_TARGET_MS", 250))
+THROTTLE_DECREASE = 0.5
+LATENCY_DECREASE = 0.9
+INVOKE_MAX_RETRIES = int(os.environ.get("INVOKE_MAX_RETRIES", 6))
+BACKOFF_BASE_SECONDS = 0.1
+BACKOFF_MAX_SECONDS = 5.0
+# Empty disables spilling
+INVOKE_OVERFLOW_QUEUE_NAME = os.environ.get("INVOKE_OVERFLOW_QUEUE_NAME", "BetaInvokeOverflowsummer99d")
+FUNCTION_NAME_ATTRIBUTE = "function_name"
+
+THROTTLE_CODES = ("TooManyRequestsException", "ThrottlingException", "Throttling", "RequestLimitExceeded")
+# Worth retrying besides throttles; anything else (a missing function, a denied role, an oversized
+# payload) fails the same way every time
+TRANSIENT_CODES = ("ServiceException", "ResourceNotReadyException", "EC2ThrottledException",
+                   "ENILimitReachedException", "InternalFailure", "ServiceUnavailable")
+
+lambda_client = aws_clients.client("lambda")
+sqs_client = aws_clients.client("sqs")
+
+
+class AIMDLimiter:
+    # Concurrency limit with additive increase and multiplicative decrease. acquire() blocks while
+    # the limit is reached; release() feeds back how the call went. Only calls that started after
+    # the last decrease can cause another, so one burst of throttles halves the limit once.
+    def __init__(self, initial, minimum, maximum):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self.decreased_at = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        # Returns the start time to pass to release()
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+            return time.monotonic()
+
+    def release(self, started, outcome, latency_ms=0.0):
+        # outcome: "ok", "throttled", or anything else for a failure that says nothing about load
+        with self._condition:
+            self.in_flight -= 1
+            if outcome == "throttled":
+                self._decrease(started, THROTTLE_DECREASE)
+            elif outcome == "ok":
+                if latency_ms > INVOKE_LATENCY_TARGET_MS:
+                    self._decrease(started, LATENCY_DECREASE)
+                else:
+                    self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+    def _decrease(self, started, factor):
+        if started >= self.decreased_at:
+            self.limit = max(self.minimum, self.limit * factor)
+            self.decreased_at = time.monotonic()
+
+
+# Target function name -> AIMDLimiter, shared by every invocation in this container
+_limiters = {}
+_limiters_lock = threading.Lock()
+_overflow_queue_url = None
+
+
+def limiter_for(function_name):
+    with _limiters_lock:
+        if function_name not in _limiters:
+            _limiters[function_name] = AIMDLimiter(min(INVOKE_INITIAL_CONCURRENCY, INVOKE_MAX_CONCURRENCY),
+                                                   INVOKE_MIN_CONCURRENCY, INVOKE_MAX_CONCURRENCY)
+        return _limiters[function_name]
+
+
+def reset():
+    # Forgets the learned limits (and the overflow queue URL)
+    global _overflow_queue_url
+    with _limiters_lock:
+        _limiters.clear()
+    _overflow_queue_url = None
+
+
+def _overflow_url():
+    global _overflow_queue_url
+    if _overflow_queue_url is None:
+        _overflow_queue_url = sqs_client.get_queue_url(QueueName=INVOKE_OVERFLOW_QUEUE_NAME)["QueueUrl"]
+    return _overflow_queue_url
+
+
+def spill(function_name, payload):
+    # Puts an undeliverable payload on the overflow queue. Returns None, or the error if it couldn't.
+    if not INVOKE_OVERFLOW_QUEUE_NAME:
+        return "no overflow queue configured"
+    try:
+        sqs_client.send_message(
+            QueueUrl=_overflow_url(),
+            MessageBody=payload.decode("utf-8") if isinstance(payload, bytes) else payload,
+            MessageAttributes={FUNCTION_NAME_ATTRIBUTE: {"DataType": "String", "StringValue": function_name}}
+        )
+    except (ClientError, BotoCoreError) as e:
+        return str(e)
+    except Exception as e:
+        return f"unexpected error: {e}"
+    return None
+
+
+class InvokeExecutor:
+    # Asynchronously invokes function_name with batch payloads from a bounded thread pool.
+    # submit() packs items into batch events and returns once they are queued; at most twice the
+    # pool size are held waiting, so a long stream of submits keeps memory flat. close() waits for
+    # every invoke and returns (sent_count, failed_items): spilled items count as sent, since
+    # overflow_lambda delivers them.
+    def __init__(self, function_name, client=None, spill_failures=True):
+        self.function_name = function_name
+        self.client = client or lambda_client
+        self.spill_failures = spill_failures
+        self.limiter = limiter_for(function_name)
+        self.metrics = instrumentation.current()
+        self._pool = ThreadPoolExecutor(max_workers=INVOKE_MAX_CONCURRENCY)
+        self._waiting = threading.BoundedSemaphore(2 * INVOKE_MAX_CONCURRENCY)
+        self._futures = []
+        self._started = time.perf_counter()
+
+    def submit(self, items, batch_size=None, max_bytes=None):
+        # Packs items into batch events carrying the current trace ID and queues them
+        extra = {instrumentation.TRACE_KEY: self.metrics.trace_id}
+        for chunk, payload in iter_batch_payloads(items, batch_size, max_bytes, extra):
+            self.submit_payload(payload, chunk)
+
+    def submit_payload(self, payload, items):
+        # Queues one ready-made payload; items are what close() reports as sent or failed for it
+        self.metrics.observe_size("invoke_payload_bytes", len(payload))
+        self._waiting.acquire()
+        future = self._pool.submit(self._deliver, payload, items)
+        future.add_done_callback(lambda _: self._waiting.release())
+        self._futures.append(future)
+
+    def _invoke(self, payload):
+        # One invoke under the limiter. Returns (outcome, error).
+        started = self.limiter.acquire()
+        outcome, error = "error", None
+        try:
+            self.client.invoke(FunctionName=self.function_name, InvocationType='Event', Payload=payload)
+            outcome = "ok"
+        except ClientError as e:
+            code = e.response["Error"]["Code"]
+            outcome = "throttled" if code in THROTTLE_CODES else ("transient" if code in TRANSIENT_CODES else "error")
+            error = str(e)
+        except BotoCoreError as e:
+            # Connection and timeout errors
+            outcome, error = "transient", str(e)
+        except Exception as e:
+            error = f"unexpected error: {e}"
+        finally:
+            self.limiter.release(started, outcome, (time.monotonic() - started) * 1000)
+        return outcome, error
+
+    def _deliver(self, payload, items):
+        # Runs in a pool thread; the calling thread does all logging and counting in close().
+        # Only a failed batch keeps its items, so finished batches don't hold memory until close().
+        result = {"count": len(items), "throttled": 0, "retries": 0, "status": "sent", "error": None}
+        attempt = 0
+        while True:
+            outcome, error = self._invoke(payload)
+            if outcome == "ok":
+                return result
+            result["error"] = error
+            if outcome == "throttled":
+                result["throttled"] += 1
+            if outcome == "error" or attempt >= INVOKE_MAX_RETRIES:
+                break
+            result["retries"] += 1
+            retries.backoff(attempt, BACKOFF_BASE_SECONDS, BACKOFF_MAX_SECONDS)
+            attempt += 1
+        result["status"] = "failed"
+        result["items"] = items
+        if self.spill_failures:
+            spill_error = spill(self.function_name, payload)
+            if spill_error is None:
+                result["status"] = "spilled"
+                del result["items"]
+            else:
+                result["error"] = f"{error}; overflow queue: {spill_error}"
+        return result
+
+    def close(self):
+        metrics = self.metrics
+        sent_count = 0
+        failed_items = []
+        with metrics.timer("invoke"):
+            results = [future.result() for future in self._futures]
+        for result in results:
+            metrics.count("invoke_throttled", result["throttled"])
+            metrics.count("invoke_retries", result["retries"])
+            if result["status"] == "failed":
+                metrics.error(f"Error invoking {self.function_name}", surveys=result["count"], error=result["error"])
+                metrics.count("invoke_errors")
+                failed_items.extend(result["items"])
+                continue
+            sent_count += result["count"]
+            if result["status"] == "spilled":
+                metrics.error(f"Invoking {self.function_name} failed; spilled to the overflow queue",
+                              surveys=result["count"], error=result["error"])
+                metrics.count("invoke_spilled", result["count"])
+            else:
+                metrics.count("invokes")
+        self._pool.shutdown()
+        if results:
+            metrics.gauge("invoke_concurrency_limit", round(self.limiter.limit, 2))
+            metrics.log(f"Invoked {self.function_name}", batches=len(results), surveys=sent_count + len(failed_items),
+                        failed=len(failed_items), concurrency_limit=round(self.limiter.limit, 2),
+                        seconds=round(time.perf_counter() - self._started, 3))
+        self._futures = []
+        return sent_count, failed_items
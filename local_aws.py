@@ -0,0 +1,587 @@
+# local_aws.py - minimal in-memory stand-ins for the AWS clients used by the pipeline.
+# They implement just enough of the boto3 call shapes for local runs and benchmarks,
+# and count requests and bytes so different code paths can be compared.
+import bisect
+import hashlib
+import io
+import itertools
+import json
+import math
+import threading
+import time
+import uuid
+import zlib
+from collections import Counter, defaultdict, deque
+from botocore.exceptions import ClientError
+
+
+def client_error(code, operation, message=""):
+    return ClientError({"Error": {"Code": code, "Message": message}}, operation)
+
+
+class StreamingBody:
+    # Mimics botocore's StreamingBody: read(), iter_chunks(), iter_lines(), close()
+    def __init__(self, data):
+        self._stream = io.BytesIO(data)
+
+    def read(self, amt=None):
+        return self._stream.read(-1 if amt is None else amt)
+
+    def iter_chunks(self, chunk_size=1024):
+        while True:
+            chunk = self._stream.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def iter_lines(self, chunk_size=1024):
+        yield from self._stream.read().splitlines()
+
+    def close(self):
+        self._stream.close()
+
+
+class _Paginator:
+    def __init__(self, method):
+        self._method = method
+
+    def paginate(self, **kwargs):
+        while True:
+            page = self._method(**kwargs)
+            yield page
+            token = page.get("NextContinuationToken") or page.get("LastEvaluatedKey")
+            if not token:
+                return
+            if "NextContinuationToken" in page:
+                kwargs["ContinuationToken"] = token
+            else:
+                kwargs["ExclusiveStartKey"] = token
+
+
+class LocalS3:
+    def __init__(self):
+        self.objects = {}  # (bucket, key) -> bytes
+        self.calls = Counter()
+        self.bytes_written = 0
+        self.bytes_read = 0
+
+    @staticmethod
+    def _etag(data):
+        return '"' + hashlib.md5(data).hexdigest() + '"'
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.calls["put_object"] += 1
+        data = Body.encode("utf-8") if isinstance(Body, str) else bytes(Body)
+        self.objects[(Bucket, Key)] = data
+        self.bytes_written += len(data)
+        return {"ETag": self._etag(data)}
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None, **kwargs):
+        self.calls["get_object"] += 1
+        if (Bucket, Key) not in self.objects:
+            raise client_error("NoSuchKey", "GetObject", "The specified key does not exist.")
+        data = self.objects[(Bucket, Key)]
+        etag = self._etag(data)
+        if IfNoneMatch is not None and IfNoneMatch == etag:
+            raise client_error("304", "GetObject", "Not Modified")
+        self.bytes_read += len(data)
+        return {"Body": StreamingBody(data), "ContentLength": len(data), "ETag": etag}
+
+    def list_objects_v2(self, Bucket, Prefix="", ContinuationToken=None, MaxKeys=1000, **kwargs):
+        self.calls["list_objects_v2"] += 1
+        keys = sorted(key for bucket, key in self.objects if bucket == Bucket and key.startswith(Prefix))
+        start = int(ContinuationToken or 0)
+        page = keys[start:start + MaxKeys]
+        response = {"Contents": [{"Key": key, "Size": len(self.objects[(Bucket, key)])} for key in page],
+                    "KeyCount": len(page)}
+        if start + MaxKeys < len(keys):
+            response["NextContinuationToken"] = str(start + MaxKeys)
+        return response
+
+    def get_paginator(self, operation_name):
+        return _Paginator(getattr(self, operation_name))
+
+
+class LocalLambda:
+    # Records async invokes per function instead of running them. Safe to call from several
+    # threads. latency_seconds makes each call take that long; with concurrency_limit, a call made
+    # while that many are already in flight is throttled (TooManyRequestsException), like a
+    # function at its concurrency or invoke rate limit.
+    def __init__(self, latency_seconds=0.0, concurrency_limit=None):
+        self.invocations = defaultdict(list)  # function name -> [payload dict]
+        self.calls = Counter()
+        self.bytes_sent = 0
+        self.latency_seconds = latency_seconds
+        self.concurrency_limit = concurrency_limit
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self._lock = threading.Lock()
+
+    def invoke(self, FunctionName, InvocationType="RequestResponse", Payload=b"", **kwargs):
+        with self._lock:
+            self.calls["invoke"] += 1
+            if self.concurrency_limit is not None and self.in_flight >= self.concurrency_limit:
+                self.calls["throttled"] += 1
+                raise client_error("TooManyRequestsException", "Invoke", "Rate Exceeded.")
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            if self.latency_seconds:
+                time.sleep(self.latency_seconds)
+            payload = Payload.decode("utf-8") if isinstance(Payload, bytes) else Payload
+            with self._lock:
+                self.bytes_sent += len(payload)
+                self.invocations[FunctionName].append(json.loads(payload))
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+        return {"StatusCode": 202 if InvocationType == "Event" else 200}
+
+    def take(self, function_name):
+        # Returns and clears the payloads recorded for a function
+        return self.invocations.pop(function_name, [])
+
+
+# DynamoDB stops a Scan/Query page at 1 MB and charges a read unit per 4 KB read
+# (half that for eventually consistent reads)
+PAGE_BYTES = 1024 * 1024
+READ_UNIT_BYTES = 4096
+
+_KEY_CONDITION_OPERATORS = {
+    "=": lambda a, b: a == b, "<": lambda a, b: a < b, "<=": lambda a, b: a <= b,
+    ">": lambda a, b: a > b, ">=": lambda a, b: a >= b,
+}
+
+
+class LocalTable:
+    # Items keyed by (user_id, timestamp) unless LocalDynamoDB.define_table() says otherwise.
+    # Global secondary indexes added with LocalDynamoDB.define_index() are kept sorted as items
+    # are written, so a Query reads only the matching entries, like the real service. Scans and
+    # Queries count read units.
+    def __init__(self, resource, name, key_names=("user_id", "timestamp")):
+        self._resource = resource
+        self.name = name
+        self.key_names = key_names  # (partition key, sort key)
+        self.items = {}  # (partition value, sort value) -> item
+        self.sizes = {}  # (partition value, sort value) -> approximate item size in bytes
+        self.indexes = {}  # name -> {"keys": (partition, sort), "projection": ..., "partitions": {value: [(sort value, key)]}}
+        self._scan_order = {}  # (Segment, TotalSegments) -> sorted keys, rebuilt after a new key is added
+
+    def _key(self, item):
+        return tuple(item.get(name) for name in self.key_names)
+
+    def _key_item(self, key):
+        return dict(zip(self.key_names, key))
+
+    def _unindex(self, key, old):
+        for index in self.indexes.values():
+            partition_key, sort_key = index["keys"]
+            if partition_key in old and sort_key in old:
+                index["partitions"][old[partition_key]].remove((old[sort_key], key))
+
+    def _store(self, item):
+        key = self._key(item)
+        old = self.items.get(key)
+        if old is not None:
+            self._unindex(key, old)
+        for index in self.indexes.values():
+            partition_key, sort_key = index["keys"]
+            if partition_key in item and sort_key in item:
+                bisect.insort(index["partitions"].setdefault(item[partition_key], []), (item[sort_key], key))
+        if old is None:
+            self._scan_order.clear()
+        self.items[key] = item
+        self.sizes[key] = len(json.dumps(item, default=str))
+
+    def _delete(self, key):
+        old = self.items.pop(key, None)
+        if old is not None:
+            self._unindex(key, old)
+            del self.sizes[key]
+            self._scan_order.clear()
+
+    def clear(self):
+        # Drops every item, keeping the indexes defined on the table
+        self.items.clear()
+        self.sizes.clear()
+        self._scan_order.clear()
+        for index in self.indexes.values():
+            index["partitions"].clear()
+
+    def _charge(self, nbytes, consistent):
+        units = math.ceil(nbytes / READ_UNIT_BYTES) * (1 if consistent else 0.5)
+        self._resource.read_units += units
+        return units
+
+    def _check(self, key, operation, ConditionExpression=None, ExpressionAttributeValues=None):
+        # ConditionExpression: clauses joined by AND, or by OR, each "attribute_not_exists(<attribute>)"
+        # or "<attribute> <op> :value" with op one of = < <= > >=, checked against the stored item
+        # (a comparison fails on a missing item). Raises ConditionalCheckFailedException like the
+        # real service.
+        if not ConditionExpression:
+            return
+        item = self.items.get(key) or {}
+
+        def holds(clause):
+            clause = clause.strip()
+            if clause.startswith("attribute_not_exists("):
+                return clause[len("attribute_not_exists("):-1].strip() not in item
+            name, operator, placeholder = clause.split()
+            return name in item and _KEY_CONDITION_OPERATORS[operator](item[name], ExpressionAttributeValues[placeholder])
+
+        if " OR " in ConditionExpression:
+            met = any(holds(clause) for clause in ConditionExpression.split(" OR "))
+        else:
+            met = all(holds(clause) for clause in ConditionExpression.split(" AND "))
+        if not met:
+            raise client_error("ConditionalCheckFailedException", operation, "The conditional request failed")
+
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeValues=None, **kwargs):
+        self._resource.calls["put_item"] += 1
+        self._resource.write_units += 1
+        self._check(self._key(Item), "PutItem", ConditionExpression, ExpressionAttributeValues)
+        self._store(Item)
+        return {}
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues=None, ExpressionAttributeNames=None, **kwargs):
+        # Supports "SET a = :a, b = :b"
+        self._resource.calls["update_item"] += 1
+        self._resource.write_units += 1
+        key = self._key(Key)
+        item = dict(self.items.get(key, Key))
+        for assignment in UpdateExpression.replace("SET ", "", 1).split(","):
+            name, value = (part.strip() for part in assignment.split("="))
+            item[(ExpressionAttributeNames or {}).get(name, name)] = ExpressionAttributeValues[value]
+        self._store(item)
+        return {}
+
+    def delete_item(self, Key, ConditionExpression=None, ExpressionAttributeValues=None, **kwargs):
+        self._resource.calls["delete_item"] += 1
+        self._resource.write_units += 1
+        self._check(self._key(Key), "DeleteItem", ConditionExpression, ExpressionAttributeValues)
+        self._delete(self._key(Key))
+        return {}
+
+    def scan(self, ExclusiveStartKey=None, Limit=None, Segment=None, TotalSegments=None,
+             FilterExpression=None, ExpressionAttributeValues=None, ConsistentRead=False,
+             ReturnConsumedCapacity=None, **kwargs):
+        # Segments split the table by partition key hash, as DynamoDB does. FilterExpression
+        # supports "<attribute> > :value", applied after Limit like the real service.
+        self._resource.calls["scan"] += 1
+        order = self._scan_order.get((Segment, TotalSegments))
+        if order is None:
+            order = sorted(self.items)
+            if TotalSegments:
+                order = [key for key in order if zlib.crc32(str(key[0]).encode("utf-8")) % TotalSegments == Segment]
+            self._scan_order[(Segment, TotalSegments)] = order
+        start = 0
+        if ExclusiveStartKey:
+            start = bisect.bisect_right(order, self._key(ExclusiveStartKey))
+        page, nbytes = [], 0
+        for key in itertools.islice(order, start, None):
+            if (Limit and len(page) >= Limit) or nbytes >= PAGE_BYTES:
+                break
+            page.append(self.items[key])
+            nbytes += self.sizes[key]
+        matches = page
+        if FilterExpression:
+            attribute, placeholder = (part.strip() for part in FilterExpression.split(">"))
+            value = ExpressionAttributeValues[placeholder]
+            matches = [item for item in matches if attribute in item and item[attribute] > value]
+        response = {"Items": matches, "Count": len(matches), "ScannedCount": len(page)}
+        units = self._charge(nbytes, ConsistentRead)
+        if ReturnConsumedCapacity:
+            response["ConsumedCapacity"] = {"TableName": self.name, "CapacityUnits": units}
+        if start + len(page) < len(order):
+            last = page[-1]
+            response["LastEvaluatedKey"] = self._key_item(self._key(last))
+        return response
+
+    def query(self, KeyConditionExpression, ExpressionAttributeValues, IndexName=None, ExclusiveStartKey=None,
+              Limit=None, ScanIndexForward=True, ConsistentRead=False, ReturnConsumedCapacity=None, Select=None,
+              **kwargs):
+        # KeyConditionExpression: "<partition> = :value [AND <sort> <op> :value]" with op one of
+        # = < <= > >=. Without IndexName the table itself is queried by its partition key.
+        # Select="COUNT" returns only the count.
+        self._resource.calls["query"] += 1
+        conditions = KeyConditionExpression.split(" AND ")
+        partition_value = ExpressionAttributeValues[conditions[0].split("=")[1].strip()]
+        if IndexName:
+            index = self.indexes[IndexName]
+            (partition_key, sort_key), projection = index["keys"], index["projection"]
+            entries = list(index["partitions"].get(partition_value, []))
+        else:
+            (partition_key, sort_key), projection = self.key_names, "ALL"
+            entries = sorted((key[1], key) for key in self.items if key[0] == partition_value)
+        if len(conditions) > 1:
+            _, operator, placeholder = conditions[1].split()
+            bound = ExpressionAttributeValues[placeholder]
+            entries = [entry for entry in entries if _KEY_CONDITION_OPERATORS[operator](entry[0], bound)]
+        if not ScanIndexForward:
+            entries.reverse()
+        if ExclusiveStartKey:
+            start = (ExclusiveStartKey[sort_key], self._key(ExclusiveStartKey))
+            entries = entries[entries.index(start) + 1:]
+
+        page, nbytes = [], 0
+        for sort_value, key in entries:
+            if (Limit and len(page) >= Limit) or nbytes >= PAGE_BYTES:
+                break
+            item = self.items[key]
+            if projection == "KEYS_ONLY":
+                item = {name: item[name] for name in (*self.key_names, partition_key, sort_key)}
+                nbytes += len(json.dumps(item, default=str))
+            else:
+                nbytes += self.sizes[key]
+            page.append(item)
+        response = {"Items": page, "Count": len(page), "ScannedCount": len(page)}
+        units = self._charge(nbytes, ConsistentRead)
+        if ReturnConsumedCapacity:
+            response["ConsumedCapacity"] = {"TableName": self.name, "CapacityUnits": units}
+        if len(page) < len(entries):
+            last = page[-1]
+            response["LastEvaluatedKey"] = {name: last[name] for name in {*self.key_names, partition_key, sort_key}}
+        if Select == "COUNT":
+            del response["Items"]
+        return response
+
+
+class LocalDynamoDB:
+    # Stand-in for boto3.resource("dynamodb")
+    def __init__(self):
+        self.tables = {}
+        self.calls = Counter()
+        self.write_units = 0
+        self.read_units = 0
+
+    def Table(self, name):
+        if name not in self.tables:
+            self.tables[name] = LocalTable(self, name)
+        return self.tables[name]
+
+    def define_table(self, table_name, partition_key, sort_key):
+        # Creates an empty table with its own key attributes
+        self.tables[table_name] = LocalTable(self, table_name, (partition_key, sort_key))
+        return self.tables[table_name]
+
+    def define_index(self, table_name, index_name, partition_key, sort_key, projection="ALL"):
+        # Adds a global secondary index and indexes the items already in the table
+        table = self.Table(table_name)
+        partitions = {}
+        for key, item in table.items.items():
+            if partition_key in item and sort_key in item:
+                partitions.setdefault(item[partition_key], []).append((item[sort_key], key))
+        for entries in partitions.values():
+            entries.sort()
+        table.indexes[index_name] = {"keys": (partition_key, sort_key), "projection": projection, "partitions": partitions}
+
+    def batch_write_item(self, RequestItems, **kwargs):
+        self.calls["batch_write_item"] += 1
+        for table_name, requests in RequestItems.items():
+            if len(requests) > 25:
+                raise client_error("ValidationException", "BatchWriteItem", "Too many items requested")
+            table = self.Table(table_name)
+            for request in requests:
+                if "DeleteRequest" in request:
+                    table._delete(table._key(request["DeleteRequest"]["Key"]))
+                else:
+                    table._store(request["PutRequest"]["Item"])
+                self.write_units += 1
+        return {"UnprocessedItems": {}}
+
+    def batch_get_item(self, RequestItems, **kwargs):
+        self.calls["batch_get_item"] += 1
+        responses = {}
+        for table_name, request in RequestItems.items():
+            if len(request["Keys"]) > 100:
+                raise client_error("ValidationException", "BatchGetItem", "Too many items requested")
+            table = self.Table(table_name)
+            responses[table_name] = [table.items[table._key(key)] for key in request["Keys"]
+                                     if table._key(key) in table.items]
+        return {"Responses": responses, "UnprocessedKeys": {}}
+
+
+class LocalDynamoDBClient:
+    # Stand-in for boto3.client("dynamodb") with typed attribute values. Conditions support the
+    # forms the idempotency ledger uses: attribute_not_exists(<key>), optionally
+    # "OR <attribute> < :value".
+    def __init__(self):
+        self.tables = defaultdict(dict)  # table -> {key value: item}
+        self.calls = Counter()
+
+    @staticmethod
+    def _key(key):
+        # {"pk": {"S": "..."}} -> (("pk", "..."),)
+        if len(key) == 1:
+            (name, typed), = key.items()
+            return ((name, next(iter(typed.values()))),)
+        return tuple(sorted((name, value) for name, typed in key.items() for value in typed.values()))
+
+    def _condition_holds(self, existing, condition, values):
+        if existing is None:
+            return True
+        if " OR " in (condition or ""):
+            attribute, placeholder = condition.split(" OR ", 1)[1].split(" < ")
+            current = existing.get(attribute.strip())
+            return current is not None and float(current["N"]) < float(values[placeholder.strip()]["N"])
+        return not condition
+
+    def _put(self, TableName, Item, ConditionExpression=None, ExpressionAttributeValues=None, key_names=("pk",)):
+        table = self.tables[TableName]
+        key = self._key({name: Item[name] for name in key_names})
+        if not self._condition_holds(table.get(key), ConditionExpression, ExpressionAttributeValues or {}):
+            return False
+        table[key] = dict(Item)
+        return True
+
+    def put_item(self, TableName, Item, ConditionExpression=None, ExpressionAttributeValues=None, **kwargs):
+        self.calls["put_item"] += 1
+        if not self._put(TableName, Item, ConditionExpression, ExpressionAttributeValues):
+            raise client_error("ConditionalCheckFailedException", "PutItem", "The conditional request failed")
+        return {}
+
+    def update_item(self, TableName, Key, UpdateExpression, ExpressionAttributeNames=None, ExpressionAttributeValues=None, **kwargs):
+        # Supports "SET #name = :value [REMOVE attribute]"
+        self.calls["update_item"] += 1
+        item = self.tables[TableName].setdefault(self._key(Key), dict(Key))
+        set_part, _, remove_part = UpdateExpression.partition(" REMOVE ")
+        for assignment in set_part.replace("SET ", "", 1).split(","):
+            name, value = (part.strip() for part in assignment.split("="))
+            item[(ExpressionAttributeNames or {}).get(name, name)] = ExpressionAttributeValues[value]
+        for name in remove_part.split(","):
+            item.pop(name.strip(), None)
+        return {}
+
+    def delete_item(self, TableName, Key, **kwargs):
+        self.calls["delete_item"] += 1
+        self.tables[TableName].pop(self._key(Key), None)
+        return {}
+
+    def batch_write_item(self, RequestItems, **kwargs):
+        self.calls["batch_write_item"] += 1
+        for table_name, requests in RequestItems.items():
+            if len(requests) > 25:
+                raise client_error("ValidationException", "BatchWriteItem", "Too many items requested")
+            for request in requests:
+                if "DeleteRequest" in request:
+                    self.tables[table_name].pop(self._key(request["DeleteRequest"]["Key"]), None)
+                else:
+                    self._put(table_name, request["PutRequest"]["Item"])
+        return {"UnprocessedItems": {}}
+
+    def transact_write_items(self, TransactItems, **kwargs):
+        # All or nothing: if any condition fails, nothing is written and the reasons say which
+        self.calls["transact_write_items"] += 1
+        if len(TransactItems) > 100:
+            raise client_error("ValidationException", "TransactWriteItems", "Member must have length less than or equal to 100")
+        writes = []
+        reasons = []
+        failed = False
+        for request in TransactItems:
+            put = request["Put"]
+            table = self.tables[put["TableName"]]
+            key = self._key({"pk": put["Item"]["pk"]})
+            if self._condition_holds(table.get(key), put.get("ConditionExpression"), put.get("ExpressionAttributeValues", {})):
+                reasons.append({"Code": "None"})
+                writes.append((table, key, put["Item"]))
+            else:
+                reasons.append({"Code": "ConditionalCheckFailed", "Message": "The conditional request failed"})
+                failed = True
+        if failed:
+            error = client_error("TransactionCanceledException", "TransactWriteItems", "Transaction cancelled")
+            error.response["CancellationReasons"] = reasons
+            raise error
+        for table, key, item in writes:
+            table[key] = dict(item)
+        return {}
+
+
+class LocalSNS:
+    def __init__(self):
+        self.messages = []
+        self.calls = Counter()
+
+    def publish(self, **kwargs):
+        self.calls["publish"] += 1
+        self.messages.append(kwargs)
+        return {"MessageId": f"local-{len(self.messages)}"}
+
+    def publish_batch(self, TopicArn, PublishBatchRequestEntries, **kwargs):
+        self.calls["publish_batch"] += 1
+        if len(PublishBatchRequestEntries) > 10:
+            raise client_error("TooManyEntriesInBatchRequest", "PublishBatch", "The batch request contains more entries than permissible.")
+        successful = []
+        for entry in PublishBatchRequestEntries:
+            self.messages.append(dict(entry, TopicArn=TopicArn))
+            successful.append({"Id": entry["Id"], "MessageId": f"local-{len(self.messages)}"})
+        return {"Successful": successful, "Failed": []}
+
+
+class LocalSQS:
+    # One queue with at-least-once delivery. poll_event() builds the event the Lambda event source
+    # mapping would deliver; complete() deletes the messages the handler didn't report as failed.
+    def __init__(self, queue_arn="arn:aws:sqs:us-east-1:000000000000:local-queue"):
+        self.queue_arn = queue_arn
+        self.messages = deque()  # (message_id, body, receive_count)
+        self.in_flight = {}
+        self.attributes = {}  # message_id -> MessageAttributes from send_message
+        self.calls = Counter()
+        self.deleted = 0
+
+    def get_queue_url(self, QueueName, **kwargs):
+        self.calls["get_queue_url"] += 1
+        region, account, name = self.queue_arn.split(":")[3:]
+        if QueueName != name:
+            raise client_error("AWS.SimpleQueueService.NonExistentQueue", "GetQueueUrl", "The specified queue does not exist.")
+        return {"QueueUrl": f"https://sqs.{region}.amazonaws.com/{account}/{name}"}
+
+    def send_message(self, QueueUrl, MessageBody, MessageAttributes=None, **kwargs):
+        self.calls["send_message"] += 1
+        message_id = str(uuid.uuid4())
+        self.messages.append((message_id, MessageBody, 0))
+        self.attributes[message_id] = MessageAttributes or {}
+        return {"MessageId": message_id}
+
+    def send_message_batch(self, QueueUrl, Entries, **kwargs):
+        self.calls["send_message_batch"] += 1
+        if len(Entries) > 10:
+            raise client_error("AWS.SimpleQueueService.TooManyEntriesInBatchRequest", "SendMessageBatch")
+        successful = []
+        for entry in Entries:
+            message_id = str(uuid.uuid4())
+            self.messages.append((message_id, entry["MessageBody"], 0))
+            successful.append({"Id": entry["Id"], "MessageId": message_id})
+        return {"Successful": successful, "Failed": []}
+
+    def poll_event(self, batch_size=10):
+        records = []
+        while self.messages and len(records) < batch_size:
+            message_id, body, receive_count = self.messages.popleft()
+            self.in_flight[message_id] = (body, receive_count + 1)
+            records.append({
+                "messageId": message_id,
+                "receiptHandle": message_id,
+                "body": body,
+                "attributes": {"ApproximateReceiveCount": str(receive_count + 1)},
+                "messageAttributes": {name: {"stringValue": value.get("StringValue"), "dataType": value.get("DataType")}
+                                      for name, value in self.attributes.get(message_id, {}).items()},
+                "eventSource": "aws:sqs",
+                "eventSourceARN": self.queue_arn,
+                "awsRegion": "us-east-1",
+            })
+        return {"Records": records}
+
+    def complete(self, event, response=None):
+        # Applies a handler's response; None (the handler raised) returns the whole batch to the queue.
+        # Returns the number of messages put back.
+        if response is None:
+            failed = {record["messageId"] for record in event["Records"]}
+        else:
+            failed = {failure["itemIdentifier"] for failure in response.get("batchItemFailures", [])}
+        for record in event["Records"]:
+            body, receive_count = self.in_flight.pop(record["messageId"])
+            if record["messageId"] in failed:
+                self.messages.append((record["messageId"], body, receive_count))
+            else:
+                self.deleted += 1
+        return len(failed)
@@ -0,0 +1,83 @@
+# message_templates.py - pre-rendered SNS messages for the recommendation emails.
+# rec_lambda only ever sends a handful of recommendation lists (one per phase), so the
+# email/SMS/default bodies and the subject are rendered and JSON-encoded once per
+# (locale, phase, recommendations) and cached for the life of the container. Each message is
+# then the cached JSON with the user's ID spliced in, so the cost per message stays flat.
+#
+# The cache is keyed by TEMPLATE_VERSION, which includes a checksum of TEMPLATES: editing a
+# template (or bumping MESSAGE_TEMPLATE_VERSION) invalidates every cached rendering.
+import json
+import os
+import zlib
+
+DEFAULT_LOCALE = os.environ.get("MESSAGE_LOCALE", "en")
+# Cached renderings kept per container; there are normally about five per locale
+MAX_CACHED_TEMPLATES = int(os.environ.get("MESSAGE_TEMPLATE_CACHE_SIZE", 256))
+# SNS limits: 100 characters for a subject, about 140 for an SMS message
+MAX_SUBJECT_CHARS = 100
+MAX_SMS_CHARS = 140
+
+# Stands in for the user's ID in a rendering until the message is personalized.
+# Written as {user_id} in the templates below.
+USER_ID_PLACEHOLDER = "{{user_id}}"
+
+TEMPLATES = {
+    "en": {
+        "subject": "Your daily recommendations: {phase} phase",
+        "body": ("Hi {user_id},\n\nBased on today's survey you are in your {phase} phase. "
+                 "Here is what we recommend:\n\n{recommendations}\n"),
+        "recommendation": "- {recommendation}",
+        "sms": "{phase} phase: {first}",
+        "sms_more": " (+{more} more in your email)",
+    },
+}
+
+TEMPLATE_VERSION = os.environ.get("MESSAGE_TEMPLATE_VERSION", "1") + "-" + format(
+    zlib.crc32(json.dumps(TEMPLATES, sort_keys=True).encode("utf-8")), "08x")
+
+# (TEMPLATE_VERSION, locale, phase, recommendations) -> (parts, subject). parts is the JSON message
+# split at the user ID placeholder.
+_rendered = {}
+RENDER_STATS = {"hits": 0, "misses": 0}
+
+
+def _sms(template, phase, recommendations):
+    first = recommendations[0] if recommendations else ""
+    more = template["sms_more"].format(more=len(recommendations) - 1) if len(recommendations) > 1 else ""
+    text = template["sms"].format(phase=phase, first=first)
+    if len(text) + len(more) > MAX_SMS_CHARS:
+        text = text[:MAX_SMS_CHARS - len(more) - 3].rstrip() + "..."
+    return text + more
+
+
+def render_template(locale, phase, recommendations):
+    # Renders one message without a user: returns (parts, subject), where joining parts with the
+    # JSON-escaped user ID gives the MessageStructure='json' message
+    template = TEMPLATES.get(locale) or TEMPLATES[DEFAULT_LOCALE]
+    recommendations_text = "\n".join(template["recommendation"].format(recommendation=rec) for rec in recommendations)
+    body = template["body"].format(user_id=USER_ID_PLACEHOLDER, phase=phase, recommendations=recommendations_text)
+    message = json.dumps({"default": body, "email": body, "sms": _sms(template, phase, recommendations)})
+    subject = " ".join(template["subject"].format(phase=phase).split())[:MAX_SUBJECT_CHARS]
+    return tuple(message.split(USER_ID_PLACEHOLDER)), subject
+
+
+def render(user_id, phase, recommendations, locale=None):
+    # Returns (message, subject) for one user, from the cached rendering when there is one
+    key = (TEMPLATE_VERSION, locale or DEFAULT_LOCALE, phase, tuple(recommendations))
+    rendered = _rendered.get(key)
+    if rendered is None:
+        RENDER_STATS["misses"] += 1
+        if len(_rendered) >= MAX_CACHED_TEMPLATES:
+            _rendered.clear()
+        rendered = _rendered[key] = render_template(key[1], phase, key[3])
+    else:
+        RENDER_STATS["hits"] += 1
+    parts, subject = rendered
+    if len(parts) == 1:
+        return parts[0], subject
+    # json.dumps escapes the ID the same way the rest of the message was escaped
+    return json.dumps(str(user_id))[1:-1].join(parts), subject
+
+
+def clear():
+    _rendered.clear()
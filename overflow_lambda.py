@@ -0,0 +1,41 @@
+# overflow_lambda.py - replays invokes that verify, cat_lambda and rec_lambda couldn't deliver.
+# invoker.spill() puts the batch event on the overflow SQS queue with the target function name
+# as a message attribute; this handler, mapped to that queue, invokes the function with it
+# unchanged (trace ID included). Messages that still can't be delivered are reported as batch
+# item failures, so SQS retries them and finally moves them to the queue's dead-letter queue.
+import instrumentation
+import aws_clients
+from invoker import InvokeExecutor, FUNCTION_NAME_ATTRIBUTE
+
+lambda_client = aws_clients.client("lambda")
+
+
+def lambda_handler(event, context):
+    metrics = instrumentation.start("overflow_lambda", event)
+    records = event.get("Records", [])
+    metrics.count("received", len(records))
+
+    executors = {}
+    failed_message_ids = []
+    for record in records:
+        function_name = record.get("messageAttributes", {}).get(FUNCTION_NAME_ATTRIBUTE, {}).get("stringValue")
+        if not function_name:
+            # Nothing to replay it to, and retrying won't add one
+            metrics.error("Overflow message without a target function. Dropping it.", message_id=record["messageId"])
+            metrics.skip("No target function")
+            continue
+        if function_name not in executors:
+            # Not spilled again: SQS already holds the message until it is delivered
+            executors[function_name] = InvokeExecutor(function_name, lambda_client, spill_failures=False)
+        executors[function_name].submit_payload(record["body"].encode("utf-8"), [record["messageId"]])
+
+    replayed = 0
+    for executor in executors.values():
+        sent_count, failed = executor.close()
+        replayed += sent_count
+        failed_message_ids.extend(failed)
+    metrics.count("replayed", replayed)
+    metrics.count("replay_failed", len(failed_message_ids))
+    metrics.log("Replayed overflow invokes", messages=len(records), replayed=replayed, failed=len(failed_message_ids))
+    metrics.emit()
+    return {"batchItemFailures": [{"itemIdentifier": message_id} for message_id in failed_message_ids]}
@@ -0,0 +1,365 @@
+# pipeline.py - runs verify -> cat -> rec -> send in a single process, without Lambda hops.
+# The stages reuse the handlers' own functions and are linked by bounded queues. Parsing and
+# validation, the bulk of the CPU work, can run on a multiprocessing pool, one file / S3 object
+# per task, so a day's backlog can be reprocessed on one machine; workers send each chunk back
+# as soon as it is validated, through a bounded queue, so memory is bounded per chunk rather than
+# per source. Classification stays in the
+# main process so every survey is classified against one set of per-user cycle states, as
+# cat_lambda does: the DynamoDB table with the aws backend, an in-memory store with the memory
+# backend (CYCLE_STATE_ENABLED=false turns the prior off).
+#
+# Usage:
+#   python pipeline.py tests/*.json                      # in-memory storage and notifications
+#   python pipeline.py s3://final-summer99d/raw_surveys/ --backend aws --workers 4
+import argparse
+import json
+import multiprocessing
+import queue
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+from botocore.exceptions import ClientError
+
+from batching import BATCH_SIZE
+from verify import iter_questionnaires, validate_batch, reason_code, STREAM_CHUNK_SIZE
+import cat_lambda
+import cycle_state
+from cat_lambda import classify_phases, classify_with_cycle_state
+from rec_lambda import build_result
+
+
+# --- Storage backends ---
+class InMemoryStorage:
+    # Keeps results in memory, keyed like the DynamoDB table
+    def __init__(self):
+        self.items = {}
+
+    def save(self, results):
+        for result in results:
+            self.items[(result["user_id"], result["timestamp"])] = result
+        return []
+
+
+class AwsStorage:
+    # Writes to DynamoDB and S3 through rec_lambda's bulk persistence functions. A result is
+    # failed if either write failed.
+    def save(self, results):
+        import rec_lambda
+        failed = rec_lambda.save_results_to_dynamodb(results)
+        _, s3_failed = rec_lambda.save_results_to_s3(results)
+        unsaved = {(result["user_id"], result["timestamp"]) for result in failed + s3_failed}
+        return [result for result in results if (result["user_id"], result["timestamp"]) in unsaved]
+
+
+# --- Notification backends ---
+class InMemoryNotifier:
+    # Records the messages that would have been sent
+    def __init__(self):
+        self.sent = []
+
+    def send(self, email_payloads):
+        self.sent.extend(email_payloads)
+        return ["Email sent (recorded in memory)."] * len(email_payloads)
+
+
+class SnsNotifier:
+    # Publishes through send_email_lambda's directory lookup and SNS delivery. Returns
+    # send_email_lambda's email status per payload: "Email sent ...", "Email skipped ..." or
+    # "Email failed ...".
+    def send(self, email_payloads):
+        import send_email_lambda
+        statuses = [None] * len(email_payloads)
+        pending = []
+        for i, payload in enumerate(email_payloads):
+            user_email, config_error = send_email_lambda.find_user_email(payload["user_id"])
+            if config_error or not user_email:
+                statuses[i] = config_error or "Email skipped (address not found)."
+                continue
+            pending.append((i, payload["user_id"], payload["phase"], payload["recommendations_list"]))
+        if pending:
+            delivered = send_email_lambda.deliver_batch([item[1:] for item in pending])
+            for (i, *_), status in zip(pending, delivered):
+                statuses[i] = status
+        return statuses
+
+
+def dynamodb_state_store():
+    import aws_clients
+    return cycle_state.DynamoDBStateStore(aws_clients.resource("dynamodb"))
+
+
+# Backend -> (storage, notifier, cycle state store) factories
+BACKENDS = {
+    "memory": (InMemoryStorage, InMemoryNotifier, cycle_state.MemoryStateStore),
+    "aws": (AwsStorage, SnsNotifier, dynamodb_state_store),
+}
+
+
+# --- Sources ---
+# A source is a local JSON array / NDJSON file or a single S3 object (s3://bucket/key)
+def expand_sources(sources):
+    # Expands s3://bucket/prefix arguments into one source per S3 object
+    for source in sources:
+        if not source.startswith("s3://"):
+            yield source
+            continue
+        import verify
+        bucket_name, _, prefix = source[len("s3://"):].partition("/")
+        paginator = verify.s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                yield f"s3://{bucket_name}/{obj['Key']}"
+
+
+def _read_source(source):
+    # Byte chunks of one source
+    if source.startswith("s3://"):
+        import verify
+        bucket_name, _, object_key = source[len("s3://"):].partition("/")
+        body = verify.s3_client.get_object(Bucket=bucket_name, Key=object_key)["Body"]
+        yield from body.iter_chunks(chunk_size=STREAM_CHUNK_SIZE)
+        return
+    with open(source, "rb") as f:
+        yield from iter(lambda: f.read(STREAM_CHUNK_SIZE), b"")
+
+
+def iter_source_surveys(source):
+    # Yields the questionnaires of one source; unparseable records come back as {"parse_error": ...}.
+    # A malformed JSON array can't be resynchronized, so like verify the rest of that source is
+    # skipped, and a source that can't be read is skipped whole; either comes back as one
+    # {"source_error": ...} record and the run moves on to the next source.
+    try:
+        for questionnaire, parse_error in iter_questionnaires(_read_source(source)):
+            yield questionnaire if parse_error is None else {"parse_error": parse_error}
+    except (json.JSONDecodeError, UnicodeDecodeError) as e:
+        print(f"JSON decode error in {source}: {e}. Skipping rest of source.", file=sys.stderr)
+        yield {"source_error": "JSON decode error. Skipped rest of source."}
+    except (OSError, ClientError) as e:
+        print(f"Could not read {source}: {e}. Skipping source.", file=sys.stderr)
+        yield {"source_error": "Could not read source."}
+
+
+def iter_surveys(sources):
+    for source in expand_sources(sources):
+        yield from iter_source_surveys(source)
+
+
+def iter_chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# --- CPU stage: verify ---
+def process_chunk(questionnaires):
+    # Validates one chunk of raw questionnaires. Module-level so it can be shipped to pool
+    # workers. Returns (payloads, skip_reasons) with the cat_lambda payload of each valid one and
+    # one reason per skipped record, made of verify's reason codes so the values aren't in it.
+    skip_reasons = []
+    parsed = []
+    for questionnaire in questionnaires:
+        if isinstance(questionnaire, dict) and "parse_error" in questionnaire:
+            skip_reasons.append("JSON decode error")
+        elif isinstance(questionnaire, dict) and "source_error" in questionnaire:
+            skip_reasons.append(questionnaire["source_error"])
+        else:
+            parsed.append(questionnaire)
+
+    _, payloads, reasons, errors = validate_batch(parsed)
+    valid = []
+    for i, payload in enumerate(payloads):
+        if i in errors:
+            skip_reasons.append("Processing error")
+        elif payload is None:
+            skip_reasons.append("; ".join(reason_code(reason) for reason in reasons[i]))
+        else:
+            valid.append(payload)
+    return valid, skip_reasons
+
+
+class Pipeline:
+    def __init__(self, storage=None, notifier=None, workers=0, batch_size=BATCH_SIZE, queue_depth=4, cycle_states=None):
+        self.storage = storage or InMemoryStorage()
+        self.notifier = notifier or InMemoryNotifier()
+        # Defaults to an in-memory store, or none (answers alone) with CYCLE_STATE_ENABLED=false
+        if cycle_states is None and cat_lambda.CYCLE_STATE_ENABLED:
+            cycle_states = cycle_state.MemoryStateStore()
+        self.cycle_states = cycle_states
+        self.workers = workers
+        self.batch_size = batch_size
+        self.queue_depth = queue_depth
+
+    def _stage(self, name, inbox, outbox, work, errors):
+        # Consumes batches from inbox until the None sentinel, passing work's output on to outbox
+        try:
+            while True:
+                batch = inbox.get()
+                if batch is None:
+                    break
+                output = work(batch)
+                if outbox is not None:
+                    outbox.put(output)
+        except Exception as e:
+            errors.append((name, e))
+            # Keep draining so upstream stages never block on a full queue
+            while inbox.get() is not None:
+                pass
+        finally:
+            if outbox is not None:
+                outbox.put(None)
+
+    def run(self, questionnaires):
+        # Streams questionnaires through every stage in this process
+        chunks = iter_chunks(questionnaires, self.batch_size)
+        return self._run(map(process_chunk, chunks))
+
+    def run_sources(self, sources):
+        # With workers > 1 each file / S3 object is parsed and validated on a pool worker,
+        # and only the valid payloads travel back to this process, a chunk at a time
+        if self.workers <= 1:
+            return self.run(iter_surveys(sources))
+        sources = list(expand_sources(sources))
+        outputs = multiprocessing.Queue(maxsize=self.workers * self.queue_depth)
+        with multiprocessing.Pool(self.workers, _init_worker, (outputs,)) as pool:
+            tasks = pool.map_async(_process_source, [(source, self.batch_size) for source in sources])
+            stats = self._run(_worker_outputs(outputs, len(sources)))
+            # Raises what a worker raised
+            tasks.get()
+            return stats
+
+    def classify(self, payloads):
+        # cat -> rec for one chunk of valid payloads: phases with the cycle-state prior, as
+        # cat_lambda assigns them, then the stored results
+        if self.cycle_states is not None and payloads:
+            surveyed_at = [datetime.strptime(payload["timestamp"], "%m%d%y%H%M%S") for payload in payloads]
+            phases = classify_with_cycle_state(payloads, surveyed_at, self.cycle_states)
+        else:
+            phases = classify_phases([payload["responses"] for payload in payloads])
+        results = []
+        for payload, phase in zip(payloads, phases):
+            payload["phase"] = phase
+            results.append(build_result(payload))
+        return results
+
+    def _run(self, processed):
+        # processed yields (payloads, skip_reasons) per chunk from the verify stage
+        stats = {"received": 0, "processed": 0, "skipped": 0, "stored": 0, "storage_failed": 0,
+                 "notified": 0, "notify_skipped": 0, "notify_failed": 0}
+        skip_reasons = Counter()
+        phases = Counter()
+        errors = []
+
+        def persist(results):
+            failed = self.storage.save(results)
+            stats["stored"] += len(results) - len(failed)
+            stats["storage_failed"] += len(failed)
+            # Like rec_lambda, only stored results are emailed
+            unsaved = {(result["user_id"], result["timestamp"]) for result in failed}
+            return [{
+                "user_id": result["user_id"],
+                "phase": result["phase"],
+                "recommendations_list": result["recommendations"]
+            } for result in results if (result["user_id"], result["timestamp"]) not in unsaved]
+
+        def notify(email_payloads):
+            # Only sent emails count as notified; skipped ones had no address or directory
+            statuses = self.notifier.send(email_payloads)
+            for status in statuses:
+                if status.startswith("Email sent"):
+                    stats["notified"] += 1
+                elif status.startswith("Email skipped"):
+                    stats["notify_skipped"] += 1
+                else:
+                    stats["notify_failed"] += 1
+
+        persist_queue = queue.Queue(maxsize=self.queue_depth)
+        notify_queue = queue.Queue(maxsize=self.queue_depth)
+        threads = [
+            threading.Thread(target=self._stage, args=("persist", persist_queue, notify_queue, persist, errors), daemon=True),
+            threading.Thread(target=self._stage, args=("notify", notify_queue, None, notify, errors), daemon=True),
+        ]
+        for thread in threads:
+            thread.start()
+
+        started = time.perf_counter()
+        try:
+            for payloads, reasons in processed:
+                results = self.classify(payloads)
+                stats["received"] += len(results) + len(reasons)
+                stats["processed"] += len(results)
+                stats["skipped"] += len(reasons)
+                skip_reasons.update(reasons)
+                phases.update(result["phase"] for result in results)
+                if results:
+                    persist_queue.put(results)
+        finally:
+            persist_queue.put(None)
+            for thread in threads:
+                thread.join()
+
+        if errors:
+            name, error = errors[0]
+            raise RuntimeError(f"Pipeline stage '{name}' failed: {str(error)}") from error
+
+        elapsed = max(time.perf_counter() - started, 1e-9)
+        stats["seconds"] = round(elapsed, 3)
+        stats["surveys_per_second"] = round(stats["received"] / elapsed, 1)
+        stats["phases"] = dict(phases)
+        stats["skip_reasons"] = dict(skip_reasons)
+        return stats
+
+
+# Pool workers put each chunk's (payloads, skip_reasons) here, then None when a source is done
+_outputs = None
+
+
+def _init_worker(outputs):
+    global _outputs
+    _outputs = outputs
+
+
+def _process_source(task):
+    # Pool task: parses and processes one source, sending each chunk's output back as it is ready.
+    # Blocks while the queue is full, so a worker never runs more than queue_depth chunks ahead.
+    source, batch_size = task
+    try:
+        for chunk in iter_chunks(iter_source_surveys(source), batch_size):
+            _outputs.put(process_chunk(chunk))
+    finally:
+        _outputs.put(None)
+
+
+def _worker_outputs(outputs, sources):
+    # Yields chunk outputs from the pool until every source has finished
+    while sources:
+        output = outputs.get()
+        if output is None:
+            sources -= 1
+        else:
+            yield output
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the survey pipeline in-process.")
+    parser.add_argument("sources", nargs="+", help="Local JSON/NDJSON files or s3://bucket/prefix")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="memory")
+    parser.add_argument("--workers", type=int, default=0, help="Worker processes, one source at a time each (0 or 1 = single process)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+
+    storage_cls, notifier_cls, state_store = BACKENDS[args.backend]
+    pipeline = Pipeline(storage_cls(), notifier_cls(), workers=args.workers, batch_size=args.batch_size,
+                        cycle_states=state_store() if cat_lambda.CYCLE_STATE_ENABLED else None)
+    print(json.dumps(pipeline.run_sources(args.sources), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,24 @@
 # rec_lambda.py (MODIFIED to invoke send_email_lambda)
 
 import json
-import boto3
 import os
+import gzip
+import time
+import uuid
 from datetime import datetime
 from botocore.exceptions import ClientError
-from decimal import Decimal
+from batching import unpack_event, invoke_in_batches
+import instrumentation
+import idempotency
+import aws_clients
+import codec
+import retries
+import survey_index
 
 # Initialize clients
-dynamodb = boto3.resource("dynamodb")
-s3 = boto3.client("s3")
-lambda_client = boto3.client("lambda") # <--- Add Lambda client to invoke send_email_lambda
+dynamodb = aws_clients.resource("dynamodb")
+s3 = aws_clients.client("s3")
+lambda_client = aws_clients.client("lambda") # <--- Add Lambda client to invoke send_email_lambda
 
 # Get environment variables (or define constants if not using env vars)
 S3_BUCKET = "final-summer99d"
@@ -19,17 +27,6 @@ DYNAMO_TABLE_NAME = "CyclicalBetaSurvey"
 # Define the name of the new email sending Lambda function
 SEND_EMAIL_LAMBDA_FUNCTION_NAME = "send_email_lambda"
 
-# Helper function for DynamoDB Decimal conversion
-def convert_floats(obj):
-    if isinstance(obj, float):
-        return Decimal(str(obj))
-    elif isinstance(obj, dict):
-        return {k: convert_floats(v) for k, v in obj.items()}
-    elif isinstance(obj, list):
-        return [convert_floats(elem) for elem in obj]
-    else:
-        return obj
-
 # Recommendation Generation Function
 def generate_recommendations(phase):
     recs = {
@@ -60,10 +57,8 @@ def generate_recommendations(phase):
     }
     return recs.get(phase, recs["Unknown"])
 
-def lambda_handler(event, context):
-    print(f"Received event for rec_lambda: {json.dumps(event)}")
-
-    # Extract data from the event payload (sent by cat_lambda)
+def build_result(event):
+    # Extract data from the survey payload (sent by cat_lambda)
     user_id = event.get("user_id")
     timestamp = event.get("timestamp")
     responses = event.get("responses")
@@ -83,65 +78,168 @@ def lambda_handler(event, context):
         "recommendations": recommendations_list, # Generated recommendations
         "valid": True # Assuming valid if it reached rec_lambda
     }
-
-    # Save to DynamoDB
+    return result
+
+# --- Bulk Persistence ---
+DYNAMO_MAX_RETRIES = int(os.environ.get("DYNAMO_MAX_RETRIES", 8))
+DYNAMO_BACKOFF_BASE_SECONDS = 0.05
+DYNAMO_BACKOFF_MAX_SECONDS = 5.0
+# S3 results are written as gzip-compressed JSON lines, one object per date per batch
+S3_RESULTS_PREFIX = "recommendations/"
+
+def save_results_to_dynamodb(results):
+    # Writes results with BatchWriteItem (25 items per request), retrying throttled requests and
+    # UnprocessedItems with backoff. Returns the list of results that could not be written.
+    # A request may not contain the same key twice, so only the last result per key is kept.
+    items = {}
+    for result in results:
+        items[(result["user_id"], result["timestamp"])] = result
+    items = list(items.values())
+
+    # saved_at lets export.py pull only the items written since its last run
+    saved_at = int(time.time())
+    # Floats become Decimals; only the parts of an item that hold floats are copied.
+    # The index attributes make the item queryable by date and phase (see survey_index.py).
+    requests = ({"PutRequest": {"Item": dict(codec.to_dynamodb(item), saved_at=saved_at,
+                                             **survey_index.index_attributes(item))}} for item in items)
+    unwritten = retries.batch_write(dynamodb, DYNAMO_TABLE_NAME, requests, "results", DYNAMO_MAX_RETRIES,
+                                    DYNAMO_BACKOFF_BASE_SECONDS, DYNAMO_BACKOFF_MAX_SECONDS)
+    unwritten = {(request["PutRequest"]["Item"]["user_id"], request["PutRequest"]["Item"]["timestamp"])
+                 for request in unwritten}
+    failed = [item for item in items if (item["user_id"], item["timestamp"]) in unwritten]
+
+    instrumentation.current().log("Saved results to DynamoDB", saved=len(items) - len(failed), total=len(items))
+    return failed
+
+def _result_date(result):
+    # Partition by survey date (timestamp is MMDDYYHHMMSS); fall back to today's date
     try:
-        table = dynamodb.Table(DYNAMO_TABLE_NAME)
-        safe_result = convert_floats(result) # Ensure any floats in responses are converted to Decimal
-        table.put_item(Item=safe_result)
-        print(f"Successfully saved to DynamoDB for user {user_id}.")
-    except ClientError as e:
-        print(f"Error writing to DynamoDB for user {user_id}: {str(e)}")
-    except Exception as e:
-        print(f"Unexpected error saving to DynamoDB for user {user_id}: {str(e)}")
-
+        return datetime.strptime(result["timestamp"], "%m%d%y%H%M%S").strftime("%Y-%m-%d")
+    except (KeyError, TypeError, ValueError):
+        return datetime.utcnow().strftime("%Y-%m-%d")
+
+def save_results_to_s3(results):
+    # Writes one compact gzip JSONL object per survey date. Returns (keys_written, failed_results).
+    metrics = instrumentation.current()
+    partitions = {}
+    for result in results:
+        partitions.setdefault(_result_date(result), []).append(result)
+
+    batch_id = f"{datetime.utcnow().strftime('%H%M%S')}-{uuid.uuid4().hex[:12]}"
+    keys = []
+    failed = []
+    for date, rows in partitions.items():
+        s3_key = f"{S3_RESULTS_PREFIX}date={date}/batch-{batch_id}.jsonl.gz"
+        body = b"".join(codec.dumps_bytes(row) + b"\n" for row in rows)
+        try:
+            s3.put_object(
+                Bucket=S3_BUCKET,
+                Key=s3_key,
+                Body=gzip.compress(body),
+                ContentType="application/x-ndjson",
+                ContentEncoding="gzip"
+            )
+            keys.append(s3_key)
+            metrics.observe_size("s3_object_bytes", len(body))
+            metrics.log("Saved results to S3", results=len(rows), object=f"s3://{S3_BUCKET}/{s3_key}")
+        except ClientError as e:
+            metrics.error("Error writing results to S3", results=len(rows), key=s3_key, error=str(e))
+            failed.extend(rows)
+        except Exception as e:
+            metrics.error("Unexpected error writing results to S3", results=len(rows), key=s3_key, error=str(e))
+            failed.extend(rows)
+    return keys, failed
+
+
+class IncompleteBatchError(Exception):
+    # Some results couldn't be stored or handed to send_email_lambda. Their claims have been
+    # released, so Lambda's async retry (or the DLQ) redoes them; the rest are dropped as duplicates.
+    pass
 
-    # Save to S3
-    try:
-        # Save the complete result as a JSON file in S3 under 'recommendations/' prefix
-        s3_key = f"recommendations/{user_id}_{timestamp}.json"
-        class DecimalEncoder(json.JSONEncoder):
-            def default(self, obj):
-                if isinstance(obj, Decimal):
-                    return float(obj)
-                return super(DecimalEncoder, self).default(obj)
-        s3.put_object(
-            Bucket=S3_BUCKET,
-            Key=s3_key,
-            Body=json.dumps(safe_result, cls=DecimalEncoder, indent=2) # Use safe_result for S3 as well
-        )
-        print(f"Successfully saved to S3 for user {user_id}.")
-    except ClientError as e:
-        print(f"Error writing to S3 for user {user_id}: {str(e)}")
-    except Exception as e:
-        print(f"Unexpected error saving to S3 for user {user_id}: {str(e)}")
-
-    # --- Invoke send_email_lambda ---
-    # Pass the necessary data to the email sending Lambda
-    email_payload = {
-        "user_id": user_id,
-        "phase": phase,
-        "recommendations_list": recommendations_list # Use the generated list
-    }
+def lambda_handler(event, context):
+    metrics = instrumentation.start("rec_lambda", event)
+    metrics.log_record("Received event for rec_lambda", event=event)
+
+    # Accepts either a single survey or a batch event {"surveys": [...]} from cat_lambda
+    surveys, is_batch = unpack_event(event)
+    received = len(surveys)
+    metrics.count("received", received)
+
+    # A retried async invoke must not store results or send emails a second time
+    surveys = idempotency.claim_surveys("rec", surveys)
+    if not surveys:
+        metrics.emit()
+        return {
+            "statusCode": 200,
+            "body": json.dumps({"received": received, "processed": 0,
+                                "status": "Duplicate delivery; already processed."})
+        }
+    # Claims of surveys that were stored and emailed are marked done below; the rest are released,
+    # so a retry redoes them
     try:
-        response = lambda_client.invoke(
-            FunctionName=SEND_EMAIL_LAMBDA_FUNCTION_NAME,
-            InvocationType='Event', # Asynchronous invocation
-            Payload=json.dumps(email_payload)
-        )
-        print(f"Invoked {SEND_EMAIL_LAMBDA_FUNCTION_NAME} for user {user_id}. Status code: {response['StatusCode']}")
-    except ClientError as e:
-        print(f"Error invoking {SEND_EMAIL_LAMBDA_FUNCTION_NAME} for user {user_id}: {str(e)}")
-    except Exception as e:
-        print(f"Unexpected error invoking {SEND_EMAIL_LAMBDA_FUNCTION_NAME} for user {user_id}: {str(e)}")
-
+        with metrics.timer("recommend"):
+            results = [build_result(survey) for survey in surveys]
+
+        # Save the whole batch to DynamoDB and S3
+        try:
+            with metrics.timer("dynamodb_write"):
+                failed_results = save_results_to_dynamodb(results)
+        except Exception as e:
+            metrics.error("Unexpected error saving to DynamoDB", error=str(e))
+            failed_results = results
+        metrics.count("dynamodb_failed", len(failed_results))
+        with metrics.timer("s3_write"):
+            s3_keys, s3_failed_results = save_results_to_s3(results)
+        metrics.count("s3_failed", len(s3_failed_results))
+        unsaved = {(result["user_id"], result["timestamp"]) for result in failed_results + s3_failed_results}
+
+        # Only results that were stored are emailed; the others are emailed when a retry stores them
+        email_payloads = [{
+            "user_id": result["user_id"],
+            "timestamp": result["timestamp"], # Newest survey wins when a user's same-day emails are merged
+            "phase": result["phase"],
+            "recommendations_list": result["recommendations"] # Use the generated list
+        } for result in results if (result["user_id"], result["timestamp"]) not in unsaved]
+
+        # --- Invoke send_email_lambda ---
+        # One asynchronous invoke per batch of users
+        sent_count, failed_payloads = invoke_in_batches(lambda_client, SEND_EMAIL_LAMBDA_FUNCTION_NAME, email_payloads)
+    except Exception:
+        idempotency.release_surveys("rec", surveys)
+        raise
+    failed_keys = unsaved | {(payload["user_id"], payload["timestamp"]) for payload in failed_payloads}
+    failed = [survey for survey in surveys if (survey.get("user_id"), survey.get("timestamp")) in failed_keys]
+    idempotency.complete_surveys("rec", [survey for survey in surveys
+                                         if (survey.get("user_id"), survey.get("timestamp")) not in failed_keys])
+    idempotency.release_surveys("rec", failed)
+    metrics.count("processed", len(results) - len(failed))
+    metrics.emit()
+    if failed:
+        # A successful async invoke is never retried: fail it so the released surveys are redone
+        raise IncompleteBatchError(f"{len(failed)} of {len(results)} results could not be saved or emailed "
+                                   f"(DynamoDB: {len(failed_results)}, S3: {len(s3_failed_results)}, "
+                                   f"send_email_lambda: {len(failed_payloads)})")
+
+    if not is_batch:
+        email_payload = email_payloads[0]
+        return {
+            "statusCode": 200,
+            "body": json.dumps({
+                "user_id": email_payload["user_id"],
+                "phase": email_payload["phase"],
+                "recommendations": email_payload["recommendations_list"],
+                "status": "Processed, recommendations generated, saved, and email sending initiated."
+            })
+        }
 
     return {
         "statusCode": 200,
         "body": json.dumps({
-            "user_id": user_id,
-            "phase": phase,
-            "recommendations": recommendations_list,
-            "status": "Processed, recommendations generated, saved, and email sending initiated."
+            "processed": len(email_payloads),
+            "dynamodb_failed": len(failed_results),
+            "s3_objects": s3_keys,
+            "emails_initiated": sent_count,
+            "emails_failed": len(failed_payloads),
+            "status": "Batch processed, recommendations generated, saved, and email sending initiated."
         })
     }
\ No newline at end of file
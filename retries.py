@@ -0,0 +1,58 @@
+# retries.py - shared retry helpers for the pipeline's AWS calls.
+# backoff() is exponential backoff with full jitter. batch_write() sends Put/Delete requests with
+# BatchWriteItem and retries what DynamoDB didn't take: UnprocessedItems and throttled requests
+# are sent again with backoff, any other error gives up on the requests it hit. The boto3 clients
+# already retry throttled calls a few times themselves (aws_clients.MAX_ATTEMPTS); this covers
+# partial failures and throttling that outlasts those attempts.
+import random
+import time
+from botocore.exceptions import ClientError
+import instrumentation
+
+BACKOFF_BASE_SECONDS = 0.05
+BACKOFF_MAX_SECONDS = 2.0
+MAX_RETRIES = 5
+# DynamoDB limit: 25 requests per BatchWriteItem
+BATCH_WRITE_SIZE = 25
+THROTTLE_CODES = ("ProvisionedThroughputExceededException", "ThrottlingException", "RequestLimitExceeded")
+
+
+def backoff(attempt, base=BACKOFF_BASE_SECONDS, cap=BACKOFF_MAX_SECONDS):
+    time.sleep(random.uniform(0, min(cap, base * 2 ** attempt)))
+
+
+def batch_write(dynamodb, table_name, requests, what="items", max_retries=MAX_RETRIES,
+                base=BACKOFF_BASE_SECONDS, cap=BACKOFF_MAX_SECONDS, count_as=None):
+    # dynamodb is a client or resource; requests are [{"PutRequest": ...} / {"DeleteRequest": ...}]
+    # in its format. Retries are counted in dynamodb_retries, and every BatchWriteItem call in
+    # count_as if given. Returns the requests that could not be written.
+    metrics = instrumentation.current()
+    requests = list(requests)
+    failed = []
+    for start in range(0, len(requests), BATCH_WRITE_SIZE):
+        pending = requests[start:start + BATCH_WRITE_SIZE]
+        attempt = 0
+        while pending:
+            try:
+                response = dynamodb.batch_write_item(RequestItems={table_name: pending})
+                pending = response.get("UnprocessedItems", {}).get(table_name, [])
+            except ClientError as e:
+                if e.response["Error"]["Code"] not in THROTTLE_CODES:
+                    metrics.error(f"Error writing {what} to DynamoDB", table=table_name, requests=len(pending), error=str(e))
+                    break
+            except Exception as e:
+                metrics.error(f"Unexpected error writing {what} to DynamoDB", table=table_name, requests=len(pending), error=str(e))
+                break
+            finally:
+                if count_as:
+                    metrics.count(count_as)
+            if not pending:
+                break
+            if attempt >= max_retries:
+                metrics.error(f"Giving up on unprocessed {what}", table=table_name, requests=len(pending), retries=attempt)
+                break
+            metrics.count("dynamodb_retries")
+            backoff(attempt, base, cap)
+            attempt += 1
+        failed.extend(pending)
+    return failed
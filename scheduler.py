@@ -0,0 +1,276 @@
+# scheduler.py - spreads recommendation emails over each user's morning delivery window.
+# Instead of publishing to SNS as soon as rec_lambda hands over a result, send_email_lambda
+# enqueues it here with a send slot: a minute inside the user's window (DEFAULT_SEND_HOUR for
+# DELIVERY_WINDOW_MINUTES, in their time zone), picked from a hash of the user ID so a morning
+# upload of every survey spreads evenly over the window. A scheduled drain
+# (send_email_lambda.drain_handler, every minute, reserved concurrency 1) sends what is due,
+# at most DRAIN_MAX_SENDS per run.
+#
+# The queue is one DynamoDB item per user per local day, keyed (user_id, send_date), holding
+# just what the message needs (phase and recommendations). A second result for the same day
+# replaces the pending one, so the user gets one email with their latest result; the put is
+# conditional on survey_order (the survey timestamp in sortable form), so an older survey
+# delivered later, e.g. by a parallel send_email_lambda invocation, never replaces it. Every write
+# gets a new version, and the drain only deletes or reschedules the version it read, so a result
+# merged in while a send is going out is kept for the next drain. The DueSends
+# index (due_day, slot) lets the drain Query what is due instead of scanning; due_day is
+# "<UTC date>#<shard>" so one day's sends don't share a single index partition.
+# Items left behind (e.g. the drain was off for days) expire through TTL on expires_at.
+#
+# Results that arrive after the window closed are sent on the next drain (sends_after_window);
+# sends_late counts those slotted inside their window but sent after it, i.e. the drain fell behind.
+import os
+import uuid
+import zlib
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from botocore.exceptions import ClientError
+import instrumentation
+import aws_clients
+
+SEND_SCHEDULER_ENABLED = os.environ.get("SEND_SCHEDULER_ENABLED", "true").lower() == "true"
+SEND_QUEUE_TABLE_NAME = os.environ.get("SEND_QUEUE_TABLE_NAME", "CyclicalBetaSendQueue")
+DUE_INDEX = "DueSends"
+DUE_INDEX_SHARDS = int(os.environ.get("SEND_QUEUE_SHARDS", 4))
+# Used for users without a time_zone / send_hour / window_minutes in the email directory
+DEFAULT_TIME_ZONE = os.environ.get("DEFAULT_TIME_ZONE", "America/Chicago")
+DEFAULT_SEND_HOUR = int(os.environ.get("DEFAULT_SEND_HOUR", 8))
+DELIVERY_WINDOW_MINUTES = int(os.environ.get("DELIVERY_WINDOW_MINUTES", 120))
+# Sends per drain run; at one run a minute this caps the SNS rate however many are due
+DRAIN_MAX_SENDS = int(os.environ.get("DRAIN_MAX_SENDS", 600))
+# How far back the drain looks for due sends
+DRAIN_LOOKBACK_DAYS = int(os.environ.get("DRAIN_LOOKBACK_DAYS", 2))
+MAX_SEND_ATTEMPTS = int(os.environ.get("MAX_SEND_ATTEMPTS", 3))
+RETRY_DELAY_MINUTES = 5
+SEND_QUEUE_TTL_SECONDS = int(os.environ.get("SEND_QUEUE_TTL_SECONDS", 3 * 24 * 3600))
+
+# Slots are UTC minutes, which sort as strings
+SLOT_FORMAT = "%Y-%m-%dT%H:%M"
+
+dynamodb = aws_clients.resource("dynamodb")
+
+_zones = {}
+
+
+def utcnow():
+    return datetime.now(timezone.utc)
+
+
+def _zone(name):
+    # ZoneInfo for an IANA name, falling back to DEFAULT_TIME_ZONE for unknown names
+    zone = _zones.get(name)
+    if zone is None:
+        try:
+            zone = ZoneInfo(name)
+        except (ZoneInfoNotFoundError, ValueError):
+            zone = ZoneInfo(DEFAULT_TIME_ZONE)
+        _zones[name] = zone
+    return zone
+
+
+def _slot(moment):
+    return moment.astimezone(timezone.utc).strftime(SLOT_FORMAT)
+
+
+def _parse_slot(slot):
+    return datetime.strptime(slot, SLOT_FORMAT).replace(tzinfo=timezone.utc)
+
+
+def _shard(user_id):
+    return zlib.crc32(str(user_id).encode("utf-8")) % DUE_INDEX_SHARDS
+
+
+def plan(user_id, preferences=None, now=None):
+    # Returns (send_date, slot, window_end) for a result arriving now: the user's local date,
+    # the UTC minute to send it and the end of their delivery window (also a UTC minute)
+    preferences = preferences or {}
+    now = now or utcnow()
+    local_now = now.astimezone(_zone(preferences.get("time_zone") or DEFAULT_TIME_ZONE))
+    window = int(preferences.get("window_minutes") or DELIVERY_WINDOW_MINUTES)
+    send_hour = preferences.get("send_hour")
+    start = local_now.replace(hour=int(DEFAULT_SEND_HOUR if send_hour is None else send_hour),
+                              minute=0, second=0, microsecond=0)
+    end = start + timedelta(minutes=window)
+    spread = zlib.crc32(str(user_id).encode("utf-8"))
+    if local_now < start:
+        send_at = start + timedelta(minutes=spread % window)
+    elif local_now < end:
+        # Spread over what is left of the window
+        send_at = local_now + timedelta(minutes=spread % max(1, int((end - local_now).total_seconds() // 60)))
+    else:
+        send_at = local_now
+    return local_now.date().isoformat(), _slot(send_at), _slot(end)
+
+
+def enqueue(sends, now=None, table_name=None):
+    # sends: [{"user_id", "phase", "recommendations", "timestamp", "preferences"}]. Writes one
+    # queue item per user per local day; of several results for the same day the newest survey
+    # wins, whether they arrive together or not. Returns the slot of each send, or None for those
+    # that could not be queued (the caller sends those right away). A send older than the one
+    # already queued is merged into it and gets its own planned slot back.
+    table = dynamodb.Table(table_name or SEND_QUEUE_TABLE_NAME)
+    metrics = instrumentation.current()
+    now = now or utcnow()
+    enqueued_at = int(now.timestamp())
+    keys = []
+    items = {}
+    for send in sends:
+        send_date, slot, window_end = plan(send["user_id"], send.get("preferences"), now)
+        key = (send["user_id"], send_date)
+        keys.append(key)
+        newer = key not in items or _survey_order(send) >= _survey_order(items[key])
+        if key in items:
+            metrics.count("sends_merged")
+        if newer:
+            items[key] = {
+                "user_id": send["user_id"],
+                "send_date": send_date,
+                "slot": slot,
+                "due_day": f"{slot[:10]}#{_shard(send['user_id'])}",
+                "window_end": window_end,
+                "phase": send["phase"],
+                "recommendations": list(send["recommendations"]),
+                "enqueued_at": enqueued_at,
+                "expires_at": enqueued_at + SEND_QUEUE_TTL_SECONDS,
+                "version": uuid.uuid4().hex,
+                "survey_order": _survey_order(send),
+            }
+            if send.get("timestamp"):
+                items[key]["timestamp"] = send["timestamp"]
+    outcomes = {}
+    for key, item in items.items():
+        # Items queued before survey_order existed are replaced
+        outcomes[key] = _write_if(table.put_item, item, "attribute_not_exists(user_id) OR "
+                                  "attribute_not_exists(survey_order) OR survey_order < :order",
+                                  {":order": item["survey_order"]}, Item=item)
+    counts = Counter(outcomes.values())
+    metrics.count("send_queue_writes", counts["written"] + counts["superseded"])
+    metrics.count("sends_enqueued", counts["written"])
+    metrics.count("sends_merged", counts["superseded"])
+    metrics.count("sends_after_window", sum(items[key]["slot"] > items[key]["window_end"]
+                                            for key, outcome in outcomes.items() if outcome == "written"))
+    metrics.count("send_queue_errors", counts["error"])
+    return [None if outcomes[key] == "error" else items[key]["slot"] for key in keys]
+
+
+def _survey_order(send):
+    # Surveys are ordered by their timestamp (MMDDYYHHMMSS); results without one count as newest
+    timestamp = send.get("timestamp")
+    if not timestamp:
+        return "~"
+    return timestamp[4:6] + timestamp[:4] + timestamp[6:]
+
+
+def take_due(now=None, limit=None, table_name=None):
+    # Returns (sends, depth): the oldest due sends, at most limit of them, and how many are due in
+    # all. Raises ClientError if the queue can't be read.
+    table = dynamodb.Table(table_name or SEND_QUEUE_TABLE_NAME)
+    now = now or utcnow()
+    limit = DRAIN_MAX_SENDS if limit is None else limit
+    due = []
+    for days_back in range(DRAIN_LOOKBACK_DAYS, -1, -1):
+        day = (now - timedelta(days=days_back)).strftime("%Y-%m-%d")
+        for shard in range(DUE_INDEX_SHARDS):
+            request = {"IndexName": DUE_INDEX, "KeyConditionExpression": "due_day = :day AND slot <= :now",
+                       "ExpressionAttributeValues": {":day": f"{day}#{shard}", ":now": _slot(now)}}
+            while True:
+                response = table.query(**request)
+                due.extend(response.get("Items", []))
+                if "LastEvaluatedKey" not in response:
+                    break
+                request["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+    due.sort(key=lambda send: send["slot"])
+    return due[:limit], len(due)
+
+
+def _write_if(write, send, condition, values, **request):
+    # Runs a put_item/delete_item under a condition on the queued item. Returns "written",
+    # "superseded" (the condition failed: the queue holds a newer result) or "error".
+    try:
+        write(ConditionExpression=condition, ExpressionAttributeValues=values, **request)
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            return "superseded"
+        instrumentation.current().error("Error writing send queue", user_id=send["user_id"],
+                                        send_date=send["send_date"], error=str(e))
+        return "error"
+    except Exception as e:
+        instrumentation.current().error("Unexpected error writing send queue", user_id=send["user_id"],
+                                        send_date=send["send_date"], error=str(e))
+        return "error"
+    return "written"
+
+
+def _if_unchanged(write, send, **request):
+    # Runs a put_item/delete_item only if the queue item is still the version take_due() returned
+    return _write_if(write, send, "version = :version", {":version": send.get("version")}, **request)
+
+
+def complete(sent, failed, now=None, table_name=None):
+    # Removes sent items from the queue and moves failed ones RETRY_DELAY_MINUTES (times the
+    # attempt) later; after MAX_SEND_ATTEMPTS they are dropped. Returns the number dropped.
+    # An item replaced by a newer result since take_due() is left alone (sends_superseded), so
+    # that result goes out on a later drain.
+    table = dynamodb.Table(table_name or SEND_QUEUE_TABLE_NAME)
+    metrics = instrumentation.current()
+    now = now or utcnow()
+    outcomes = Counter()
+    dropped = 0
+    for send in sent:
+        key = {"user_id": send["user_id"], "send_date": send["send_date"]}
+        outcomes[_if_unchanged(table.delete_item, send, Key=key)] += 1
+    for send in failed:
+        attempts = int(send.get("attempts", 0)) + 1
+        if attempts >= MAX_SEND_ATTEMPTS:
+            metrics.error("Giving up on scheduled email", user_id=send["user_id"], send_date=send["send_date"],
+                          attempts=attempts)
+            key = {"user_id": send["user_id"], "send_date": send["send_date"]}
+            outcomes[_if_unchanged(table.delete_item, send, Key=key)] += 1
+            dropped += 1
+            continue
+        slot = _slot(now + timedelta(minutes=RETRY_DELAY_MINUTES * attempts))
+        item = dict(send, slot=slot, due_day=f"{slot[:10]}#{_shard(send['user_id'])}", attempts=attempts)
+        outcomes[_if_unchanged(table.put_item, send, Item=item)] += 1
+    metrics.count("send_queue_writes", outcomes["written"] + outcomes["superseded"])
+    metrics.count("sends_dropped", dropped)
+    metrics.count("sends_superseded", outcomes["superseded"])
+    metrics.count("send_queue_errors", outcomes["error"])
+    return dropped
+
+
+def report(metrics, sent, depth, now=None):
+    # Queue depth (sends due this run, including those left for the next) and send lag (how long
+    # after its slot each send went out), as metrics and a log line
+    now = now or utcnow()
+    lags = sorted((now - _parse_slot(send["slot"])).total_seconds() for send in sent)
+    late = sum(send["slot"] <= send["window_end"] < _slot(now) for send in sent)
+    metrics.gauge("send_queue_depth", depth)
+    metrics.count("sends_late", late)
+    fields = {"due": depth, "sent": len(sent), "late": late}
+    if lags:
+        for name, value in (("p50", lags[len(lags) // 2]),
+                            ("p95", lags[min(len(lags) - 1, int(len(lags) * 0.95))]),
+                            ("max", lags[-1])):
+            metrics.gauge(f"send_lag_{name}", value, "Seconds")
+            fields[f"lag_{name}_s"] = round(value, 1)
+    metrics.log("Drained send queue", **fields)
+    return fields
+
+
+def table_definition(table_name=None):
+    # CreateTable arguments for the queue (on-demand, so idle hours cost nothing)
+    return {
+        "TableName": table_name or SEND_QUEUE_TABLE_NAME,
+        "KeySchema": [{"AttributeName": "user_id", "KeyType": "HASH"},
+                      {"AttributeName": "send_date", "KeyType": "RANGE"}],
+        "AttributeDefinitions": [{"AttributeName": name, "AttributeType": "S"}
+                                 for name in ("user_id", "send_date", "due_day", "slot")],
+        "GlobalSecondaryIndexes": [{
+            "IndexName": DUE_INDEX,
+            "KeySchema": [{"AttributeName": "due_day", "KeyType": "HASH"},
+                          {"AttributeName": "slot", "KeyType": "RANGE"}],
+            "Projection": {"ProjectionType": "ALL"},
+        }],
+        "BillingMode": "PAY_PER_REQUEST",
+    }
@@ -1,13 +1,23 @@
 # send_email_lambda.py (NEW Lambda Function - Using SNS for Email Sending)
 import json
-import boto3
 import os
+import time
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from botocore.exceptions import ClientError
 from decimal import Decimal # Needed if processing data that might contain decimals
+from batching import unpack_event
+import instrumentation
+import aws_clients
+import codec
+import message_templates
+import retries
+import scheduler
 
 # Initialize clients
-s3_client = boto3.client("s3")
-sns_client = boto3.client("sns", region_name="us-east-1") # <--- Initialize SNS client
+s3_client = aws_clients.client("s3")
+sns_client = aws_clients.client("sns") # Region comes from the environment (see aws_clients.py)
 
 # Configuration for the S3 bucket where user_emails.json is stored
 S3_CONFIG_BUCKET = "final-summer99d"
@@ -23,6 +33,26 @@ S3_USER_EMAILS_KEY = "config/user_email.json"
 SNS_EMAIL_TOPIC_ARN = "arn:aws:sns:us-east-1:544835564974:daily_recs" 
 
 
+# --- Email Directory Cache ---
+# The directory is kept in module scope so warm invocations reuse it. After
+# EMAIL_DIRECTORY_TTL_SECONDS it is revalidated with a conditional GET (If-None-Match),
+# which costs no download when the object is unchanged. If that refresh fails, the cached copy
+# keeps being served until the next TTL; only a directory that was never loaded skips emails.
+EMAIL_DIRECTORY_TTL_SECONDS = float(os.environ.get("EMAIL_DIRECTORY_TTL_SECONDS", 300))
+# "single": one list at S3_USER_EMAILS_KEY
+# "sharded": lists split by user_id hash under S3_USER_EMAILS_PREFIX (see build_sharded_directory)
+# "per_user": one {"user_id": ..., "email": ...} object per user under S3_USER_EMAILS_PREFIX
+EMAIL_DIRECTORY_LAYOUT = os.environ.get("EMAIL_DIRECTORY_LAYOUT", "single")
+EMAIL_DIRECTORY_SHARDS = int(os.environ.get("EMAIL_DIRECTORY_SHARDS", 16))
+S3_USER_EMAILS_PREFIX = "config/user_email/"
+
+# S3 key -> {"index": {user_id: email}, "preferences": {user_id: {...}}, "etag": ..., "checked_at": ...}
+_email_directory_cache = {}
+DIRECTORY_STATS = {"hits": 0, "misses": 0, "refreshes": 0, "not_modified": 0, "stale": 0, "s3_reads": 0}
+# Counter values already reported in an earlier invocation's metrics
+_reported_directory_stats = {}
+_reported_render_stats = {}
+
 # Helper function to find user email from the loaded JSON list
 def get_user_email_from_config(user_id, email_config_list):
     for entry in email_config_list:
@@ -30,101 +60,454 @@ def get_user_email_from_config(user_id, email_config_list):
             return entry.get("email")
     return None
 
-def lambda_handler(event, context):
-    print(f"Received event for send_email_lambda: {json.dumps(event)}")
-
-    # Extract data from the event payload (sent by rec_lambda)
-    user_id = event.get("user_id")
-    phase = event.get("phase")
-    recommendations_list = event.get("recommendations_list")
-
-    if not user_id or not phase or not recommendations_list:
-        print("Error: Missing required data in event payload (user_id, phase, or recommendations_list).")
-        return {
-            'statusCode': 400,
-            'body': json.dumps('Missing required data.')
-        }
+def build_email_index(email_config_list):
+    # user_id -> email; keeps the first entry per user, like get_user_email_from_config
+    if isinstance(email_config_list, dict):
+        email_config_list = [email_config_list]
+    index = {}
+    for entry in email_config_list:
+        index.setdefault(entry.get("user_id"), entry.get("email"))
+    return index
+
+# Optional per-user delivery settings in a directory entry, used by the send scheduler
+PREFERENCE_FIELDS = ("time_zone", "send_hour", "window_minutes")
+
+def build_preference_index(email_config_list):
+    # user_id -> {"time_zone": ..., ...} for the entries that set any PREFERENCE_FIELDS
+    if isinstance(email_config_list, dict):
+        email_config_list = [email_config_list]
+    preferences = {}
+    for entry in email_config_list:
+        fields = {name: entry[name] for name in PREFERENCE_FIELDS if entry.get(name) is not None}
+        if fields:
+            preferences.setdefault(entry.get("user_id"), fields)
+    return preferences
+
+def directory_key_for(user_id):
+    if EMAIL_DIRECTORY_LAYOUT == "sharded":
+        shard = zlib.crc32(user_id.encode("utf-8")) % EMAIL_DIRECTORY_SHARDS
+        return f"{S3_USER_EMAILS_PREFIX}shard-{shard:03d}.json"
+    if EMAIL_DIRECTORY_LAYOUT == "per_user":
+        return f"{S3_USER_EMAILS_PREFIX}{user_id}.json"
+    return S3_USER_EMAILS_KEY
+
+def build_sharded_directory(email_config_list):
+    # Splits a user_email.json list into {S3 key: entries} for the sharded layout
+    shards = {}
+    for entry in email_config_list:
+        shards.setdefault(directory_key_for(entry.get("user_id")), []).append(entry)
+    return shards
 
-    # --- Step 1: Read user_emails.json from S3 ---
-    user_emails_config = []
+def _is_error(e, codes):
+    return e.response.get("Error", {}).get("Code") in codes
+
+def _serve_stale(key, entry, now, error):
+    # A refresh failed but an earlier copy is cached: use it, and try again after the next TTL
+    DIRECTORY_STATS["stale"] += 1
+    entry["checked_at"] = now
+    instrumentation.current().error("Error refreshing user emails config. Using the cached copy.",
+                                    object=f"s3://{S3_CONFIG_BUCKET}/{key}", error=str(error))
+    return entry["index"]
+
+def _get_email_directory(key):
+    # Returns the cached user_id -> email index for an S3 key, loading or revalidating it as needed.
+    # Raises ClientError / json.JSONDecodeError if the object cannot be loaded and nothing is cached.
+    entry = _email_directory_cache.get(key)
+    now = time.monotonic()
+    if entry is not None and now - entry["checked_at"] < EMAIL_DIRECTORY_TTL_SECONDS:
+        DIRECTORY_STATS["hits"] += 1
+        return entry["index"]
+
+    request = {"Bucket": S3_CONFIG_BUCKET, "Key": key}
+    if entry is None:
+        DIRECTORY_STATS["misses"] += 1
+    else:
+        DIRECTORY_STATS["refreshes"] += 1
+        if entry["etag"]:
+            request["IfNoneMatch"] = entry["etag"]
+
+    DIRECTORY_STATS["s3_reads"] += 1
     try:
-        response = s3_client.get_object(Bucket=S3_CONFIG_BUCKET, Key=S3_USER_EMAILS_KEY)
-        user_emails_config_body = response['Body'].read().decode('utf-8')
-        user_emails_config = json.loads(user_emails_config_body)
-        print(f"Successfully loaded user emails config from s3://{S3_CONFIG_BUCKET}/{S3_USER_EMAILS_KEY}")
+        response = s3_client.get_object(**request)
     except ClientError as e:
-        print(f"Error loading user emails config from S3: {str(e)}. Cannot send emails.")
-        return {
-            "statusCode": 200,
-            "body": json.dumps({"user_id": user_id, "status": "Email skipped (config load error)."})
-        }
+        if entry is not None and _is_error(e, ("304", "NotModified")):
+            DIRECTORY_STATS["not_modified"] += 1
+            entry["checked_at"] = now
+            return entry["index"]
+        if EMAIL_DIRECTORY_LAYOUT != "single" and _is_error(e, ("NoSuchKey", "404")):
+            # Missing shard / user object: remember that nobody is there until the next refresh
+            _email_directory_cache[key] = {"index": {}, "preferences": {}, "etag": None, "checked_at": now}
+            return {}
+        if entry is not None:
+            return _serve_stale(key, entry, now, e)
+        raise
+
+    try:
+        user_emails_config = codec.loads(response['Body'].read())
     except json.JSONDecodeError as e:
-        print(f"Error decoding user emails config JSON: {str(e)}. Cannot send emails.")
-        return {
-            "statusCode": 200,
-            "body": json.dumps({"user_id": user_id, "status": "Email skipped (config JSON error)."})
-        }
+        if entry is not None:
+            return _serve_stale(key, entry, now, e)
+        raise
+    index = build_email_index(user_emails_config)
+    _email_directory_cache[key] = {"index": index, "preferences": build_preference_index(user_emails_config),
+                                   "etag": response.get("ETag"), "checked_at": now}
+    instrumentation.current().log("Loaded user emails", users=len(index), object=f"s3://{S3_CONFIG_BUCKET}/{key}")
+    return index
+
+# --- Step 1: Look up the user's email in the directory (user_email.json in S3) ---
+# Returns (user_email, error_status); error_status is None unless the directory could not be loaded
+def find_user_email(user_id):
+    metrics = instrumentation.current()
+    try:
+        with metrics.timer("directory_lookup"):
+            return _get_email_directory(directory_key_for(user_id)).get(user_id), None
+    except ClientError as e:
+        metrics.error("Error loading user emails config from S3. Cannot send emails.", error=str(e))
+        return None, "Email skipped (config load error)."
+    except json.JSONDecodeError as e:
+        metrics.error("Error decoding user emails config JSON. Cannot send emails.", error=str(e))
+        return None, "Email skipped (config JSON error)."
     except Exception as e:
-        print(f"Unexpected error loading user emails config: {str(e)}. Cannot send emails.")
-        return {
-            "statusCode": 200,
-            "body": json.dumps({"user_id": user_id, "status": "Email skipped (unexpected config error)."})
+        metrics.error("Unexpected error loading user emails config. Cannot send emails.", error=str(e))
+        return None, "Email skipped (unexpected config error)."
+
+# The user's delivery settings from the directory ({} if none); call after find_user_email,
+# which loads the directory
+def delivery_preferences(user_id):
+    entry = _email_directory_cache.get(directory_key_for(user_id))
+    return entry["preferences"].get(user_id, {}) if entry else {}
+
+def get_directory_stats():
+    return dict(DIRECTORY_STATS, cached_keys=len(_email_directory_cache))
+
+# --- SNS Delivery ---
+# "batch": emails are gathered and sent with PublishBatch (10 per call) over a thread pool
+# "publish": one Publish call per user
+SNS_DELIVERY_MODE = os.environ.get("SNS_DELIVERY_MODE", "batch")
+SNS_BATCH_SIZE = 10  # PublishBatch limit
+SNS_MAX_WORKERS = int(os.environ.get("SNS_MAX_WORKERS", 4))
+# PublishBatch calls per second (and burst) allowed across all workers
+SNS_PUBLISH_RATE = float(os.environ.get("SNS_PUBLISH_RATE", 100))
+SNS_PUBLISH_BURST = int(os.environ.get("SNS_PUBLISH_BURST", 20))
+SNS_MAX_RETRIES = int(os.environ.get("SNS_MAX_RETRIES", 5))
+SNS_BACKOFF_BASE_SECONDS = 0.1
+SNS_BACKOFF_MAX_SECONDS = 5.0
+SNS_THROTTLE_CODES = ("Throttling", "ThrottlingException", "Throttled", "TooManyRequestsException", "KMSThrottling")
+
+class TokenBucket:
+    # Thread-safe token bucket: acquire() blocks until a token is available
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+# Shared by every invocation in this container
+_publish_limiter = TokenBucket(SNS_PUBLISH_RATE, SNS_PUBLISH_BURST)
+
+def _message_attributes(user_id, phase):
+    # MessageAttributes used by the topic's subscription filter policies
+    return {
+        'user_id': { # Name of the attribute to filter on
+            'DataType': 'String', # Data type must be String, Number, or Binary
+            'StringValue': user_id # The actual user_id for this message
+        },
+        'phase': { # Optional: You could also filter by phase
+            'DataType': 'String',
+            'StringValue': phase
         }
+    }
+
+def _address_not_found_result(user_id):
+    instrumentation.current().log_record("Skipping email: Email address not found in config file for this user_id.", user_id=user_id)
+    instrumentation.current().skip("Address not found")
+    return {
+        "statusCode": 200,
+        "body": json.dumps({"user_id": user_id, "status": "Email skipped (address not found)."})
+    }
+
+def _email_result(user_id, phase, recommendations_list, email_status):
+    return {
+        "statusCode": 200,
+        "body": json.dumps({
+            "user_id": user_id,
+            "phase": phase,
+            "recommendations": recommendations_list,
+            "status": f"Recommendations sent, {email_status}"
+        })
+    }
 
-    # --- Step 2: Find the user's email address ---
+def _scheduled_result(user_id, phase, recommendations_list, slot):
+    return {
+        "statusCode": 200,
+        "body": json.dumps({
+            "user_id": user_id,
+            "phase": phase,
+            "recommendations": recommendations_list,
+            "status": f"Recommendations scheduled, email queued for {slot} UTC."
+        })
+    }
+
+def send_recommendation_email(user_id, phase, recommendations_list, user_email_for_logging):
+    # --- Step 2: Check the user's email address ---
     # For SNS email, you subscribe the email address to the topic.
     # The publish is then done to the topic.
     # So, we just need to ensure the user_email is valid to proceed,
     # but the actual "To" address is handled by SNS subscriptions.
     # We'll still retrieve it for logging/confirmation.
-    user_email_for_logging = get_user_email_from_config(user_id, user_emails_config)
-
+    metrics = instrumentation.current()
     if not user_email_for_logging:
-        print(f"Skipping email for user {user_id}: Email address not found in config file for this user_id.")
-        return {
-            "statusCode": 200,
-            "body": json.dumps({"user_id": user_id, "status": "Email skipped (address not found)."})
-        }
-
+        return _address_not_found_result(user_id)
 
     # --- Step 3: Send Recommendations via SNS Publish to Topic ---
-    # ... (recommendations_html, recommendations_text, subject, sns_message definition) ...
+    # Rendered once per phase and cached in the container; only the user ID is filled in here
+    sns_message, subject = message_templates.render(user_id, phase, recommendations_list)
 
     try:
-        response = sns_client.publish(
-            TopicArn=SNS_EMAIL_TOPIC_ARN,
-            Message=json.dumps(sns_message),
-            Subject=subject,
-            MessageStructure='json',
-            # --- NEW: Add MessageAttributes for filtering ---
-            MessageAttributes={
-                'user_id': { # Name of the attribute to filter on
-                    'DataType': 'String', # Data type must be String, Number, or Binary
-                    'StringValue': user_id # The actual user_id for this message
-                },
-                'phase': { # Optional: You could also filter by phase
-                    'DataType': 'String',
-                    'StringValue': phase
-                }
-            }
-        )
-        print(f"Email sent successfully via SNS to topic {SNS_EMAIL_TOPIC_ARN} for user {user_id} (email: {user_email_for_logging}). MessageId: {response['MessageId']}")
+        with metrics.timer("sns_publish"):
+            response = sns_client.publish(
+                TopicArn=SNS_EMAIL_TOPIC_ARN,
+                Message=sns_message,
+                Subject=subject,
+                MessageStructure='json',
+                # --- NEW: Add MessageAttributes for filtering ---
+                MessageAttributes=_message_attributes(user_id, phase)
+            )
+        metrics.log_record("Email sent successfully via SNS", topic=SNS_EMAIL_TOPIC_ARN, user_id=user_id,
+                           email=user_email_for_logging, message_id=response['MessageId'])
+        metrics.count("sent")
         email_status = f"Email sent via SNS to topic {SNS_EMAIL_TOPIC_ARN}."
 
     except ClientError as e:
-        # ... (rest of error handling) ...
-        print(f"Error sending email via SNS for user {user_id} (email: {user_email_for_logging}): {str(e)}")
+        metrics.error("Error sending email via SNS", user_id=user_id, email=user_email_for_logging, error=str(e))
+        metrics.count("send_errors")
         email_status = f"Email failed via SNS: {str(e)}"
     except Exception as e:
-        print(f"Unexpected error in SNS email sending for user {user_id} (email: {user_email_for_logging}): {str(e)}")
+        metrics.error("Unexpected error in SNS email sending", user_id=user_id, email=user_email_for_logging, error=str(e))
+        metrics.count("send_errors")
         email_status = f"Email failed via SNS unexpectedly: {str(e)}"
 
+    return _email_result(user_id, phase, recommendations_list, email_status)
+
+def _publish_batch_with_retries(entries):
+    # Sends up to 10 entries with PublishBatch. Only entries that failed for a retryable reason
+    # (throttling, SNS-side errors) are sent again. Returns ({entry Id: status}, stats).
+    statuses = {}
+    stats = {"latencies_ms": [], "throttled": 0, "retries": 0}
+    pending = {entry["Id"]: entry for entry in entries}
+    attempt = 0
+    while pending:
+        _publish_limiter.acquire()
+        retry = {}
+        last_error = None
+        started = time.perf_counter()
+        try:
+            response = sns_client.publish_batch(TopicArn=SNS_EMAIL_TOPIC_ARN, PublishBatchRequestEntries=list(pending.values()))
+            for success in response.get("Successful", []):
+                statuses[success["Id"]] = f"Email sent via SNS to topic {SNS_EMAIL_TOPIC_ARN}."
+            for failure in response.get("Failed", []):
+                last_error = f"{failure.get('Code')}: {failure.get('Message')}"
+                if failure.get("Code") in SNS_THROTTLE_CODES:
+                    stats["throttled"] += 1
+                if failure.get("SenderFault"):
+                    statuses[failure["Id"]] = f"Email failed via SNS: {last_error}"
+                else:
+                    retry[failure["Id"]] = pending[failure["Id"]]
+        except ClientError as e:
+            last_error = str(e)
+            if e.response["Error"]["Code"] in SNS_THROTTLE_CODES:
+                stats["throttled"] += len(pending)
+                retry = pending
+            else:
+                for entry_id in pending:
+                    statuses[entry_id] = f"Email failed via SNS: {last_error}"
+        except Exception as e:
+            for entry_id in pending:
+                statuses[entry_id] = f"Email failed via SNS unexpectedly: {str(e)}"
+        stats["latencies_ms"].append((time.perf_counter() - started) * 1000)
+
+        pending = retry
+        if pending:
+            if attempt >= SNS_MAX_RETRIES:
+                for entry_id in pending:
+                    statuses[entry_id] = f"Email failed via SNS after {attempt} retries: {last_error}"
+                break
+            stats["retries"] += 1
+            retries.backoff(attempt, SNS_BACKOFF_BASE_SECONDS, SNS_BACKOFF_MAX_SECONDS)
+            attempt += 1
+    return statuses, stats
+
+def deliver_batch(pending):
+    # pending: [(user_id, phase, recommendations_list)]. Sends them with PublishBatch over a bounded
+    # thread pool, rate limited by the shared token bucket. Returns one email status per item.
+    metrics = instrumentation.current()
+    entries = []
+    for i, (user_id, phase, recommendations_list) in enumerate(pending):
+        sns_message, subject = message_templates.render(user_id, phase, recommendations_list)
+        entries.append({
+            "Id": str(i),
+            "Message": sns_message,
+            "Subject": subject,
+            "MessageStructure": "json",
+            "MessageAttributes": _message_attributes(user_id, phase)
+        })
+    batches = [entries[i:i + SNS_BATCH_SIZE] for i in range(0, len(entries), SNS_BATCH_SIZE)]
+
+    statuses = {}
+    latencies = []
+    with metrics.timer("sns_publish_batch"):
+        with ThreadPoolExecutor(max_workers=max(1, min(SNS_MAX_WORKERS, len(batches)))) as pool:
+            for batch_statuses, stats in pool.map(_publish_batch_with_retries, batches):
+                statuses.update(batch_statuses)
+                latencies.extend(stats["latencies_ms"])
+                metrics.count("sns_throttled", stats["throttled"])
+                metrics.count("sns_retries", stats["retries"])
+
+    sent = sum(status.startswith("Email sent") for status in statuses.values())
+    metrics.count("sns_batches", len(batches))
+    metrics.count("sent", sent)
+    metrics.count("send_errors", len(entries) - sent)
+    if latencies:
+        latencies.sort()
+        metrics.log("SNS batch delivery", messages=len(entries), batches=len(batches), calls=len(latencies),
+                    sent=sent, throttled=metrics.counters["sns_throttled"],
+                    p50_ms=round(latencies[len(latencies) // 2], 3),
+                    p95_ms=round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 3),
+                    max_ms=round(latencies[-1], 3))
+    return [statuses[entry["Id"]] for entry in entries]
+
+def _report_cache_stats(metrics):
+    for name, value in DIRECTORY_STATS.items():
+        metrics.count(f"directory_{name}", value - _reported_directory_stats.get(name, 0))
+    _reported_directory_stats.update(DIRECTORY_STATS)
+    for name, value in message_templates.RENDER_STATS.items():
+        metrics.count(f"template_{name}", value - _reported_render_stats.get(name, 0))
+    _reported_render_stats.update(message_templates.RENDER_STATS)
+
+def lambda_handler(event, context):
+    metrics = instrumentation.start("send_email_lambda", event)
+    metrics.log_record("Received event for send_email_lambda", event=event)
+
+    # Accepts either a single recommendation or a batch event {"surveys": [...]} from rec_lambda
+    items, is_batch = unpack_event(event)
+    metrics.count("received", len(items))
+
+    results = []
+    scheduled = []
+    pending = []
+    for item in items:
+        # Extract data from the event payload (sent by rec_lambda)
+        user_id = item.get("user_id")
+        phase = item.get("phase")
+        recommendations_list = item.get("recommendations_list")
+
+        if not user_id or not phase or not recommendations_list:
+            metrics.error("Missing required data in event payload (user_id, phase, or recommendations_list).")
+            metrics.skip("Missing required data")
+            results.append({
+                'statusCode': 400,
+                'body': json.dumps('Missing required data.')
+            })
+            continue
+
+        # Served from the warm-container directory cache; S3 is only read on a miss or after the TTL
+        user_email, config_error = find_user_email(user_id)
+        if config_error:
+            metrics.skip("Config error")
+            results.append({
+                "statusCode": 200,
+                "body": json.dumps({"user_id": user_id, "status": config_error})
+            })
+            continue
+        if not user_email:
+            results.append(_address_not_found_result(user_id))
+            continue
+
+        if scheduler.SEND_SCHEDULER_ENABLED:
+            # Queued below for the user's delivery window; drain_handler sends it
+            scheduled.append((len(results), user_id, phase, recommendations_list, item.get("timestamp")))
+            results.append(None)
+        elif SNS_DELIVERY_MODE == "batch":
+            # Sent together below; keep this item's slot in the results
+            pending.append((len(results), user_id, phase, recommendations_list))
+            results.append(None)
+        else:
+            results.append(send_recommendation_email(user_id, phase, recommendations_list, user_email))
+
+    if scheduled:
+        try:
+            with metrics.timer("send_queue_write"):
+                slots = scheduler.enqueue([{
+                    "user_id": user_id, "phase": phase, "recommendations": recommendations_list,
+                    "timestamp": timestamp, "preferences": delivery_preferences(user_id)
+                } for _, user_id, phase, recommendations_list, timestamp in scheduled])
+        except Exception as e:
+            metrics.error("Unexpected error queueing emails. Sending them now.", emails=len(scheduled), error=str(e))
+            slots = [None] * len(scheduled)
+        for (index, user_id, phase, recommendations_list, _), slot in zip(scheduled, slots):
+            if slot is None:
+                # Not queued: send it now rather than lose it
+                pending.append((index, user_id, phase, recommendations_list))
+            else:
+                results[index] = _scheduled_result(user_id, phase, recommendations_list, slot)
+
+    if pending:
+        statuses = deliver_batch([item[1:] for item in pending])
+        for (index, user_id, phase, recommendations_list), email_status in zip(pending, statuses):
+            results[index] = _email_result(user_id, phase, recommendations_list, email_status)
+
+    _report_cache_stats(metrics)
+    metrics.emit()
+
+    if not is_batch:
+        return results[0]
+
     return {
         "statusCode": 200,
         "body": json.dumps({
-            "user_id": user_id,
-            "phase": phase,
-            "recommendations": recommendations_list,
-            "status": f"Recommendations sent, {email_status}"
+            "received": len(items),
+            "email_directory": get_directory_stats(),
+            "results": [json.loads(result["body"]) for result in results]
         })
-    }
\ No newline at end of file
+    }
+
+# --- Scheduled delivery ---
+# Runs every minute from an EventBridge rule as its own function (send_scheduler in the
+# notebook) with reserved concurrency 1, so two drains never send the same item
+def drain_handler(event, context):
+    metrics = instrumentation.start("send_scheduler", event)
+    now = scheduler.utcnow()
+    try:
+        with metrics.timer("send_queue_read"):
+            due, depth = scheduler.take_due(now)
+    except ClientError as e:
+        metrics.error("Error reading send queue", error=str(e))
+        metrics.emit()
+        raise
+
+    statuses = deliver_batch([(send["user_id"], send["phase"], send["recommendations"]) for send in due]) if due else []
+    sent = [send for send, status in zip(due, statuses) if status.startswith("Email sent")]
+    failed = [send for send, status in zip(due, statuses) if not status.startswith("Email sent")]
+    with metrics.timer("send_queue_write"):
+        dropped = scheduler.complete(sent, failed, now)
+    summary = scheduler.report(metrics, sent, depth, now)
+    _report_cache_stats(metrics)
+    metrics.emit()
+
+    return {
+        "statusCode": 200,
+        "body": json.dumps(dict(summary, failed=len(failed), dropped=dropped))
+    }
@@ -0,0 +1,211 @@
+# survey_index.py - query access to CyclicalBetaSurvey by date and by phase.
+# The table's sort key (timestamp, MMDDYYHHMMSS) doesn't sort across months or years, so
+# rec_lambda also writes two index attributes with every item:
+#   surveyed_at  ISO date-time (YYYY-MM-DDTHH:MM:SS), sort key of the UserHistory index
+#   phase_day    "<date>#<phase>#<shard>", partition key of the PhaseDay index
+# history() and users_in_phase() answer "last 30 days for a user" and "who is in Luteal today"
+# with paginated Queries that read only the matching items instead of scanning the table.
+# Every user's PhaseDay entries for a day go to one of PHASE_INDEX_SHARDS partitions, so a busy
+# day doesn't put every write on a single index partition; users_in_phase() queries each shard.
+#
+# Items written before the index attributes existed are migrated with:
+#   python survey_index.py backfill --segments 8
+# Other commands:
+#   python survey_index.py create-indexes                  # add the GSIs to an existing table
+#   python survey_index.py history user_000001 --since 2024-05-01
+#   python survey_index.py phase 2024-05-03 Luteal
+import argparse
+import os
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+
+import aws_clients
+import codec
+
+TABLE_NAME = os.environ.get("SURVEY_TABLE_NAME", "CyclicalBetaSurvey")
+HISTORY_INDEX = "UserHistory"
+PHASE_INDEX = "PhaseDay"
+PHASE_INDEX_SHARDS = int(os.environ.get("PHASE_INDEX_SHARDS", 4))
+# Index name -> (partition key, sort key, projection). history() needs whole items;
+# users_in_phase() only needs the keys.
+INDEXES = {
+    HISTORY_INDEX: ("user_id", "surveyed_at", "ALL"),
+    PHASE_INDEX: ("phase_day", "user_id", "KEYS_ONLY"),
+}
+# Matches the table's own provisioned throughput in the notebook
+INDEX_THROUGHPUT = {"ReadCapacityUnits": 5, "WriteCapacityUnits": 5}
+BACKFILL_SEGMENTS = int(os.environ.get("BACKFILL_SEGMENTS", 4))
+INDEX_POLL_SECONDS = 15
+
+dynamodb = aws_clients.resource("dynamodb")
+dynamodb_client = aws_clients.client("dynamodb")
+
+
+def surveyed_at(timestamp):
+    # MMDDYYHHMMSS -> YYYY-MM-DDTHH:MM:SS, or None if the timestamp doesn't parse
+    try:
+        return datetime.strptime(timestamp, "%m%d%y%H%M%S").isoformat()
+    except (TypeError, ValueError):
+        return None
+
+
+def phase_day(day, phase, user_id):
+    shard = zlib.crc32(str(user_id).encode("utf-8")) % PHASE_INDEX_SHARDS
+    return f"{day}#{phase}#{shard}"
+
+
+def index_attributes(item):
+    # The index attributes for a result, or {} if its timestamp doesn't parse (the item is then
+    # left out of both indexes)
+    at = surveyed_at(item.get("timestamp"))
+    if at is None:
+        return {}
+    return {"surveyed_at": at, "phase_day": phase_day(at[:10], item.get("phase"), item.get("user_id"))}
+
+
+def _iso(value):
+    # date and datetime (a subclass of date) as ISO strings; strings pass through
+    return value.isoformat() if isinstance(value, date) else str(value)
+
+
+def _query(table, **request):
+    # Runs a Query to the end, following LastEvaluatedKey; yields the items
+    while True:
+        response = table.query(**request)
+        yield from response.get("Items", [])
+        if "LastEvaluatedKey" not in response:
+            return
+        request["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def history(user_id, since=None, table_name=None):
+    # A user's results, oldest first, optionally only those surveyed on or after since
+    # (a date, datetime or ISO string)
+    table = dynamodb.Table(table_name or TABLE_NAME)
+    request = {"IndexName": HISTORY_INDEX, "ExpressionAttributeValues": {":user_id": user_id}}
+    if since is None:
+        request["KeyConditionExpression"] = "user_id = :user_id"
+    else:
+        request["KeyConditionExpression"] = "user_id = :user_id AND surveyed_at >= :since"
+        request["ExpressionAttributeValues"][":since"] = _iso(since)
+    return list(_query(table, **request))
+
+
+def users_in_phase(day, phase, table_name=None):
+    # Sorted IDs of the users whose survey on day (a date or YYYY-MM-DD) was classified as phase
+    table = dynamodb.Table(table_name or TABLE_NAME)
+    day = _iso(day)[:10]
+    users = set()
+    for shard in range(PHASE_INDEX_SHARDS):
+        users.update(item["user_id"] for item in _query(
+            table, IndexName=PHASE_INDEX, KeyConditionExpression="phase_day = :phase_day",
+            ExpressionAttributeValues={":phase_day": f"{day}#{phase}#{shard}"}))
+    return sorted(users)
+
+
+# --- Backfill ---
+def _backfill_segment(table_name, segment, total_segments):
+    table = dynamodb.Table(table_name)
+    request = {"Segment": segment, "TotalSegments": total_segments,
+               "ProjectionExpression": "user_id, #ts, phase, surveyed_at, phase_day",
+               "ExpressionAttributeNames": {"#ts": "timestamp"}}
+    stats = {"scanned": 0, "updated": 0, "skipped": 0}
+    while True:
+        response = table.scan(**request)
+        for item in response.get("Items", []):
+            stats["scanned"] += 1
+            attributes = index_attributes(item)
+            if not attributes:
+                stats["skipped"] += 1
+                continue
+            if all(item.get(name) == value for name, value in attributes.items()):
+                continue
+            table.update_item(
+                Key={"user_id": item["user_id"], "timestamp": item["timestamp"]},
+                UpdateExpression="SET surveyed_at = :surveyed_at, phase_day = :phase_day",
+                ExpressionAttributeValues={":surveyed_at": attributes["surveyed_at"],
+                                           ":phase_day": attributes["phase_day"]}
+            )
+            stats["updated"] += 1
+        if "LastEvaluatedKey" not in response:
+            return stats
+        request["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def backfill(table_name=None, total_segments=None):
+    # Writes the index attributes onto every item that lacks them (or has stale ones) with a
+    # parallel segmented scan. Safe to run again; up-to-date items are not rewritten.
+    table_name = table_name or TABLE_NAME
+    total_segments = total_segments or BACKFILL_SEGMENTS
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=total_segments) as pool:
+        segments = list(pool.map(lambda segment: _backfill_segment(table_name, segment, total_segments),
+                                 range(total_segments)))
+    summary = {name: sum(stats[name] for stats in segments) for name in ("scanned", "updated", "skipped")}
+    summary["seconds"] = round(time.perf_counter() - started, 3)
+    return summary
+
+
+def index_definitions():
+    # GlobalSecondaryIndexes entries for CreateTable / UpdateTable
+    return [{
+        "IndexName": name,
+        "KeySchema": [{"AttributeName": partition_key, "KeyType": "HASH"},
+                      {"AttributeName": sort_key, "KeyType": "RANGE"}],
+        "Projection": {"ProjectionType": projection},
+        "ProvisionedThroughput": INDEX_THROUGHPUT,
+    } for name, (partition_key, sort_key, projection) in INDEXES.items()]
+
+
+def create_indexes(table_name=None):
+    # Adds the missing GSIs to an existing table. DynamoDB builds one index at a time per table,
+    # so this waits for each to become ACTIVE before starting the next.
+    table_name = table_name or TABLE_NAME
+    attribute_definitions = [{"AttributeName": name, "AttributeType": "S"}
+                             for name in ("user_id", "surveyed_at", "phase_day")]
+    created = []
+    for definition in index_definitions():
+        existing = dynamodb_client.describe_table(TableName=table_name)["Table"].get("GlobalSecondaryIndexes", [])
+        if any(index["IndexName"] == definition["IndexName"] for index in existing):
+            continue
+        dynamodb_client.update_table(TableName=table_name, AttributeDefinitions=attribute_definitions,
+                                     GlobalSecondaryIndexUpdates=[{"Create": definition}])
+        while True:
+            indexes = dynamodb_client.describe_table(TableName=table_name)["Table"].get("GlobalSecondaryIndexes", [])
+            if all(index["IndexStatus"] == "ACTIVE" for index in indexes):
+                break
+            time.sleep(INDEX_POLL_SECONDS)
+        created.append(definition["IndexName"])
+    return created
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query and maintain the survey table's date and phase indexes.")
+    parser.add_argument("--table", default=TABLE_NAME)
+    commands = parser.add_subparsers(dest="command", required=True)
+    backfill_parser = commands.add_parser("backfill", help="Write the index attributes onto existing items")
+    backfill_parser.add_argument("--segments", type=int, default=BACKFILL_SEGMENTS)
+    commands.add_parser("create-indexes", help="Add the GSIs to an existing table")
+    history_parser = commands.add_parser("history", help="A user's results, oldest first")
+    history_parser.add_argument("user_id")
+    history_parser.add_argument("--since", help="YYYY-MM-DD or an ISO date-time")
+    phase_parser = commands.add_parser("phase", help="Users in a phase on a day")
+    phase_parser.add_argument("day", help="YYYY-MM-DD")
+    phase_parser.add_argument("phase")
+    args = parser.parse_args()
+
+    if args.command == "backfill":
+        result = backfill(args.table, args.segments)
+    elif args.command == "create-indexes":
+        result = {"created": create_indexes(args.table)}
+    elif args.command == "history":
+        result = history(args.user_id, args.since, args.table)
+    else:
+        result = users_in_phase(args.day, args.phase, args.table)
+    print(codec.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
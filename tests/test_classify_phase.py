@@ -0,0 +1,101 @@
+# Checks cat_lambda's compiled phase table against the scoring rules it replaced, for every
+# combination of numeric answers and symptoms, with q5 both as a plain list and as the
+# {"symptoms": [...], "additional": ...} dict verify forwards.
+#   python -m pytest tests/test_classify_phase.py
+import itertools
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cat_lambda
+
+SYMPTOMS = cat_lambda.MENSTRUATION_SYMPTOMS + cat_lambda.LUTEAL_SYMPTOMS + cat_lambda.OVULATION_SYMPTOMS
+
+
+def baseline_classify_phase(res):
+    # classify_phase as it was before the lookup table, unchanged
+    bleeding = res.get("q1")
+    mucus = res.get("q2")
+    libido = res.get("q3")
+    mood = res.get("q4")
+    symptoms = res.get("q5", [])
+    energy = res.get("q6")
+
+    menstruation_symptoms = ["Cramps", "Lower back pain", "Headache or migraine"]
+    luteal_symptoms = ["Bloating", "Breast tenderness", "Breast fullness or swelling", "Digestive issues", "Acne or skin breakouts"]
+    ovulation_symptoms = ["Feeling hot or flushed", "Egg-white consistency mucus", "High libido"]
+
+    score = {"Menstruation": 0, "Luteal": 0, "Ovulation": 0, "Follicular": 0}
+
+    if bleeding is not None:
+        if bleeding >= 2:
+            score["Menstruation"] += 3
+        elif bleeding == 1:
+            score["Luteal"] += 1
+
+    if mucus is not None and libido is not None:
+        if mucus == 4 or libido >= 4:
+            score["Ovulation"] += 2
+        elif mucus in [2, 3]:
+            score["Follicular"] += 1
+
+    if energy is not None:
+        if energy in [1, 2]:
+            score["Menstruation"] += 1
+            score["Luteal"] += 1
+        elif energy >= 4:
+            score["Ovulation"] += 1
+            score["Follicular"] += 1
+
+    for symptom in symptoms:
+        if symptom in menstruation_symptoms:
+            score["Menstruation"] += 1
+        elif symptom in luteal_symptoms:
+            score["Luteal"] += 1
+        elif symptom in ovulation_symptoms:
+            score["Ovulation"] += 1
+
+    assigned_phase = max(score, key=score.get)
+    return assigned_phase
+
+
+def symptom_subsets():
+    for size in range(len(SYMPTOMS) + 1):
+        for subset in itertools.combinations(SYMPTOMS, size):
+            yield list(subset)
+
+
+def test_every_combination_matches_baseline():
+    subsets = list(symptom_subsets())
+    checked = 0
+    for q1, q2, q3, q6 in itertools.product(cat_lambda.Q1_VALUES, cat_lambda.Q2_VALUES,
+                                            cat_lambda.Q3_VALUES, cat_lambda.Q6_VALUES):
+        listed = [{"q1": q1, "q2": q2, "q3": q3, "q4": 3, "q5": symptoms, "q6": q6} for symptoms in subsets]
+        expected = [baseline_classify_phase(res) for res in listed]
+        wrapped = [dict(res, q5={"symptoms": res["q5"], "additional": ""}) for res in listed]
+        for batch in (listed, wrapped):
+            assert [cat_lambda.classify_phase(res) for res in batch] == expected, (q1, q2, q3, q6)
+            assert cat_lambda.classify_phases(batch) == expected, (q1, q2, q3, q6)
+            checked += len(batch)
+    assert checked == 2 * len(subsets) * 6 ** 4
+
+
+def test_inputs_outside_the_table_match_baseline():
+    # Unknown and repeated symptoms, missing q5 and out-of-range answers take the rule fallback
+    cases = [
+        {"q1": 2, "q2": 1, "q3": 1, "q5": ["Cramps", "Cramps", "Bloating"], "q6": 1},
+        {"q1": 0, "q2": 4, "q3": 2, "q5": ["Fatigue", "High libido"], "q6": 5},
+        {"q1": 7, "q2": 2, "q3": 9, "q6": 4},
+        {"q1": 1.5, "q2": 3, "q3": 3, "q5": [], "q6": 0},
+        {},
+    ]
+    for res in cases:
+        assert cat_lambda.classify_phase(res) == baseline_classify_phase(res), res
+        assert cat_lambda.classify_phases([res]) == [baseline_classify_phase(res)], res
+
+
+if __name__ == "__main__":
+    test_every_combination_matches_baseline()
+    test_inputs_outside_the_table_match_baseline()
+    print("ok")
@@ -0,0 +1,126 @@
+# Checks rec_lambda's bulk persistence against the local AWS stand-ins: every result reaches
+# DynamoDB in BatchWriteItem requests even when DynamoDB hands items back unprocessed or throttles,
+# results it can't write are returned, and S3 gets one gzip JSON lines object per survey date.
+#   python -m pytest tests/test_persistence.py
+import gzip
+import json
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark
+import instrumentation
+import local_aws
+import rec_lambda
+import retries
+
+RECORDS = 2000
+
+
+def make_results(records=RECORDS, seed=0):
+    rng = random.Random(seed)
+    return [rec_lambda.build_result(dict(survey, phase=rng.choice(benchmark.PHASES)))
+            for survey in benchmark.generate_surveys(records, seed, 0)]
+
+
+def stand_ins(monkeypatch):
+    aws = benchmark.install_stand_ins(1000)
+    monkeypatch.setattr(rec_lambda, "DYNAMO_BACKOFF_BASE_SECONDS", 0)
+    instrumentation.start("test", {})
+    return aws
+
+
+def stored_keys(aws):
+    return set(aws["dynamodb"].Table(rec_lambda.DYNAMO_TABLE_NAME).items)
+
+
+def test_unprocessed_items_are_retried_until_stored(monkeypatch):
+    aws = stand_ins(monkeypatch)
+    results = make_results()
+    keys = {(result["user_id"], result["timestamp"]) for result in results}
+    rng = random.Random(1)
+    batch_write_item = aws["dynamodb"].batch_write_item
+    calls = []
+
+    def with_unprocessed(RequestItems, **kwargs):
+        # 30% of every request comes back as UnprocessedItems
+        calls.append(RequestItems)
+        written, unprocessed = {}, {}
+        for table_name, requests in RequestItems.items():
+            for request in requests:
+                (unprocessed if rng.random() < 0.3 else written).setdefault(table_name, []).append(request)
+        batch_write_item(RequestItems=written)
+        return {"UnprocessedItems": unprocessed}
+
+    aws["dynamodb"].batch_write_item = with_unprocessed
+    assert rec_lambda.save_results_to_dynamodb(results) == []
+    assert stored_keys(aws) == keys
+    assert all(len(requests) <= retries.BATCH_WRITE_SIZE for call in calls for requests in call.values())
+    # Far fewer requests than one put_item per result, and a few retries on top of the minimum
+    assert -(-len(keys) // retries.BATCH_WRITE_SIZE) < len(calls) < len(keys) // 2
+    assert aws["dynamodb"].calls["put_item"] == 0
+
+
+def test_throttled_requests_are_retried(monkeypatch):
+    aws = stand_ins(monkeypatch)
+    results = make_results(100)
+    batch_write_item = aws["dynamodb"].batch_write_item
+    throttles = [3]
+
+    def throttled(RequestItems, **kwargs):
+        if throttles[0]:
+            throttles[0] -= 1
+            raise local_aws.client_error("ProvisionedThroughputExceededException", "BatchWriteItem")
+        return batch_write_item(RequestItems=RequestItems)
+
+    aws["dynamodb"].batch_write_item = throttled
+    assert rec_lambda.save_results_to_dynamodb(results) == []
+    assert len(stored_keys(aws)) == len(results)
+
+
+def test_results_that_cannot_be_written_are_returned(monkeypatch):
+    aws = stand_ins(monkeypatch)
+    results = make_results(60)
+
+    def broken(RequestItems, **kwargs):
+        raise local_aws.client_error("ValidationException", "BatchWriteItem")
+
+    aws["dynamodb"].batch_write_item = broken
+    failed = rec_lambda.save_results_to_dynamodb(results)
+    assert sorted((r["user_id"], r["timestamp"]) for r in failed) == sorted((r["user_id"], r["timestamp"]) for r in results)
+    assert not stored_keys(aws)
+
+
+def test_s3_gets_one_object_per_survey_date(monkeypatch):
+    aws = stand_ins(monkeypatch)
+    results = make_results()
+    keys, failed = rec_lambda.save_results_to_s3(results)
+    dates = {rec_lambda._result_date(result) for result in results}
+    assert failed == [] and len(keys) == len(dates) == aws["s3"].calls["put_object"] - 1
+    rows = []
+    for key in keys:
+        lines = gzip.decompress(aws["s3"].objects[(rec_lambda.S3_BUCKET, key)]).splitlines()
+        date = key.split("date=")[1].split("/")[0]
+        rows.extend(json.loads(line) for line in lines)
+        assert {rec_lambda._result_date(json.loads(line)) for line in lines} == {date}
+    assert sorted((r["user_id"], r["timestamp"]) for r in rows) == sorted((r["user_id"], r["timestamp"]) for r in results)
+
+
+def test_s3_failures_return_their_results(monkeypatch):
+    aws = stand_ins(monkeypatch)
+    results = make_results(200)
+    put_object = aws["s3"].put_object
+    broken_date = rec_lambda._result_date(results[0])
+
+    def put_or_fail(**kwargs):
+        if f"date={broken_date}/" in kwargs["Key"]:
+            raise local_aws.client_error("InternalError", "PutObject")
+        return put_object(**kwargs)
+
+    aws["s3"].put_object = put_or_fail
+    keys, failed = rec_lambda.save_results_to_s3(results)
+    assert failed and all(rec_lambda._result_date(result) == broken_date for result in failed)
+    assert len(failed) == sum(rec_lambda._result_date(result) == broken_date for result in results)
+    assert all(f"date={broken_date}/" not in key for key in keys)
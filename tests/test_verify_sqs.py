@@ -0,0 +1,138 @@
+# Drives verify's SQS consumer through the local SQS, S3 and Lambda stand-ins: partial batch
+# failure reporting, messages a retry can't fix (a body that isn't JSON, a missing S3 object)
+# being skipped rather than failed, and duplicate surveys being forwarded only once.
+#   python -m pytest tests/test_verify_sqs.py
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aws_clients
+import benchmark
+import invoker
+import local_aws
+import verify
+
+BUCKET = "survey-uploads"
+
+
+def stand_ins(monkeypatch):
+    aws = benchmark.install_stand_ins(100)
+    monkeypatch.setattr(invoker, "BACKOFF_BASE_SECONDS", 0)
+    queue = local_aws.LocalSQS("arn:aws:sqs:us-east-1:000000000000:survey-queue")
+    return aws, queue
+
+
+def surveys(count, seed=0):
+    # generate_surveys draws time_elapsed at random, so pin it to one that always validates
+    return [dict(survey, time_elapsed=30.0)
+            for survey in benchmark.generate_surveys(count, seed, invalid_rate=0, users=100)]
+
+
+def s3_notification(key):
+    return json.dumps({"Records": [{"s3": {"bucket": {"name": BUCKET}, "object": {"key": key}}}]})
+
+
+def forwarded(aws):
+    # (user_id, timestamp) of every survey verify sent to cat_lambda
+    return [(survey["user_id"], survey["timestamp"])
+            for event in aws["lambda"].take(verify.CAT_LAMBDA_FUNCTION_NAME) for survey in event["surveys"]]
+
+
+def keys(batch):
+    return sorted((survey["user_id"], survey["timestamp"]) for survey in batch)
+
+
+def failed_ids(response):
+    return [failure["itemIdentifier"] for failure in response["batchItemFailures"]]
+
+
+def test_unfixable_messages_are_skipped_not_failed(monkeypatch):
+    aws, queue = stand_ins(monkeypatch)
+    raw, array, uploaded = surveys(1, seed=1), surveys(5, seed=2), surveys(20, seed=3)
+    aws["s3"].put_object(Bucket=BUCKET, Key="raw_surveys/day.json", Body=json.dumps(uploaded))
+    queue.send_message(QueueUrl="", MessageBody=json.dumps(raw[0]))
+    queue.send_message(QueueUrl="", MessageBody=json.dumps(array))
+    queue.send_message(QueueUrl="", MessageBody="{not json")
+    queue.send_message(QueueUrl="", MessageBody=s3_notification("raw_surveys/missing.json"))
+    queue.send_message(QueueUrl="", MessageBody=s3_notification("raw_surveys/day.json"))
+
+    event = queue.poll_event()
+    response = verify.lambda_handler(event, None)
+    assert failed_ids(response) == []
+    assert queue.complete(event, response) == 0 and not queue.messages
+    assert sorted(forwarded(aws)) == keys(raw + array + uploaded)
+
+
+def test_only_messages_with_retryable_failures_are_reported(monkeypatch):
+    aws, queue = stand_ins(monkeypatch)
+    good, slow = surveys(10, seed=1), surveys(10, seed=2)
+    aws["s3"].put_object(Bucket=BUCKET, Key="raw_surveys/good.json", Body=json.dumps(good))
+    aws["s3"].put_object(Bucket=BUCKET, Key="raw_surveys/slow.json", Body=json.dumps(slow))
+    get_object = aws["s3"].get_object
+
+    def slow_down(Bucket, Key, **kwargs):
+        if Key == "raw_surveys/slow.json":
+            raise local_aws.client_error("SlowDown", "GetObject", "Please reduce your request rate.")
+        return get_object(Bucket=Bucket, Key=Key, **kwargs)
+
+    aws["s3"].get_object = slow_down
+    queue.send_message(QueueUrl="", MessageBody=s3_notification("raw_surveys/good.json"))
+    queue.send_message(QueueUrl="", MessageBody=s3_notification("raw_surveys/slow.json"))
+    event = queue.poll_event()
+    response = verify.lambda_handler(event, None)
+    assert failed_ids(response) == [event["Records"][1]["messageId"]]
+    assert queue.complete(event, response) == 1
+    assert sorted(forwarded(aws)) == keys(good)
+
+    # The redelivered message goes through once S3 recovers
+    aws["s3"].get_object = get_object
+    event = queue.poll_event()
+    assert event["Records"][0]["attributes"]["ApproximateReceiveCount"] == "2"
+    response = verify.lambda_handler(event, None)
+    assert failed_ids(response) == [] and queue.complete(event, response) == 0
+    assert sorted(forwarded(aws)) == keys(slow)
+
+
+def test_messages_whose_surveys_could_not_be_forwarded_fail(monkeypatch):
+    aws, queue = stand_ins(monkeypatch)
+    monkeypatch.setattr(invoker, "INVOKE_OVERFLOW_QUEUE_NAME", "")
+    monkeypatch.setattr(invoker, "INVOKE_MAX_RETRIES", 0)
+    broken = local_aws.LocalLambda()
+
+    def unavailable(**kwargs):
+        raise local_aws.client_error("ServiceException", "Invoke", "Service unavailable")
+
+    broken.invoke = unavailable
+    aws_clients.register("lambda", broken)
+    batch = surveys(3)
+    queue.send_message(QueueUrl="", MessageBody=json.dumps(batch))
+    queue.send_message(QueueUrl="", MessageBody="{not json")
+    event = queue.poll_event()
+    response = verify.lambda_handler(event, None)
+    assert failed_ids(response) == [event["Records"][0]["messageId"]]
+    queue.complete(event, response)
+
+    # The failed surveys' claims were released, so the retry forwards them
+    aws_clients.register("lambda", aws["lambda"])
+    event = queue.poll_event()
+    response = verify.lambda_handler(event, None)
+    assert failed_ids(response) == []
+    assert sorted(forwarded(aws)) == keys(batch)
+
+
+def test_duplicate_surveys_are_forwarded_once(monkeypatch):
+    aws, queue = stand_ins(monkeypatch)
+    batch = surveys(4)
+    # The same surveys twice in one batch, then the whole batch delivered again
+    queue.send_message(QueueUrl="", MessageBody=json.dumps(batch))
+    queue.send_message(QueueUrl="", MessageBody=json.dumps(batch[:2]))
+    event = queue.poll_event()
+    response = verify.lambda_handler(event, None)
+    assert failed_ids(response) == []
+    assert sorted(forwarded(aws)) == keys(batch)
+
+    processed, skipped, failed = verify.process_sqs_records(event["Records"])
+    assert (processed, skipped, failed) == (0, 6, [])
+    assert forwarded(aws) == []
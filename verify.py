@@ -1,130 +1,601 @@
 import json
-import boto3
+import codecs
+import time
 from decimal import Decimal
 import os
 from datetime import datetime # Needed for timestamp validation
+from itertools import compress
+from urllib.parse import unquote_plus
 from botocore.exceptions import ClientError
+from batching import invoke_in_batches, BATCH_SIZE, ForwardingError
+from invoker import InvokeExecutor
+import instrumentation
+import idempotency
+import aws_clients
+import codec
 
-s3_client = boto3.client('s3')
-lambda_client = boto3.client('lambda') # To invoke cat_lambda
+s3_client = aws_clients.client('s3')
+lambda_client = aws_clients.client('lambda') # To invoke cat_lambda
 
 # Define the name of the categorization Lambda function
 CAT_LAMBDA_FUNCTION_NAME = 'cat_lambda'
 
-def lambda_handler(event, context):
-    print(f"Received event: {json.dumps(event)}")
-    
+# S3 bodies are read in chunks of this size instead of all at once
+STREAM_CHUNK_SIZE = int(os.environ.get("STREAM_CHUNK_SIZE", 64 * 1024))
+# A single questionnaire larger than this is treated as malformed, which bounds the parse buffer
+MAX_RECORD_CHARS = int(os.environ.get("MAX_RECORD_CHARS", 1024 * 1024))
+
+_WHITESPACE = ' \t\n\r'
+_ARRAY_SEPARATORS = _WHITESPACE + ','
+
+
+def iter_questionnaires(chunks):
+    # Incrementally parses questionnaires from an iterable of byte chunks. Accepts either a
+    # JSON array of objects or newline-delimited JSON (one object per line).
+    # Yields (questionnaire, error) pairs; error is a message for a record that could not be parsed.
+    # Raises json.JSONDecodeError if a JSON array is malformed, since it cannot be resynchronized.
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buffer, pos, eof = '', 0, False
+    is_array = None
+
+    while True:
+        # Skip separators, pulling in more data as needed
+        separators = _ARRAY_SEPARATORS if is_array else _WHITESPACE
+        while pos < len(buffer) and buffer[pos] in separators:
+            pos += 1
+        if pos == len(buffer):
+            if eof:
+                break
+            chunk = next(chunks, None)
+            buffer, pos = utf8.decode(chunk or b'', final=chunk is None), 0
+            eof = chunk is None
+            continue
+
+        if is_array is None:
+            is_array = buffer[pos] == '['
+            if is_array:
+                pos += 1
+            continue
+        if is_array and buffer[pos] == ']':
+            return
+
+        try:
+            questionnaire, pos = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError as e:
+            if not eof and len(buffer) - pos <= MAX_RECORD_CHARS:
+                # Most likely the record is split across chunks: read more and retry
+                chunk = next(chunks, None)
+                buffer, pos = buffer[pos:] + utf8.decode(chunk or b'', final=chunk is None), 0
+                eof = chunk is None
+                continue
+            if is_array:
+                raise
+            # A bad line in newline-delimited JSON only loses that line
+            newline = buffer.find('\n', pos)
+            yield None, f"JSON decode error: {str(e)}"
+            if newline == -1:
+                buffer, pos = '', 0
+                # Drop the rest of the oversized line
+                while not eof:
+                    chunk = next(chunks, None)
+                    eof = chunk is None
+                    text = utf8.decode(chunk or b'', final=eof)
+                    newline = text.find('\n')
+                    if newline != -1:
+                        buffer = text[newline + 1:]
+                        break
+            else:
+                pos = newline + 1
+            continue
+
+        yield questionnaire, None
+
+    if is_array:
+        raise json.JSONDecodeError("Unexpected end of data: JSON array is not closed", buffer, pos)
+
+
+def validate_questionnaire(questionnaire):
+    # Returns (cat_lambda_payload, validation_reason); the payload is None for invalid entries
+    time_elapsed = questionnaire.get('time_elapsed', 0)
+    user_id = questionnaire.get('user_id', '').strip()
+    timestamp = questionnaire.get('timestamp', '').strip()
+
+    is_valid = True
+    validation_reason = []
+
+    if not isinstance(time_elapsed, (int, float)) or time_elapsed < 5.0: # Changed min_time_elapsed to 5s as per earlier discussion
+        is_valid = False
+        validation_reason.append(f"Invalid time_elapsed={time_elapsed} (must be >= 5).")
+
+    if not user_id:
+        is_valid = False
+        validation_reason.append("Missing user_id.")
+
+    if not timestamp:
+        is_valid = False
+        validation_reason.append("Missing timestamp.")
+    else:
+        try:
+            # Ensure timestamp is in correct format (MMDDYYHHMMSS)
+            datetime.strptime(timestamp, "%m%d%y%H%M%S")
+        except ValueError:
+            is_valid = False
+            validation_reason.append(f"Invalid timestamp format={timestamp} (expected MMDDYYHHMMSS).")
+
+    responses = {k.lower(): v for k, v in questionnaire.get("responses", {}).items()}
+    if not responses:
+        is_valid = False
+        validation_reason.append("Responses object is empty.")
+    elif not all(q in responses for q in ["q1", "q2", "q3", "q4", "q5", "q6"]):
+        is_valid = False
+        validation_reason.append("Missing one or more core questions (q1-q6).")
+    else:
+        q5_data = responses.get("q5", {})
+        if not q5_data.get("symptoms") and not q5_data.get("additional"):
+            is_valid = False
+            validation_reason.append("Q5 is empty: No symptoms or additional comments provided.")
+
+    if not is_valid:
+        return None, validation_reason
+
+    # Prepare payload for cat_lambda (should match what cat_lambda expects)
+    cat_lambda_payload = {
+        'user_id': user_id,
+        'timestamp': timestamp,
+        'time_elapsed': time_elapsed,
+        'responses': responses  # Normalized lowercase keys
+}
+    return cat_lambda_payload, validation_reason
+
+
+def reason_code(message):
+    # Validation messages embed the offending value; the part before it is the metric dimension
+    return message.split("=")[0].rstrip(".")
+
+
+# --- Columnar validation ---
+# The checks in validate_questionnaire as a declarative rule set. Each rule is applied to a
+# whole column of a batch with map(), so a batch costs a handful of C-level passes instead of
+# a chain of Python calls per record. The messages are exactly validate_questionnaire's.
+MIN_TIME_ELAPSED = 5.0
+CORE_QUESTIONS = ("q1", "q2", "q3", "q4", "q5", "q6")
+# Number of parsed questionnaires validated together
+VALIDATION_BATCH_SIZE = int(os.environ.get("VALIDATION_BATCH_SIZE", 1000))
+
+_DAYS_IN_MONTH = (0, 31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+
+def _timestamp_ok(timestamp):
+    # Checks a zero-padded MMDDYYHHMMSS value arithmetically; anything else
+    # (Feb 29, unpadded or non-ASCII digits) is settled by strptime as before
+    if len(timestamp) == 12 and timestamp.isascii() and timestamp.isdigit():
+        value, second = divmod(int(timestamp), 100)
+        value, minute = divmod(value, 100)
+        value, hour = divmod(value, 100)
+        month, day = divmod(value // 100, 100)
+        if (1 <= month <= 12 and 1 <= day <= _DAYS_IN_MONTH[month] and (month != 2 or day < 29)
+                and hour < 24 and minute < 60 and second < 60):
+            return True
+    try:
+        datetime.strptime(timestamp, "%m%d%y%H%M%S")
+        return True
+    except ValueError:
+        return False
+
+
+def _invalid_time_elapsed(value):
+    return not isinstance(value, (int, float)) or value < MIN_TIME_ELAPSED
+
+
+def _is_empty(value):
+    return not value
+
+
+def _invalid_timestamp(value):
+    return bool(value) and not _timestamp_ok(value)
+
+
+def _missing_core_questions(responses):
+    return bool(responses) and not all(q in responses for q in CORE_QUESTIONS)
+
+
+def _empty_q5(responses):
+    if not responses or not all(q in responses for q in CORE_QUESTIONS):
+        return False
+    q5_data = responses.get("q5", {})
+    return not q5_data.get("symptoms") and not q5_data.get("additional")
+
+
+# Column name -> how it is read from a questionnaire
+VALIDATION_COLUMNS = {
+    "time_elapsed": lambda q: q.get('time_elapsed', 0),
+    "user_id": lambda q: q.get('user_id', '').strip(),
+    "timestamp": lambda q: q.get('timestamp', '').strip(),
+    "responses": lambda q: {k.lower(): v for k, v in q.get("responses", {}).items()},
+}
+
+# (column, check, message) in the order validate_questionnaire reports them; {value} is the column value
+VALIDATION_RULES = (
+    ("time_elapsed", _invalid_time_elapsed, "Invalid time_elapsed={value} (must be >= 5)."),
+    ("user_id", _is_empty, "Missing user_id."),
+    ("timestamp", _is_empty, "Missing timestamp."),
+    ("timestamp", _invalid_timestamp, "Invalid timestamp format={value} (expected MMDDYYHHMMSS)."),
+    ("responses", _is_empty, "Responses object is empty."),
+    ("responses", _missing_core_questions, "Missing one or more core questions (q1-q6)."),
+    ("responses", _empty_q5, "Q5 is empty: No symptoms or additional comments provided."),
+)
+
+
+def _compile_rules(columns, rules):
+    # Resolves column names to positions once, so validate_batch only indexes lists
+    names = list(columns)
+    return ([columns[name] for name in names],
+            [(names.index(column), check, message, "{value}" in message) for column, check, message in rules])
+
+
+_COLUMN_READERS, _COMPILED_RULES = _compile_rules(VALIDATION_COLUMNS, VALIDATION_RULES)
+_TIME_ELAPSED, _USER_ID, _TIMESTAMP, _RESPONSES = (list(VALIDATION_COLUMNS).index(name) for name in
+                                                   ("time_elapsed", "user_id", "timestamp", "responses"))
+
+
+def _apply_column(function, values, broken):
+    # map() over the whole column; only if something raises is it redone row by row,
+    # recording the rows that raised in broken
+    try:
+        return list(map(function, values))
+    except Exception:
+        results = []
+        for i, value in enumerate(values):
+            try:
+                results.append(function(value))
+            except Exception:
+                broken.add(i)
+                results.append(None)
+        return results
+
+
+def validate_batch(questionnaires):
+    # Validates a list of questionnaires column by column. Returns (valid, payloads, reasons, errors):
+    # a valid-record mask, the cat_lambda payload per record (None if invalid), each record's
+    # validation messages and {index: exception} for records validate_questionnaire would raise on.
+    questionnaires = list(questionnaires)
+    broken = set()
+    columns = [_apply_column(reader, questionnaires, broken) for reader in _COLUMN_READERS]
+
+    reasons = [[] for _ in questionnaires]
+    for column, check, message, formatted in _COMPILED_RULES:
+        values = columns[column]
+        for i in compress(range(len(values)), _apply_column(check, values, broken)):
+            reasons[i].append(message.format(value=values[i]) if formatted else message)
+
+    errors = {}
+    for i in broken:
+        # Rows the columns couldn't handle go through the row validator to fail (or pass) as before
+        try:
+            payload, reasons[i] = validate_questionnaire(questionnaires[i])
+        except Exception as e:
+            reasons[i] = []
+            errors[i] = e
+
+    valid = [not reasons[i] and i not in errors for i in range(len(questionnaires))]
+    time_elapsed, user_ids, timestamps, responses = (columns[c] for c in (_TIME_ELAPSED, _USER_ID, _TIMESTAMP, _RESPONSES))
+    payloads = [None] * len(questionnaires)
+    for i in compress(range(len(valid)), valid):
+        # Prepare payload for cat_lambda (should match what cat_lambda expects)
+        payloads[i] = {
+            'user_id': user_ids[i],
+            'timestamp': timestamps[i],
+            'time_elapsed': time_elapsed[i],
+            'responses': responses[i]  # Normalized lowercase keys
+        }
+    return valid, payloads, reasons, errors
+
+
+def check_questionnaires(entries):
+    # Validates (index, source, questionnaire) entries as one batch, logging and counting the
+    # skipped ones. Returns the cat_lambda payload for each entry, None where it was skipped.
+    metrics = instrumentation.current()
+    entries = list(entries)
+    with metrics.timer("validate"):
+        valid, payloads, reasons, errors = validate_batch(questionnaire for _, _, questionnaire in entries)
+
+    for i in compress(range(len(valid)), (not ok for ok in valid)):
+        index, source, questionnaire = entries[i]
+        if i in errors:
+            metrics.error("Error processing questionnaire. Skipping.", index=index, source=source, error=str(errors[i]))
+            metrics.skip("Processing error")
+            continue
+        metrics.log_record("Skipping questionnaire: Invalid entry", index=index,
+                           user_id=questionnaire.get('user_id', ''), reason=" ".join(reasons[i]))
+        metrics.skip(*[reason_code(reason) for reason in reasons[i]])
+    return payloads
+
+
+def claim_fresh_surveys(cat_lambda_payloads):
+    # Drops surveys an earlier delivery already forwarded. Returns (fresh_payloads, duplicate_count).
+    fresh_payloads = idempotency.claim_surveys("verify", cat_lambda_payloads)
+    duplicate_count = len(cat_lambda_payloads) - len(fresh_payloads)
+    if duplicate_count:
+        instrumentation.current().skip("Duplicate", n=duplicate_count)
+    return fresh_payloads, duplicate_count
+
+
+def survey_refs(payloads):
+    # Just the claim key of each survey, so claims can be settled without keeping the payloads
+    return [{'user_id': payload.get('user_id'), 'timestamp': payload.get('timestamp')} for payload in payloads]
+
+
+def settle_forwarded(claimed, sent_count, failed_payloads):
+    # Counts forwarded surveys and marks their claims done; failed surveys' claims are released
+    # so a retry can forward them. claimed holds the survey_refs of every survey submitted.
+    metrics = instrumentation.current()
+    metrics.count("processed", sent_count)
+    failed = {(payload.get('user_id'), payload.get('timestamp')) for payload in failed_payloads}
+    idempotency.complete_surveys("verify", [ref for ref in claimed if (ref['user_id'], ref['timestamp']) not in failed])
+    if failed_payloads:
+        metrics.skip("Invoke failed", n=len(failed_payloads))
+        idempotency.release_surveys("verify", failed_payloads)
+
+
+def forward_surveys(cat_lambda_payloads):
+    # Drops surveys an earlier delivery already forwarded, then invokes cat_lambda with the rest.
+    # Returns (sent_count, failed_payloads, duplicate_count).
+    fresh_payloads, duplicate_count = claim_fresh_surveys(cat_lambda_payloads)
+    sent_count, failed_payloads = invoke_in_batches(lambda_client, CAT_LAMBDA_FUNCTION_NAME, fresh_payloads)
+    settle_forwarded(survey_refs(fresh_payloads), sent_count, failed_payloads)
+    return sent_count, failed_payloads, duplicate_count
+
+
+def process_s3_object(bucket_name, object_key):
+    # Streams one S3 object, validating questionnaires as they are parsed and forwarding
+    # them to cat_lambda every BATCH_SIZE valid entries. The invokes run in the background while
+    # parsing continues. Returns (processed, skipped); raises ForwardingError if any valid
+    # survey couldn't be forwarded.
+    metrics = instrumentation.current()
     processed_count = 0
     skipped_count = 0
+    questionnaire_count = 0
+    bytes_read = 0
+    pending = []  # (index, source, questionnaire) waiting to be validated
+    cat_lambda_payloads = []
+    claimed = []  # survey_refs of the surveys submitted to the forwarder
+    started = time.perf_counter()
 
-    # This Lambda is triggered by an S3 PutObject event.
-    for record in event['Records']:
-        if 's3' in record:
-            bucket_name = record['s3']['bucket']['name']
-            object_key = record['s3']['object']['key']
-            print(f"Processing S3 object: s3://{bucket_name}/{object_key}")
+    def validate_pending():
+        nonlocal skipped_count
+        valid_payloads = [payload for payload in check_questionnaires(pending) if payload is not None]
+        skipped_count += len(pending) - len(valid_payloads)
+        cat_lambda_payloads.extend(valid_payloads)
+        pending.clear()
 
-            try:
-                # Get object content from S3
-                response = s3_client.get_object(Bucket=bucket_name, Key=object_key)
-                body = response['Body'].read().decode('utf-8')
-                print(f"S3 object content (first 200 chars): {body[:200]}...")
-                
-                try:
-                    # Expecting a list of questionnaire objects in the S3 file
-                    questionnaires = json.loads(body)
-                except json.JSONDecodeError as e:
-                    print(f"JSON decode error for s3://{bucket_name}/{object_key}: {str(e)}. Skipping object.")
-                    skipped_count += 1
-                    continue # Skip to the next S3 record if JSON is invalid
-                
-                if not isinstance(questionnaires, list):
-                    print(f"Error: Expected a list of questionnaires in s3://{bucket_name}/{object_key}, but got {type(questionnaires)}. Skipping object.")
+    def flush(final=False):
+        # Queues full batches for cat_lambda, keeping any remainder for the next flush unless
+        # this is the last one
+        nonlocal skipped_count
+        count = len(cat_lambda_payloads) if final else len(cat_lambda_payloads) // BATCH_SIZE * BATCH_SIZE
+        fresh_payloads, duplicate_count = claim_fresh_surveys(cat_lambda_payloads[:count])
+        skipped_count += duplicate_count
+        forwarder.submit(fresh_payloads)
+        claimed.extend(survey_refs(fresh_payloads))
+        del cat_lambda_payloads[:count]
+
+    def counted_chunks(body):
+        nonlocal bytes_read
+        chunks = body.iter_chunks(chunk_size=STREAM_CHUNK_SIZE)
+        while True:
+            with metrics.timer("s3_read"):
+                chunk = next(chunks, None)
+            if chunk is None:
+                return
+            bytes_read += len(chunk)
+            yield chunk
+
+    # Get object content from S3
+    with metrics.timer("s3_get"):
+        response = s3_client.get_object(Bucket=bucket_name, Key=object_key)
+    # A redelivered notification, or the same content uploaded again, has the same ETag
+    etag = response.get('ETag')
+    if not idempotency.claim_object(bucket_name, object_key, etag):
+        response['Body'].close()
+        metrics.log("Skipping S3 object: already processed", object=f"s3://{bucket_name}/{object_key}", etag=etag)
+        return 0, 0
+    forwarder = InvokeExecutor(CAT_LAMBDA_FUNCTION_NAME, lambda_client)
+    try:
+        try:
+            for idx, (questionnaire, parse_error) in enumerate(iter_questionnaires(counted_chunks(response['Body']))):
+                questionnaire_count += 1
+                if parse_error:
+                    metrics.log_record("Skipping questionnaire", index=idx + 1, object_key=object_key, reason=parse_error)
+                    metrics.skip("JSON decode error")
                     skipped_count += 1
                     continue
+                # Validated a batch at a time; valid entries are queued for cat_lambda
+                pending.append((idx + 1, object_key, questionnaire))
+                if len(pending) >= VALIDATION_BATCH_SIZE:
+                    validate_pending()
+                    if len(cat_lambda_payloads) >= BATCH_SIZE:
+                        flush()
+        except json.JSONDecodeError as e:
+            # Anything already parsed is still forwarded; the rest of the file is skipped
+            metrics.error("JSON decode error. Skipping rest of object.", object=f"s3://{bucket_name}/{object_key}", error=str(e))
+            metrics.skip("JSON decode error")
+            skipped_count += 1
+        finally:
+            response['Body'].close()
+
+        # --- Invoke cat_lambda for whatever is left ---
+        validate_pending()
+        flush(final=True)
+    except Exception:
+        # Let a redelivery process the object again
+        settle_forwarded(claimed, *forwarder.close())
+        idempotency.release_object(bucket_name, object_key, etag)
+        raise
+    sent_count, failed_payloads = forwarder.close()
+    settle_forwarded(claimed, sent_count, failed_payloads)
+    if failed_payloads:
+        # Released so a redelivery processes the object again
+        idempotency.release_object(bucket_name, object_key, etag)
+        raise ForwardingError(f"{len(failed_payloads)} of {sent_count + len(failed_payloads)} surveys "
+                              f"from s3://{bucket_name}/{object_key} could not be forwarded")
+    processed_count += sent_count
+    idempotency.complete_object(bucket_name, object_key, etag)
+
+    elapsed = max(time.perf_counter() - started, 1e-9)
+    metrics.count("questionnaires", questionnaire_count)
+    metrics.observe_size("s3_object_bytes", bytes_read)
+    metrics.log("Processed S3 object",
+        object=f"s3://{bucket_name}/{object_key}",
+        questionnaires=questionnaire_count,
+        processed=processed_count,
+        skipped=skipped_count,
+        bytes=bytes_read,
+        seconds=round(elapsed, 3),
+        surveys_per_second=round(questionnaire_count / elapsed, 1),
+        bytes_per_second=round(bytes_read / elapsed, 1)
+    )
+    return processed_count, skipped_count
+
+
+def s3_objects_from(notification):
+    # (bucket, key) pairs in an S3 event notification; keys arrive URL-encoded
+    return [(record['s3']['bucket']['name'], unquote_plus(record['s3']['object']['key']))
+            for record in notification.get('Records', []) if 's3' in record]
 
-                print(f"Parsed {len(questionnaires)} questionnaires from {object_key}.")
-                
-                # Process each questionnaire in the list
-                for idx, questionnaire in enumerate(questionnaires):
-                    try:
-                        # --- Validation Logic ---
-                        time_elapsed = questionnaire.get('time_elapsed', 0)
-                        user_id = questionnaire.get('user_id', '').strip()
-                        timestamp = questionnaire.get('timestamp', '').strip()
-
-                        is_valid = True
-                        validation_reason = []
-
-                        if not isinstance(time_elapsed, (int, float)) or time_elapsed < 5.0: # Changed min_time_elapsed to 5s as per earlier discussion
-                            is_valid = False
-                            validation_reason.append(f"Invalid time_elapsed={time_elapsed} (must be >= 5).")
-                        
-                        if not user_id:
-                            is_valid = False
-                            validation_reason.append("Missing user_id.")
-                        
-                        if not timestamp:
-                            is_valid = False
-                            validation_reason.append("Missing timestamp.")
-                        else:
-                            try:
-                                # Ensure timestamp is in correct format (MMDDYYHHMMSS)
-                                datetime.strptime(timestamp, "%m%d%y%H%M%S") 
-                            except ValueError:
-                                is_valid = False
-                                validation_reason.append(f"Invalid timestamp format={timestamp} (expected MMDDYYHHMMSS).")
-                        
-                        responses = {k.lower(): v for k, v in questionnaire.get("responses", {}).items()}
-                        if not responses:
-                            is_valid = False
-                            validation_reason.append("Responses object is empty.")
-                        elif not all(q in responses for q in ["q1", "q2", "q3", "q4", "q5", "q6"]):
-                            is_valid = False
-                            validation_reason.append("Missing one or more core questions (q1-q6).")
-                        else:
-                            q5_data = responses.get("q5", {})
-                            if not q5_data.get("symptoms") and not q5_data.get("additional"):
-                                is_valid = False
-                                validation_reason.append("Q5 is empty: No symptoms or additional comments provided.")  
-
-
-                        if not is_valid:
-                            full_reason = " ".join(validation_reason)
-                            print(f"Skipping questionnaire {idx + 1} for user {user_id}: Invalid entry. Reason: {full_reason}")
-                            skipped_count += 1
-                            continue # Skip to the next questionnaire in the list
-
-                        # --- If Valid, Invoke cat_lambda ---
-                        print(f"Questionnaire {idx + 1} for user {user_id} is valid. Invoking {CAT_LAMBDA_FUNCTION_NAME}.")
-                        
-                        # Prepare payload for cat_lambda (should match what cat_lambda expects)
-                        cat_lambda_payload = {
-                            'user_id': user_id,
-                            'timestamp': timestamp,
-                            'time_elapsed': time_elapsed,
-                            'responses': responses  # Normalized lowercase keys
-}
 
-                        lambda_client.invoke(
-                            FunctionName=CAT_LAMBDA_FUNCTION_NAME,
-                            InvocationType='Event', # Asynchronous invocation
-                            Payload=json.dumps(cat_lambda_payload)
-                        )
-                        processed_count += 1
+def decode_sqs_body(body):
+    # Returns (questionnaires, s3_objects) carried by one SQS message: a raw survey, a JSON array
+    # of surveys, or an S3 event notification (sent directly or wrapped in an SNS envelope).
+    # Raises json.JSONDecodeError / TypeError for a body that isn't JSON.
+    message = codec.loads(body)
+    if isinstance(message, dict) and message.get('Type') == 'Notification' and 'Message' in message:
+        message = codec.loads(message['Message'])
+    if isinstance(message, list):
+        return message, []
+    if isinstance(message, dict) and 'Records' in message:
+        return [], s3_objects_from(message)
+    if isinstance(message, dict) and message.get('Event') == 's3:TestEvent':
+        return [], []
+    return [message], []
 
-                    except Exception as e:
-                        print(f"Error processing questionnaire {idx + 1} from {object_key}: {str(e)}. Skipping.")
-                        skipped_count += 1
 
+# S3 errors that retrying the message won't fix
+PERMANENT_S3_ERRORS = ('NoSuchKey', 'NoSuchBucket', 'AccessDenied')
+
+
+def process_sqs_records(records):
+    # Validates every survey in a batch of SQS messages and forwards the valid ones to cat_lambda
+    # together. Invalid or undecodable messages are skipped, since a retry can't fix them; a message
+    # only fails if its S3 object couldn't be read or its surveys couldn't be forwarded.
+    # Returns (processed, skipped, failed_message_ids) with the failed IDs in delivery order.
+    metrics = instrumentation.current()
+    processed_count = 0
+    skipped_count = 0
+    failed = {}
+    entries = []  # (index, messageId, questionnaire) for every survey in the batch
+
+    for record in records:
+        message_id = record['messageId']
+        try:
+            questionnaires, s3_objects = decode_sqs_body(record.get('body'))
+        except (json.JSONDecodeError, TypeError) as e:
+            metrics.log_record("Skipping SQS message: body is not JSON", message_id=message_id, error=str(e))
+            metrics.skip("JSON decode error")
+            skipped_count += 1
+            continue
+
+        for bucket_name, object_key in s3_objects:
+            try:
+                processed, skipped = process_s3_object(bucket_name, object_key)
+                processed_count += processed
+                skipped_count += skipped
+            except ForwardingError as e:
+                metrics.error("Could not forward every survey in S3 object", object=f"s3://{bucket_name}/{object_key}", message_id=message_id, error=str(e))
+                failed[message_id] = True
+            except ClientError as e:
+                metrics.error("S3 ClientError for object", object=f"s3://{bucket_name}/{object_key}", message_id=message_id, error=str(e))
+                metrics.count("s3_errors")
+                if e.response['Error']['Code'] not in PERMANENT_S3_ERRORS:
+                    failed[message_id] = True
+            except Exception as e:
+                metrics.error("An unexpected error occurred for S3 object", object=f"s3://{bucket_name}/{object_key}", message_id=message_id, error=str(e))
+                metrics.count("s3_errors")
+                failed[message_id] = True
+
+        entries.extend((idx + 1, message_id, questionnaire) for idx, questionnaire in enumerate(questionnaires))
+
+    # Surveys from every message are validated together and sent in one set of invokes
+    cat_lambda_payloads = []
+    owners = []  # messageId for each payload
+    for (_, message_id, _), payload in zip(entries, check_questionnaires(entries)):
+        if payload is None:
+            skipped_count += 1
+            continue
+        cat_lambda_payloads.append(payload)
+        owners.append(message_id)
+
+    # A failed invoke fails every message it carried
+    sent_count, failed_payloads, duplicate_count = forward_surveys(cat_lambda_payloads)
+    processed_count += sent_count
+    skipped_count += duplicate_count
+    if failed_payloads:
+        failed_ids = {id(payload) for payload in failed_payloads}
+        for payload, message_id in zip(cat_lambda_payloads, owners):
+            if id(payload) in failed_ids:
+                failed[message_id] = True
+
+    return processed_count, skipped_count, list(failed)
+
+
+def lambda_handler(event, context):
+    # S3 events carry no trace ID, so every invocation starts a new trace
+    metrics = instrumentation.start("verify", event)
+    metrics.log_record("Received event", event=event)
+
+    processed_count = 0
+    skipped_count = 0
+
+    # SQS event source mapping: report the failed messages so only those are retried
+    records = event.get('Records', [])
+    if records and records[0].get('eventSource') == 'aws:sqs':
+        processed_count, skipped_count, failed_message_ids = process_sqs_records(records)
+        metrics.count("sqs_messages", len(records))
+        metrics.count("sqs_failed_messages", len(failed_message_ids))
+        metrics.log("Processed SQS batch", messages=len(records), processed=processed_count,
+                    skipped=skipped_count, failed_messages=len(failed_message_ids))
+        metrics.emit()
+        return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed_message_ids]}
+
+    # This Lambda is triggered by an S3 PutObject event.
+    unforwarded = []
+    for record in records:
+        if 's3' in record:
+            bucket_name, object_key = s3_objects_from({'Records': [record]})[0]
+            metrics.log("Processing S3 object", object=f"s3://{bucket_name}/{object_key}")
+
+            try:
+                processed, skipped = process_s3_object(bucket_name, object_key)
+                processed_count += processed
+                skipped_count += skipped
+            except ForwardingError as e:
+                metrics.error("Could not forward every survey in S3 object", object=f"s3://{bucket_name}/{object_key}", error=str(e))
+                unforwarded.append(e)
             except ClientError as e:
-                print(f"S3 ClientError for object s3://{bucket_name}/{object_key}: {str(e)}")
+                metrics.error("S3 ClientError for object", object=f"s3://{bucket_name}/{object_key}", error=str(e))
+                metrics.count("s3_errors")
             except Exception as e:
-                print(f"An unexpected error occurred for S3 object s3://{bucket_name}/{object_key}: {str(e)}")
+                metrics.error("An unexpected error occurred for S3 object", object=f"s3://{bucket_name}/{object_key}", error=str(e))
+                metrics.count("s3_errors")
         else:
-            print(f"Record does not contain S3 event data: {json.dumps(record)}")
+            metrics.log("Record does not contain S3 event data", record=record)
 
+    metrics.emit()
+    if unforwarded:
+        # Fail the invocation so Lambda retries the event; the released objects are processed again
+        raise unforwarded[0]
     return {
         'statusCode': 200,
         'body': json.dumps(f'S3 object processing complete. Processed: {processed_count}, Skipped: {skipped_count} questionnaires.')
-    }
\ No newline at end of file
+    }